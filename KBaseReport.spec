@@ -9,15 +9,42 @@ module KBaseReport {
     typedef string ws_id;
 
     /*
-     * Structure representing a template to be rendered. 'template_file' must be provided,
-     * 'template_data_json' is optional
+     * Split the list under 'data_key' in the template data into pages of 'page_size' items,
+     * rendering the template once for each page. Each page is rendered with 'data_key' set to the
+     * items on that page, and with the variable 'pagination', which has the keys 'page', 'pages',
+     * 'page_size', 'total', 'first', 'last', 'files', 'prev' and 'next' for building navigation.
+     * The first page is saved with the output file name, and page N as <name>_N<extension>.
+     */
+
+    typedef structure {
+        string data_key;
+        int page_size;
+    } Paginate;
+
+    /*
+     * Structure representing a template to be rendered. 'template_file' must be provided;
+     * the data can be given as 'template_data_json' or as 'template_data_file', a JSON or NDJSON
+     * (.ndjson or .jsonl) file in the scratch directory. Both are optional.
      */
 
     typedef structure {
         string template_file;
         string template_data_json;
+        string template_data_file;
     } TemplateParams;
 
+    /*
+     * A template for a file in file_links or html_links. As TemplateParams, with the optional
+     * 'paginate', as the pages of a link are saved to a directory and uploaded together.
+     */
+
+    typedef structure {
+        string template_file;
+        string template_data_json;
+        string template_data_file;
+        Paginate paginate;
+    } LinkedTemplateParams;
+
     /*
      * Represents a Workspace object with some brief description text
      * that can be associated with the object.
@@ -103,7 +130,7 @@ module KBaseReport {
      *  One of the following identifiers is required:
      *     string path - Can be a file or directory path.
      *     string shock_id - Shock node ID.
-     *     TemplateParams template - template to be rendered and saved as a file.
+     *     LinkedTemplateParams template - template to be rendered and saved as a file.
      * Optional arguments:
      *     string label - A short description for the file (eg. "Filter results")
      *     string description - A more detailed, human-readable description of the file
@@ -111,7 +138,7 @@ module KBaseReport {
     typedef structure {
         string path;
         string shock_id;
-        TemplateParams template;
+        LinkedTemplateParams template;
         string name;
         string label;
         string description;
@@ -190,12 +217,21 @@ module KBaseReport {
      *                              should be saved. Must be in the scratch directory.
      * Optional:
      *     string template_data_json -  Data for rendering in the template.
+     *     string template_data_file -  Path to a JSON file with the data for rendering in the
+     *                                  template, instead of template_data_json. Must be in the
+     *                                  scratch directory. In an NDJSON file (extension .ndjson
+     *                                  or .jsonl), each line is a record, and the list of
+     *                                  records is available to the template as `records`.
+     *     Paginate paginate         -  Split a list in the data across several pages, saved
+     *                                  in the same directory as output_file.
      */
 
     typedef structure {
         string template_file;
         string output_file;
         string template_data_json;
+        string template_data_file;
+        Paginate paginate;
     } RenderTemplateParams;
 
     /*
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 #BEGIN_HEADER
 from installed_clients.DataFileUtilClient import DataFileUtil
-from .utils import report_utils
+from .utils import json_codec, report_utils
 from .utils.TemplateUtil import TemplateUtil
-from .utils.validation_utils import validate_simple_report_params, validate_extended_report_params
+from .utils.validation_utils import (validate_simple_report_params,
+                                     validate_extended_report_params, validate_upload_config)
 import os
+import time
 from configparser import ConfigParser
 #END_HEADER
 
@@ -37,6 +39,8 @@ class KBaseReport:
         #BEGIN_CONSTRUCTOR
 
         self.config = config
+        # JSON codec for template data
+        json_codec.use_codec(self.config.get('json-codec'))
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.dfu = DataFileUtil(self.callback_url)
 
@@ -53,6 +57,13 @@ class KBaseReport:
 
         self.config['template_toolkit'] = template_toolkit_config
         self.templater = TemplateUtil(self.config)
+        if self.templater.config['template-warm-up']:
+            # the server creates this object before forking, so the workers start warm
+            warm_up = self.templater.warm_up()
+            print(f"{time.time()} Compiled {warm_up['compiled']} templates")
+            for (path, err) in warm_up['failed'].items():
+                print(f'{time.time()} Could not compile template {path}: {err}')
+        self.upload_config = validate_upload_config(self.config)
 
         self.scratch = config['scratch']
 
@@ -87,10 +98,13 @@ class KBaseReport:
            in the report view) -> structure: parameter "text_message" of
            String, parameter "direct_html" of String, parameter "template" of
            type "TemplateParams" (* Structure representing a template to be
-           rendered. 'template_file' must be provided, * 'template_data_json'
-           is optional) -> structure: parameter "template_file" of String,
-           parameter "template_data_json" of String, parameter "warnings" of
-           list of String, parameter "objects_created" of list of type
+           rendered. 'template_file' must be provided; * the data can be
+           given as 'template_data_json' or as 'template_data_file', a JSON
+           or NDJSON * (.ndjson or .jsonl) file in the scratch directory.
+           Both are optional.) -> structure: parameter "template_file" of
+           String, parameter "template_data_json" of String, parameter
+           "template_data_file" of String, parameter "warnings" of list of
+           String, parameter "objects_created" of list of type
            "WorkspaceObject" (* Represents a Workspace object with some brief
            description text * that can be associated with the object. *
            Required arguments: *     ws_id ref - workspace ID in the format
@@ -118,9 +132,11 @@ class KBaseReport:
         #BEGIN create
         params = validate_simple_report_params(params)
 
-        if 'template' in params['report']:
-            # render template and set content as 'direct_html'
-            params['report'] = self.templater.render_template_to_direct_html(params['report'])
+        with self.templater.collect_profiles() as profiles:
+            if 'template' in params['report']:
+                # render template and set content as 'direct_html'
+                params['report'] = self.templater.render_template_to_direct_html(params['report'])
+        report_utils.log_template_profiles(ctx, profiles)
         info = report_utils.create_report(params, self.dfu)
         #END create
 
@@ -197,45 +213,70 @@ class KBaseReport:
            "results.zip") -- shown to the user *  One of the following
            identifiers is required: *     string path - Can be a file or
            directory path. *     string shock_id - Shock node ID. *
-           TemplateParams template - template to be rendered and saved as a
-           file. * Optional arguments: *     string label - A short
+           LinkedTemplateParams template - template to be rendered and saved
+           as a file. * Optional arguments: *     string label - A short
            description for the file (eg. "Filter results") *     string
            description - A more detailed, human-readable description of the
            file) -> structure: parameter "path" of String, parameter
            "shock_id" of String, parameter "template" of type
-           "TemplateParams" (* Structure representing a template to be
-           rendered. 'template_file' must be provided, * 'template_data_json'
-           is optional) -> structure: parameter "template_file" of String,
-           parameter "template_data_json" of String, parameter "name" of
-           String, parameter "label" of String, parameter "description" of
-           String, parameter "template" of type "TemplateParams" (* Structure
+           "LinkedTemplateParams" (* A template for a file in file_links or
+           html_links. As TemplateParams, with the optional * 'paginate', as
+           the pages of a link are saved to a directory and uploaded
+           together.) -> structure: parameter "template_file" of String,
+           parameter "template_data_json" of String, parameter
+           "template_data_file" of String, parameter "paginate" of type
+           "Paginate" (* Split the list under 'data_key' in the template data
+           into pages of 'page_size' items, * rendering the template once for
+           each page. Each page is rendered with 'data_key' set to the *
+           items on that page, and with the variable 'pagination', which has
+           the keys 'page', 'pages', * 'page_size', 'total', 'first', 'last',
+           'files', 'prev' and 'next' for building navigation. * The first
+           page is saved with the output file name, and page N as
+           <name>_N<extension>.) -> structure: parameter "data_key" of
+           String, parameter "page_size" of Long, parameter "name" of String,
+           parameter "label" of String, parameter "description" of String,
+           parameter "template" of type "TemplateParams" (* Structure
            representing a template to be rendered. 'template_file' must be
-           provided, * 'template_data_json' is optional) -> structure:
+           provided; * the data can be given as 'template_data_json' or as
+           'template_data_file', a JSON or NDJSON * (.ndjson or .jsonl) file
+           in the scratch directory. Both are optional.) -> structure:
            parameter "template_file" of String, parameter
-           "template_data_json" of String, parameter "direct_html" of String,
-           parameter "direct_html_link_index" of Long, parameter "file_links"
-           of list of type "File" (* A file to be linked in the report. Pass
-           in *either* a shock_id or a * path. If a path to a file is given,
+           "template_data_json" of String, parameter "template_data_file" of
+           String, parameter "direct_html" of String, parameter
+           "direct_html_link_index" of Long, parameter "file_links" of list
+           of type "File" (* A file to be linked in the report. Pass in
+           *either* a shock_id or a * path. If a path to a file is given,
            then the file will be uploaded. If a * path to a directory is
            given, then it will be zipped and uploaded. * Required arguments:
            *     string name - Plain-text filename (eg. "results.zip") --
            shown to the user *  One of the following identifiers is required:
            *     string path - Can be a file or directory path. *     string
-           shock_id - Shock node ID. *     TemplateParams template - template
-           to be rendered and saved as a file. * Optional arguments: *
-           string label - A short description for the file (eg. "Filter
+           shock_id - Shock node ID. *     LinkedTemplateParams template -
+           template to be rendered and saved as a file. * Optional arguments:
+           *     string label - A short description for the file (eg. "Filter
            results") *     string description - A more detailed,
            human-readable description of the file) -> structure: parameter
            "path" of String, parameter "shock_id" of String, parameter
-           "template" of type "TemplateParams" (* Structure representing a
-           template to be rendered. 'template_file' must be provided, *
-           'template_data_json' is optional) -> structure: parameter
-           "template_file" of String, parameter "template_data_json" of
-           String, parameter "name" of String, parameter "label" of String,
-           parameter "description" of String, parameter "report_object_name"
-           of String, parameter "html_window_height" of Double, parameter
-           "summary_window_height" of Double, parameter "workspace_name" of
-           String, parameter "workspace_id" of Long
+           "template" of type "LinkedTemplateParams" (* A template for a file
+           in file_links or html_links. As TemplateParams, with the optional
+           * 'paginate', as the pages of a link are saved to a directory and
+           uploaded together.) -> structure: parameter "template_file" of
+           String, parameter "template_data_json" of String, parameter
+           "template_data_file" of String, parameter "paginate" of type
+           "Paginate" (* Split the list under 'data_key' in the template data
+           into pages of 'page_size' items, * rendering the template once for
+           each page. Each page is rendered with 'data_key' set to the *
+           items on that page, and with the variable 'pagination', which has
+           the keys 'page', 'pages', * 'page_size', 'total', 'first', 'last',
+           'files', 'prev' and 'next' for building navigation. * The first
+           page is saved with the output file name, and page N as
+           <name>_N<extension>.) -> structure: parameter "data_key" of
+           String, parameter "page_size" of Long, parameter "name" of String,
+           parameter "label" of String, parameter "description" of String,
+           parameter "report_object_name" of String, parameter
+           "html_window_height" of Double, parameter "summary_window_height"
+           of Double, parameter "workspace_name" of String, parameter
+           "workspace_id" of Long
         :returns: instance of type "ReportInfo" (* The reference to the saved
            KBaseReport. This is the return object for * both create() and
            create_extended() * Returned data: *    ws_id ref - reference to a
@@ -252,10 +293,13 @@ class KBaseReport:
         # return variables are: info
         #BEGIN create_extended_report
         params = validate_extended_report_params(params)
-        if 'template' in params:
-            # render template and set content as 'direct_html'
-            params = self.templater.render_template_to_direct_html(params)
-        info = report_utils.create_extended(params, self.dfu, self.templater)
+        with self.templater.collect_profiles() as profiles:
+            if 'template' in params:
+                # render template and set content as 'direct_html'
+                params = self.templater.render_template_to_direct_html(params)
+            info = report_utils.create_extended(params, self.dfu, self.templater,
+                                                self.upload_config, ctx)
+        report_utils.log_template_profiles(ctx, profiles)
         #END create_extended_report
 
         # At some point might do deeper type checking...
@@ -285,9 +329,27 @@ class KBaseReport:
            *     string output_file    -  Path to the file where the rendered
            template *                              should be saved. Must be
            in the scratch directory. * Optional: *     string
-           template_data_json -  Data for rendering in the template.) ->
-           structure: parameter "template_file" of String, parameter
-           "output_file" of String, parameter "template_data_json" of String
+           template_data_json -  Data for rendering in the template. *
+           string template_data_file -  Path to a JSON file with the data for
+           rendering in the *                                  template,
+           instead of template_data_json. Must be in the *
+           scratch directory. In an NDJSON file (extension .ndjson *
+           or .jsonl), each line is a record, and the list of *
+           records is available to the template as `records`. *     Paginate
+           paginate         -  Split a list in the data across several pages,
+           saved *                                  in the same directory as
+           output_file.) -> structure: parameter "template_file" of String,
+           parameter "output_file" of String, parameter "template_data_json"
+           of String, parameter "template_data_file" of String, parameter
+           "paginate" of type "Paginate" (* Split the list under 'data_key'
+           in the template data into pages of 'page_size' items, * rendering
+           the template once for each page. Each page is rendered with
+           'data_key' set to the * items on that page, and with the variable
+           'pagination', which has the keys 'page', 'pages', * 'page_size',
+           'total', 'first', 'last', 'files', 'prev' and 'next' for building
+           navigation. * The first page is saved with the output file name,
+           and page N as <name>_N<extension>.) -> structure: parameter
+           "data_key" of String, parameter "page_size" of Long
         :returns: instance of type "File" (* A file to be linked in the
            report. Pass in *either* a shock_id or a * path. If a path to a
            file is given, then the file will be uploaded. If a * path to a
@@ -296,23 +358,35 @@ class KBaseReport:
            "results.zip") -- shown to the user *  One of the following
            identifiers is required: *     string path - Can be a file or
            directory path. *     string shock_id - Shock node ID. *
-           TemplateParams template - template to be rendered and saved as a
-           file. * Optional arguments: *     string label - A short
+           LinkedTemplateParams template - template to be rendered and saved
+           as a file. * Optional arguments: *     string label - A short
            description for the file (eg. "Filter results") *     string
            description - A more detailed, human-readable description of the
            file) -> structure: parameter "path" of String, parameter
            "shock_id" of String, parameter "template" of type
-           "TemplateParams" (* Structure representing a template to be
-           rendered. 'template_file' must be provided, * 'template_data_json'
-           is optional) -> structure: parameter "template_file" of String,
-           parameter "template_data_json" of String, parameter "name" of
-           String, parameter "label" of String, parameter "description" of
-           String
+           "LinkedTemplateParams" (* A template for a file in file_links or
+           html_links. As TemplateParams, with the optional * 'paginate', as
+           the pages of a link are saved to a directory and uploaded
+           together.) -> structure: parameter "template_file" of String,
+           parameter "template_data_json" of String, parameter
+           "template_data_file" of String, parameter "paginate" of type
+           "Paginate" (* Split the list under 'data_key' in the template data
+           into pages of 'page_size' items, * rendering the template once for
+           each page. Each page is rendered with 'data_key' set to the *
+           items on that page, and with the variable 'pagination', which has
+           the keys 'page', 'pages', * 'page_size', 'total', 'first', 'last',
+           'files', 'prev' and 'next' for building navigation. * The first
+           page is saved with the output file name, and page N as
+           <name>_N<extension>.) -> structure: parameter "data_key" of
+           String, parameter "page_size" of Long, parameter "name" of String,
+           parameter "label" of String, parameter "description" of String
         """
         # ctx is the context object
         # return variables are: output_file_path
         #BEGIN render_template
-        output_file_path = self.templater.render_template_to_file(params)
+        with self.templater.collect_profiles() as profiles:
+            output_file_path = self.templater.render_template_to_file(params)
+        report_utils.log_template_profiles(ctx, profiles)
         #END render_template
 
         # At some point might do deeper type checking...
@@ -336,9 +410,27 @@ class KBaseReport:
            Path to the template file to be rendered. *     string output_file
            -  Path to the file where the rendered template *
            should be saved. Must be in the scratch directory. * Optional: *
-           string template_data_json -  Data for rendering in the template.)
-           -> structure: parameter "template_file" of String, parameter
-           "output_file" of String, parameter "template_data_json" of String
+           string template_data_json -  Data for rendering in the template. *
+           string template_data_file -  Path to a JSON file with the data for
+           rendering in the *                                  template,
+           instead of template_data_json. Must be in the *
+           scratch directory. In an NDJSON file (extension .ndjson *
+           or .jsonl), each line is a record, and the list of *
+           records is available to the template as `records`. *     Paginate
+           paginate         -  Split a list in the data across several pages,
+           saved *                                  in the same directory as
+           output_file.) -> structure: parameter "template_file" of String,
+           parameter "output_file" of String, parameter "template_data_json"
+           of String, parameter "template_data_file" of String, parameter
+           "paginate" of type "Paginate" (* Split the list under 'data_key'
+           in the template data into pages of 'page_size' items, * rendering
+           the template once for each page. Each page is rendered with
+           'data_key' set to the * items on that page, and with the variable
+           'pagination', which has the keys 'page', 'pages', * 'page_size',
+           'total', 'first', 'last', 'files', 'prev' and 'next' for building
+           navigation. * The first page is saved with the output file name,
+           and page N as <name>_N<extension>.) -> structure: parameter
+           "data_key" of String, parameter "page_size" of Long
         :returns: instance of type "FileList" -> structure: parameter
            "file_list" of list of type "File" (* A file to be linked in the
            report. Pass in *either* a shock_id or a * path. If a path to a
@@ -348,23 +440,35 @@ class KBaseReport:
            "results.zip") -- shown to the user *  One of the following
            identifiers is required: *     string path - Can be a file or
            directory path. *     string shock_id - Shock node ID. *
-           TemplateParams template - template to be rendered and saved as a
-           file. * Optional arguments: *     string label - A short
+           LinkedTemplateParams template - template to be rendered and saved
+           as a file. * Optional arguments: *     string label - A short
            description for the file (eg. "Filter results") *     string
            description - A more detailed, human-readable description of the
            file) -> structure: parameter "path" of String, parameter
            "shock_id" of String, parameter "template" of type
-           "TemplateParams" (* Structure representing a template to be
-           rendered. 'template_file' must be provided, * 'template_data_json'
-           is optional) -> structure: parameter "template_file" of String,
-           parameter "template_data_json" of String, parameter "name" of
-           String, parameter "label" of String, parameter "description" of
-           String
+           "LinkedTemplateParams" (* A template for a file in file_links or
+           html_links. As TemplateParams, with the optional * 'paginate', as
+           the pages of a link are saved to a directory and uploaded
+           together.) -> structure: parameter "template_file" of String,
+           parameter "template_data_json" of String, parameter
+           "template_data_file" of String, parameter "paginate" of type
+           "Paginate" (* Split the list under 'data_key' in the template data
+           into pages of 'page_size' items, * rendering the template once for
+           each page. Each page is rendered with 'data_key' set to the *
+           items on that page, and with the variable 'pagination', which has
+           the keys 'page', 'pages', * 'page_size', 'total', 'first', 'last',
+           'files', 'prev' and 'next' for building navigation. * The first
+           page is saved with the output file name, and page N as
+           <name>_N<extension>.) -> structure: parameter "data_key" of
+           String, parameter "page_size" of Long, parameter "name" of String,
+           parameter "label" of String, parameter "description" of String
         """
         # ctx is the context object
         # return variables are: output_paths
         #BEGIN render_templates
-        output_paths = self.templater.render_template_list_to_files(params)
+        with self.templater.collect_profiles() as profiles:
+            output_paths = self.templater.render_template_list_to_files(params)
+        report_utils.log_template_profiles(ctx, profiles)
         #END render_templates
 
         # At some point might do deeper type checking...
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from uuid import uuid4
+
+from . import json_codec
+
+"""
+Cache of rendered template output
+
+Output is looked up by a request key, made from the template name, the TT config and a digest
+of the template data, and stored under an output key that adds the modification time and size
+of every template file that was loaded for the render (the main template and everything it
+INCLUDEs or PROCESSes, directly or not). A change to any of those files gives a new output key,
+so stale output is never returned.
+"""
+
+# outputs bigger than this are only kept on disk
+_MAX_MEMORY_ENTRY_SIZE = 16 * 1024 * 1024
+
+# template files loaded by the render running in this thread (see recording_dependencies)
+_dependencies = threading.local()
+
+
+@contextmanager
+def recording_dependencies():
+    """ Collect the paths of the template files that are loaded in this thread """
+    paths = set()
+    previous = getattr(_dependencies, 'paths', None)
+    _dependencies.paths = paths
+    try:
+        yield paths
+    finally:
+        _dependencies.paths = previous
+
+
+def record_dependency(path):
+    """ Called by template loaders for each template file they look at """
+    paths = getattr(_dependencies, 'paths', None)
+    if paths is not None:
+        paths.add(path)
+
+
+def request_key(template_file, template_data, uc_tt_config, backend='tt'):
+    """
+    Cache key for rendering a template with some data
+    :param template_file:   (string)  the template file to render
+    :param template_data:   (dict)    data to be rendered in the template
+    :param uc_tt_config:    (dict)    TT config, with the keys in upper case
+    :param backend:         (string)  name of the template backend that renders it
+    :return: hex digest, or None if the data cannot be serialised as JSON
+    """
+    try:
+        data_json = json_codec.dumps(template_data, sort_keys=True, compact=True)
+    except (TypeError, ValueError):
+        return None
+    config_json = json.dumps(uc_tt_config, sort_keys=True, default=str)
+    sha = hashlib.sha256()
+    for part in [backend, template_file, config_json, data_json]:
+        sha.update(part.encode('utf-8') + b'\0')
+    return sha.hexdigest()
+
+
+def dependency_stamps(paths):
+    """ [path, mtime_ns, size] for each template file; a file that does not exist has Nones """
+    stamps = []
+    for path in sorted(paths):
+        try:
+            st = os.stat(path)
+            stamps.append([path, st.st_mtime_ns, st.st_size])
+        except OSError:
+            stamps.append([path, None, None])
+    return stamps
+
+
+class RenderCache:
+
+    def __init__(self, max_entries=128, cache_dir=None, max_size_mb=1024):
+        """
+        :param max_entries:  (int)     number of outputs kept in memory; least recently used go
+                                       first
+        :param cache_dir:    (string)  directory for the disk tier, which can be shared between
+                                       processes; None turns it off
+        :param max_size_mb:  (int)     size the disk tier is cut back to when it grows bigger;
+                                       least recently used outputs go first
+        """
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_size = max_size_mb * 1024 * 1024
+        # request key => dependency paths, and output key => output
+        self._dependencies = OrderedDict()
+        self._outputs = OrderedDict()
+        self._counts = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """ Counts of cache hits (of which disk_hits came from the disk tier), misses, and
+        outputs evicted from the disk tier by this process """
+        with self._lock:
+            return dict(self._counts)
+
+    def get(self, req_key):
+        """ Return the rendered output for a request key, or None """
+        output_key = self._output_key(req_key)
+        text = self._memory_output(output_key)
+        if text is not None:
+            return text
+
+        path = self._disk_output(output_key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'r') as f:
+                text = f.read()
+        except OSError:
+            # evicted by another process
+            return None
+        self._remember(output_key, text)
+        return text
+
+    def get_to_file(self, req_key, output_file):
+        """ Write the rendered output for a request key to a file; False if there is none """
+        output_key = self._output_key(req_key)
+        text = self._memory_output(output_key)
+        if text is not None:
+            with open(output_file, 'w') as f:
+                f.write(text)
+            return True
+
+        path = self._disk_output(output_key)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, output_file)
+        except FileNotFoundError:
+            # evicted by another process
+            return False
+        return True
+
+    def add(self, req_key, dependencies, text):
+        """
+        Store rendered output
+        :param req_key:       (string)  output of request_key
+        :param dependencies:  (set)     paths of the template files loaded for the render
+        :param text:          (string)  the output
+        """
+        output_key = self._add_dependencies(req_key, dependencies)
+        self._remember(output_key, text)
+        if self.cache_dir:
+            self._write_disk(output_key + '.out', lambda tmp: _write_text(tmp, text))
+
+    def add_file(self, req_key, dependencies, output_file):
+        """ Store rendered output that was written to a file; large files are only kept on disk """
+        output_key = self._add_dependencies(req_key, dependencies)
+        if os.path.getsize(output_file) <= _MAX_MEMORY_ENTRY_SIZE:
+            with open(output_file, 'r') as f:
+                self._remember(output_key, f.read())
+        if self.cache_dir:
+            self._write_disk(output_key + '.out', lambda tmp: shutil.copyfile(output_file, tmp))
+
+    def _count(self, *counters):
+        with self._lock:
+            for counter in counters:
+                self._counts[counter] += 1
+
+    def _memory_output(self, output_key):
+        """ Output from the memory tier, counting a hit; None if it is not there """
+        if output_key is None:
+            return None
+        with self._lock:
+            text = self._outputs.get(output_key)
+            if text is not None:
+                self._outputs.move_to_end(output_key)
+                self._counts['hits'] += 1
+        return text
+
+    def _disk_output(self, output_key):
+        """ Path of the output in the disk tier, counting a hit or miss; None if it is not there """
+        path = None
+        if output_key is not None and self.cache_dir:
+            path = os.path.join(self.cache_dir, output_key + '.out')
+            try:
+                # modification times order the disk tier for eviction
+                os.utime(path)
+            except OSError:
+                path = None
+        if path is None:
+            self._count('misses')
+        else:
+            self._count('hits', 'disk_hits')
+        return path
+
+    def _output_key(self, req_key):
+        """ Output key for the current state of the templates the request depends on """
+        with self._lock:
+            dependencies = self._dependencies.get(req_key)
+            if dependencies is not None:
+                self._dependencies.move_to_end(req_key)
+        if dependencies is None and self.cache_dir:
+            try:
+                with open(os.path.join(self.cache_dir, req_key + '.deps.json'), 'r') as f:
+                    dependencies = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if dependencies is None:
+            return None
+        return self._stamped_key(req_key, dependencies)
+
+    def _stamped_key(self, req_key, dependencies):
+        stamps = json.dumps(dependency_stamps(dependencies))
+        return hashlib.sha256((req_key + '\0' + stamps).encode('utf-8')).hexdigest()
+
+    def _add_dependencies(self, req_key, dependencies):
+        dependencies = sorted(dependencies)
+        with self._lock:
+            self._dependencies[req_key] = dependencies
+            self._dependencies.move_to_end(req_key)
+            while len(self._dependencies) > self.max_entries:
+                self._dependencies.popitem(last=False)
+        if self.cache_dir:
+            self._write_disk(req_key + '.deps.json',
+                             lambda tmp: _write_text(tmp, json.dumps(dependencies)))
+        return self._stamped_key(req_key, dependencies)
+
+    def _remember(self, output_key, text):
+        if len(text) > _MAX_MEMORY_ENTRY_SIZE:
+            return
+        with self._lock:
+            self._outputs[output_key] = text
+            self._outputs.move_to_end(output_key)
+            while len(self._outputs) > self.max_entries:
+                self._outputs.popitem(last=False)
+
+    def _write_disk(self, name, write):
+        """ Write a cache file atomically, so other processes never see part of one """
+        tmp_path = os.path.join(self.cache_dir, f'.{uuid4().hex}.tmp')
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        except OSError:
+            # the disk tier is only an optimisation
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used files until the disk tier is within max_size """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+        for (mtime, size, path) in sorted(entries):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._count('evictions')
+            total -= size
+            if total <= self.max_size:
+                break
+
+
+def _write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
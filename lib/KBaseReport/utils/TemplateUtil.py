@@ -1,12 +1,64 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import json
 import os.path
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from template import Template
+from template.context import Context
+from template.document import Document
+from template.provider import Provider
+from template.util import StringBuffer
 from uuid import uuid4
+from .RenderCache import (RenderCache, dependency_stamps, record_dependency, recording_dependencies,
+                          request_key)
+from .template_backends import (JinjaBackend, TemplateBackend, TT_EXTENSIONS, JINJA_EXTENSIONS,
+                                backend_name, include_paths)
+from .template_profile import RenderProfile, save_profile
 from .validation_utils import validate_template_params, validate_template_util_config, _format_errors
 
 """ Class for rendering from a template """
 
+# TemplateUtil used by each process in the render_template_list_to_files pool
+_worker_templater = None
+
+# output of the template currently being streamed to a file by this thread (see StreamingOutput)
+_streaming = threading.local()
+
+# the Buffer global of each compiled template being streamed, with the number of renders
+# streaming it (see _streaming_buffer)
+_streamed_documents = {}
+_streamed_documents_lock = threading.Lock()
+
+# profile of the render running in this thread, and the profiles being collected by
+# TemplateUtil.collect_profiles
+_profiling = threading.local()
+
+# buffer size for files that template output is streamed to
+_STREAM_BUFFER_SIZE = 1024 * 1024
+
+# TT options that add output around the main template, which rules out streaming it
+_NON_STREAMING_OPTIONS = ['PRE_PROCESS', 'POST_PROCESS', 'PROCESS', 'WRAPPER', 'ERROR', 'ERRORS']
+
+
+class TemplateRenderError(Exception):
+    """ One or more templates in a list could not be rendered """
+
+    def __init__(self, failures, param_list):
+        """
+        :param failures: list of (index in param_list, exception) tuples, in input order
+        :param param_list: the list of template params that was rendered
+        """
+        self.failures = failures
+        super().__init__("\n".join(
+            [f'{len(failures)} template(s) could not be rendered:'] +
+            [f"  [{idx}] {param_list[idx].get('template_file', '')}: {err}"
+             for (idx, err) in failures]
+        ))
+
 
 class TemplateUtil:
 
@@ -17,23 +69,175 @@ class TemplateUtil:
         validated_config = validate_template_util_config(config)
         self.config = validated_config
         self._template = None
+        # engines for rendering, by TT config; a render checks one out for its own use
+        self._engines = TemplateEnginePool(self._new_template_engine)
+        # template backends by name; see template_backends
+        self._backends = {'tt': TTBackend(self._engines)}
+        self._backends_lock = threading.Lock()
+        if validated_config['template-backend'] != 'tt':
+            self._backend(validated_config['template-backend'])
+        self._render_pool = None
+        self._render_pool_lock = threading.Lock()
+        self._render_cache = None
+        if validated_config['template-output-cache-size'] or \
+                validated_config['template-output-cache-dir']:
+            self._render_cache = RenderCache(
+                max_entries=validated_config['template-output-cache-size'],
+                cache_dir=validated_config['template-output-cache-dir'],
+                max_size_mb=validated_config['template-output-cache-max-mb'],
+            )
 
     def template_engine(self):
         if not self._template:
-            self._init_template_engine()
+            self._template = self._new_template_engine(self._tt_config())
 
         return self._template
 
-    def _init_template_engine(self, tt_config=None):
+    def _tt_config(self, tt_config=None):
+        """ The TT config to render with, defaulting to the one from KBaseReport """
 
         if not tt_config:
             tt_config = self.config['template_toolkit']
 
         # TTP requires the config keys be uppercase
-        uc_tt_config = {key.upper(): value for key, value in tt_config.items()}
-        self._template = Template(uc_tt_config)
+        return {key.upper(): value for key, value in tt_config.items()}
 
-        return self._template
+    def _new_template_engine(self, uc_tt_config):
+        """ Create a template engine for a TT config
+
+        Each engine has its own template provider, which keeps up to 'template-cache-size'
+        compiled templates in memory and checks the template files for changes every time they
+        are used; if 'template-cache-dir' is set, compiled templates are also saved there, and
+        are shared by all engines with the same config.
+
+        :param uc_tt_config:    (dict)  TT config, with the keys in upper case
+
+        :return:
+        engine (Template)
+        """
+        params = {
+            'CACHE_SIZE': self.config['template-cache-size'],
+            'STAT_TTL': 0,
+            **uc_tt_config,
+        }
+        # values from deploy.cfg are strings
+        for key in ['CACHE_SIZE', 'STAT_TTL']:
+            if isinstance(params[key], str):
+                params[key] = int(params[key])
+
+        cache_dir = None
+        if self.config['template-cache-dir']:
+            cache_dir = os.path.join(self.config['template-cache-dir'],
+                                     tt_config_digest(uc_tt_config))
+
+        engine_config = {
+            **uc_tt_config,
+            'LOAD_TEMPLATES': [TemplateCacheProvider(params, cache_dir)],
+        }
+        if self.config['template-profile']:
+            engine_config['CONTEXT'] = ProfilingContext(engine_config)
+        return Template(engine_config)
+
+    def collect_profiles(self):
+        """ Collect the profiles of the renders in this thread while the context is active
+
+        Used as
+
+            with templater.collect_profiles() as profiles:
+                templater.render_template_to_file(params)
+
+        Renders in the worker processes started by this thread are included. Nothing is
+        collected unless 'template-profile' is set; see template_profile for the format.
+        """
+        return _collecting_profiles()
+
+    @contextmanager
+    def _profiled(self, template_file):
+        """ Profile a render, if 'template-profile' is set """
+        if not self.config['template-profile']:
+            yield
+            return
+
+        profile = RenderProfile(template_file)
+        _profiling.current = profile
+        try:
+            yield
+        finally:
+            _profiling.current = None
+        profile.finish()
+        profile = profile.to_dict()
+        if self.config['template-profile-dir']:
+            save_profile(self.config['template-profile-dir'], profile)
+        _add_profiles([profile])
+
+    def render_cache_stats(self):
+        """ Hit and miss counts for the rendered output cache, or None if it is turned off """
+        if not self._render_cache:
+            return None
+        return self._render_cache.stats()
+
+    def _render_cache_key(self, template_file, template_data, uc_tt_config, backend):
+        """ Key for the rendered output cache; None if there is no cache or the data is unusable """
+        if not self._render_cache:
+            return None
+        return request_key(template_file, template_data, uc_tt_config, backend.name)
+
+    def _backend(self, name):
+        """ The template backend with a name ('tt' or 'jinja2'), created on first use """
+        with self._backends_lock:
+            if name not in self._backends:
+                self._backends[name] = JinjaBackend(self.config)
+            return self._backends[name]
+
+    def _template_backend(self, template_file):
+        """ The backend that renders a template file: by extension, or 'template-backend' """
+        return self._backend(backend_name(template_file, self.config['template-backend']))
+
+    def warm_up(self):
+        """ Compile the templates on the INCLUDE_PATH, so the first renders do not have to
+
+        Meant to be run before the server forks its workers, which then share the compiled
+        templates copy-on-write. Template Toolkit templates are compiled into an engine in the
+        pool for the default TT config, and Jinja2 templates into its environment, if Jinja2 is
+        installed; both are saved to 'template-cache-dir' if it is set, and only the last
+        'template-cache-size' of each stay in memory. Templates that fail to compile are
+        skipped, and raise their error as usual when they are rendered.
+
+        :return:
+        {
+            'compiled': 12,  # number of templates compiled
+            'failed': { '/path/to/template.tt': 'error message', ... },
+        }
+
+        """
+        uc_tt_config = self._tt_config()
+        extensions = TT_EXTENSIONS
+        if JinjaBackend.available():
+            extensions += JINJA_EXTENSIONS
+
+        compiled = set()
+        failed = {}
+        for dir_path in include_paths(uc_tt_config):
+            for (root, dirs, files) in os.walk(dir_path):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if not name.endswith(extensions):
+                        continue
+                    # nested INCLUDE_PATH dirs list some templates more than once
+                    if path in compiled or path in failed:
+                        continue
+                    # fetched by name, as INCLUDE and PROCESS do, so it is cached under the
+                    # same key
+                    rel_path = os.path.relpath(path, dir_path)
+                    try:
+                        self._template_backend(rel_path).compile(rel_path, uc_tt_config)
+                    except Exception as err:
+                        failed[path] = str(err)
+                    else:
+                        compiled.add(path)
+
+        return {'compiled': len(compiled), 'failed': failed}
 
     def render_template_to_direct_html(self, params):
         """ Render a template and save the resulting content as the 'direct_html' key in 'params'
@@ -74,6 +278,10 @@ class TemplateUtil:
         :return:
         [{ 'path': '/path/to/output_file' }, { 'path': '/path/to_file_2' }, ... ]
 
+        If 'template-render-workers' is more than 1, the templates are rendered and written
+        across a pool of that many processes. Any errors are then collected and raised as a
+        TemplateRenderError, which gives the index in param_list of each failed template.
+
         """
 
         # check for any identical output_file paths
@@ -88,7 +296,59 @@ class TemplateUtil:
                 else:
                     output_file_set.add(p['output_file'])
 
-        return [self.render_template_to_file(_) for _ in param_list]
+        if self.config['template-render-workers'] < 2 or len(param_list) < 2:
+            return [self.render_template_to_file(_) for _ in param_list]
+
+        (output, failures) = self._run_in_pool(_render_template_to_file_in_worker,
+                                               [(params,) for params in param_list])
+        if failures:
+            raise TemplateRenderError(failures, param_list)
+
+        return output
+
+    def _run_in_pool(self, func, arg_list):
+        """ Call func with each set of args in the worker processes
+
+        :return:
+        (output, failures)  output in input order, and a list of (index, exception) tuples for
+                            any calls that failed
+        """
+
+        pool = self._get_render_pool()
+        futures = [pool.submit(_call_in_worker, func, *args) for args in arg_list]
+        output = []
+        failures = []
+        for (idx, future) in enumerate(futures):
+            try:
+                (result, profiles) = future.result()
+                output.append(result)
+                _add_profiles(profiles)
+            except BrokenProcessPool:
+                # a worker died; start a new pool next time
+                self._drop_render_pool(pool)
+                raise
+            except Exception as err:
+                failures.append((idx, err))
+
+        return (output, failures)
+
+    def _get_render_pool(self):
+        """ The pool of render worker processes, started on first use """
+        with self._render_pool_lock:
+            if not self._render_pool:
+                self._render_pool = ProcessPoolExecutor(
+                    max_workers=self.config['template-render-workers'],
+                    initializer=_init_render_worker,
+                    initargs=(self.config,),
+                )
+            return self._render_pool
+
+    def _drop_render_pool(self, pool):
+        """ Shut down a broken pool, unless another render has already replaced it """
+        with self._render_pool_lock:
+            if self._render_pool is pool:
+                self._render_pool = None
+        pool.shutdown(wait=False)
 
     def render_template_to_file(self, params):
         """ Render a template and save the resulting content to a file
@@ -98,24 +358,39 @@ class TemplateUtil:
             template_file:      # the template file to render
             template_data:      # data to be rendered in the template
             output_file:        # path to a file where the output will be written
+            paginate:           # split a list in the data across pages (optional), e.g.
+                                # { 'data_key': 'genes', 'page_size': 1000 }
 
         :return:
         { 'path': '/path/to/output_file' }
 
+        If 'template-stream-output' is set, the output is written to the file as it is produced
+        rather than being built up in memory first.
+
+        The template is rendered by Template Toolkit or Jinja2, depending on its extension and
+        'template-backend'; see template_backends.
+
+        Output is reused from the rendered output cache, if there is one, when the template,
+        the templates it loads and the data are all unchanged.
+
+        With 'paginate', output_file is the first page; see _render_pages_to_files.
+
         """
 
         validated_params = validate_template_params(params, self.config, with_output_file=True)
-        template_string = self._render_template(validated_params['template_file'],
-                                                validated_params['template_data'],)
-
         output_file = validated_params['output_file']
         # ensure any subdirs are created
         dir_path = os.path.dirname(output_file)
         if not os.path.isdir(dir_path):
             os.makedirs(dir_path)
 
-        with open(output_file, 'w') as f:
-            f.write(template_string)
+        if 'paginate' in validated_params:
+            self._render_pages_to_files(validated_params['template_file'],
+                                        validated_params['template_data'], output_file,
+                                        validated_params['paginate'])
+        else:
+            self._render_to_file(validated_params['template_file'],
+                                 validated_params['template_data'], output_file)
 
         return {'path': output_file}
 
@@ -128,6 +403,160 @@ class TemplateUtil:
         params['output_file'] = os.path.join(self.config['scratch'], str(uuid4()) + '.txt')
         return self.render_template_to_file(params)
 
+    def render_template_to_scratch_dir(self, params, file_name):
+        """ Render a template into a new directory in scratch, as file_name
+
+        wrapper around render_template_to_file for templates whose output is uploaded as a
+        directory, e.g. paginated templates, which write each page to the same directory
+
+        :return:
+        { 'path': '/path/to/new_dir' }
+
+        """
+        output_dir = os.path.join(self.config['scratch'], str(uuid4()))
+        params['output_file'] = os.path.join(output_dir, file_name)
+        self.render_template_to_file(params)
+        return {'path': output_dir}
+
+    def template_stamps(self, params):
+        """ [path, mtime_ns, size] for the files that a template's output depends on
+
+        The template file is looked for as TT looks for it: relative to the working directory
+        and in each INCLUDE_PATH directory, or as given if it is absolute. A template_data_file
+        is included too. Templates loaded by the template are not, as they are only known once
+        it has been rendered.
+
+        :param params:  (dict)  template params, as for render_template_to_file
+        """
+        template_file = params['template_file']
+        paths = [os.path.abspath(template_file)]
+        if not os.path.isabs(template_file):
+            paths += [os.path.join(dir_path, template_file)
+                      for dir_path in include_paths(self._tt_config())]
+        if params.get('template_data_file'):
+            paths.append(params['template_data_file'])
+        return dependency_stamps(paths)
+
+    def _render_to_file(self, template_file, template_data, output_file):
+        """ Render a template to a file, streaming the output and using the render cache if
+        they are turned on """
+
+        uc_tt_config = self._tt_config()
+        backend = self._template_backend(template_file)
+        if self.config['template-stream-output'] and backend.can_stream(uc_tt_config):
+            cache_key = self._render_cache_key(template_file, template_data, uc_tt_config,
+                                               backend)
+            if cache_key and self._render_cache.get_to_file(cache_key, output_file):
+                return
+
+            with recording_dependencies() as dependencies:
+                self._stream_template_to_file(template_file, template_data, output_file)
+            if cache_key:
+                self._render_cache.add_file(cache_key, dependencies, output_file)
+            return
+
+        template_string = self._render_template(template_file, template_data)
+
+        with open(output_file, 'w') as f:
+            f.write(template_string)
+
+    def _render_pages_to_files(self, template_file, template_data, output_file, paginate):
+        """ Render a template once for each page of a list in the data
+
+        The list template_data[paginate['data_key']] is split into pages of paginate['page_size']
+        items. Each page is rendered with that key set to the items on the page, and with the
+        variable `pagination`, which holds:
+
+            page:       # page number, starting at 1
+            pages:      # number of pages
+            page_size:  # items per page
+            total:      # number of items in the whole list
+            first:      # position in the whole list of the first item on the page, from 1
+            last:       # position in the whole list of the last item on the page
+            files:      # file names of all the pages, in order
+            prev:       # file name of the previous page, or None
+            next:       # file name of the next page, or None
+
+        The first page is written to output_file, and page N to <name>_N<ext> in the same
+        directory. Pages are rendered across the 'template-render-workers' processes, if set;
+        if any page fails, the pages already written are removed and the first error is raised.
+
+        """
+        items = template_data[paginate['data_key']]
+        page_size = paginate['page_size']
+        n_pages = max(1, -(-len(items) // page_size))
+
+        (dir_path, file_name) = os.path.split(output_file)
+        (stem, ext) = os.path.splitext(file_name)
+        files = [file_name] + [f'{stem}_{n}{ext}' for n in range(2, n_pages + 1)]
+
+        arg_list = []
+        for n in range(n_pages):
+            page_items = items[n * page_size:(n + 1) * page_size]
+            page_data = {
+                **template_data,
+                paginate['data_key']: page_items,
+                'pagination': {
+                    'page': n + 1,
+                    'pages': n_pages,
+                    'page_size': page_size,
+                    'total': len(items),
+                    'first': n * page_size + 1 if page_items else 0,
+                    'last': n * page_size + len(page_items),
+                    'files': files,
+                    'prev': files[n - 1] if n > 0 else None,
+                    'next': files[n + 1] if n + 1 < n_pages else None,
+                },
+            }
+            arg_list.append((template_file, page_data, os.path.join(dir_path, files[n])))
+
+        if self.config['template-render-workers'] < 2 or n_pages < 2:
+            failures = []
+            for (idx, args) in enumerate(arg_list):
+                try:
+                    self._render_to_file(*args)
+                except Exception as err:
+                    failures.append((idx, err))
+                    break
+        else:
+            (_, failures) = self._run_in_pool(_render_to_file_in_worker, arg_list)
+
+        if failures:
+            for args in arg_list:
+                if os.path.exists(args[2]):
+                    os.remove(args[2])
+            raise failures[0][1]
+
+    def _stream_template_to_file(self, template_file, template_data, output_file):
+        """ Render a template, writing the output to a file as it is produced
+
+        Output from the main template goes straight to the file, in chunks of up to
+        _STREAM_BUFFER_SIZE; only the output of each INCLUDE or PROCESS directive is held in
+        memory. If rendering fails, the partly written file is removed.
+
+        :param template_file:   (string)  the template file to render
+        :param template_data:   (dict)    data to be rendered in the template
+        :param output_file:     (string)  path of the file to write
+
+        """
+        uc_tt_config = self._tt_config()
+        backend = self._template_backend(template_file)
+        try:
+            with open(output_file, 'w', buffering=_STREAM_BUFFER_SIZE) as fh:
+                output = StreamingOutput(fh, trim=bool(uc_tt_config.get('TRIM')))
+                with self._profiled(template_file):
+                    # raises a TemplateException if there is an issue anywhere
+                    remainder = backend.stream(template_file, template_data, output,
+                                               uc_tt_config)
+                # nothing is left over unless the main template could not be streamed
+                if remainder:
+                    fh.write(remainder)
+                output.close()
+        except Exception:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+
     def _render_template(self, template_file, template_data={}, template_config=None):
         """ Render template_name using template_data
 
@@ -139,10 +568,321 @@ class TemplateUtil:
         template_string (string)   the rendered template
 
         """
-        if template_config and template_config.items() > 0:
-            self._init_template_engine(template_config)
+        uc_tt_config = self._tt_config(template_config)
+        backend = self._template_backend(template_file)
+        cache_key = self._render_cache_key(template_file, template_data, uc_tt_config, backend)
+        if cache_key:
+            template_string = self._render_cache.get(cache_key)
+            if template_string is not None:
+                return template_string
 
-        # raises a TemplateException if there is an issue anywhere
-        template_string = self.template_engine().process(template_file, template_data)
+        with recording_dependencies() as dependencies, self._profiled(template_file):
+            # raises a TemplateException if there is an issue anywhere
+            template_string = backend.render(template_file, template_data, uc_tt_config)
+
+        if cache_key:
+            self._render_cache.add(cache_key, dependencies, template_string)
 
         return template_string
+
+
+def _can_stream(uc_tt_config):
+    """ Whether the main template's output is all the output, so it can be streamed """
+    return not any(uc_tt_config.get(key) for key in _NON_STREAMING_OPTIONS)
+
+
+@contextmanager
+def _collecting_profiles():
+    profiles = []
+    previous = getattr(_profiling, 'profiles', None)
+    _profiling.profiles = profiles
+    try:
+        yield profiles
+    finally:
+        _profiling.profiles = previous
+
+
+def _add_profiles(profiles):
+    """ Add render profiles to those being collected in this thread, if any """
+    collected = getattr(_profiling, 'profiles', None)
+    if collected is not None:
+        collected.extend(profiles)
+
+
+def _init_render_worker(config):
+    """ Set up the TemplateUtil for a render_template_list_to_files worker process """
+    global _worker_templater
+    _worker_templater = TemplateUtil({**config, 'template-render-workers': 0})
+
+
+def _call_in_worker(func, *args):
+    """ Call a worker function, returning its output along with any render profiles """
+    with _collecting_profiles() as profiles:
+        output = func(*args)
+    return (output, profiles)
+
+
+def _render_template_to_file_in_worker(params):
+    return _worker_templater.render_template_to_file(params)
+
+
+def _render_to_file_in_worker(template_file, template_data, output_file):
+    return _worker_templater._render_to_file(template_file, template_data, output_file)
+
+
+class TTBackend(TemplateBackend):
+    """ Template Toolkit templates, rendered with engines from a TemplateEnginePool """
+
+    name = 'tt'
+
+    def __init__(self, engines):
+        """
+        :param engines: (TemplateEnginePool)  engines to render with
+        """
+        self.engines = engines
+
+    def render(self, template_file, template_data, uc_tt_config):
+        with self.engines.checkout(uc_tt_config) as engine:
+            return engine.process(template_file, template_data)
+
+    def can_stream(self, uc_tt_config):
+        return _can_stream(uc_tt_config)
+
+    def stream(self, template_file, template_data, output, uc_tt_config):
+        # the main template's output buffer is swapped for `output` (see _template_buffer)
+        with self.engines.checkout(uc_tt_config) as engine:
+            document = engine.context().template(template_file)
+            _streaming.output = output
+            try:
+                with _streaming_buffer(document):
+                    return engine.process(document, template_data)
+            finally:
+                _streaming.output = None
+
+    def compile(self, template_file, uc_tt_config):
+        with self.engines.checkout(uc_tt_config) as engine:
+            engine.context().template(template_file)
+
+
+class StreamingOutput:
+    """ Output buffer for a compiled template that writes to a file instead of memory
+
+    Stands in for the StringBuffer that the template's main block writes its output to, and
+    takes the output of Jinja2 templates as it is generated. As the output has already gone to
+    the file, get() returns an empty string; TT's TRIM option is applied here instead, by
+    dropping leading whitespace and holding back trailing whitespace.
+    (Unlike TT, this also trims the output of a template that ends with a STOP directive.)
+    """
+
+    def __init__(self, fh, trim=False):
+        """
+        :param fh:      (file)  text file to write to
+        :param trim:    (bool)  remove leading and trailing whitespace from the output
+        """
+        self.fh = fh
+        self.trim = trim
+        self._started = False
+        self._whitespace = ''
+
+    def write(self, *args):
+        for arg in args:
+            text = str(arg)
+            if not self.trim:
+                self.fh.write(text)
+                continue
+            if not self._started:
+                text = text.lstrip()
+                if not text:
+                    continue
+                self._started = True
+            content = text.rstrip()
+            if content:
+                self.fh.write(self._whitespace + content)
+                self._whitespace = ''
+            self._whitespace += text[len(content):]
+
+    def get(self):
+        return ''
+
+    def clear(self):
+        # what has been written stays written; TT only clears a buffer to rewrite it with
+        # the old contents plus more (see TemplateException.text)
+        pass
+
+    def reset(self, *args):
+        self.write(*args)
+
+    def close(self):
+        if not self.trim:
+            self.fh.write(self._whitespace)
+        self._whitespace = ''
+
+
+def _template_buffer(*args):
+    """ Buffer() for compiled templates
+
+    While a template is being streamed to a file, the first buffer made in this thread is the
+    output buffer of the main template, so it is swapped for the StreamingOutput.
+    """
+    output = getattr(_streaming, 'output', None)
+    if output is None:
+        return StringBuffer(*args)
+    _streaming.output = None
+    output.write(*args)
+    return output
+
+
+@contextmanager
+def _streaming_buffer(document):
+    """ Make a compiled template create its buffers with _template_buffer while it is streamed
+
+    Buffer is a global of the template's compiled code, so it is only swapped while a render is
+    streaming the template, and put back once the last such render has finished. Other renders
+    of the template in the meantime get a StringBuffer from _template_buffer, as usual.
+    """
+    if not isinstance(document, Document):
+        yield
+        return
+    block_globals = document.block().__globals__
+    key = id(block_globals)
+    with _streamed_documents_lock:
+        if key not in _streamed_documents:
+            _streamed_documents[key] = [block_globals['Buffer'], 0]
+            block_globals['Buffer'] = _template_buffer
+        _streamed_documents[key][1] += 1
+    try:
+        yield
+    finally:
+        with _streamed_documents_lock:
+            _streamed_documents[key][1] -= 1
+            if not _streamed_documents[key][1]:
+                block_globals['Buffer'] = _streamed_documents.pop(key)[0]
+
+
+class ProfilingContext(Context):
+    """ Template Toolkit context that times each template and block it processes
+
+    Everything processed by the context goes through process(): the main template, and any
+    template or BLOCK used by INCLUDE, PROCESS, WRAPPER, PRE_PROCESS and the like. Time spent in
+    loops and other directives counts towards the template or block they are in.
+    """
+
+    def process(self, template, params=None, localize=False):
+        profile = getattr(_profiling, 'current', None)
+        if profile is None:
+            return super().process(template, params, localize)
+
+        profile.enter(_component_name(template))
+        try:
+            return super().process(template, params, localize)
+        finally:
+            profile.leave()
+
+
+def _component_name(template):
+    """ Name of a template (or list of templates) passed to Context.process """
+    if isinstance(template, (list, tuple)):
+        return '+'.join(_component_name(t) for t in template)
+    if isinstance(template, str):
+        return template
+    return getattr(template, 'name', None) or getattr(template, '__name__', repr(template))
+
+
+class TemplateEnginePool:
+    """ Template engines that can be used by several threads at once
+
+    A TT engine keeps the state of the template it is processing, so each render checks out an
+    engine of its own. Engines are returned to the pool afterwards and kept, along with the
+    templates they have compiled, for the next render with the same config; the pool grows to
+    the number of renders that have run at once for each config.
+    """
+
+    def __init__(self, new_engine):
+        """
+        :param new_engine:  (callable)  creates an engine from a TT config with upper case keys
+        """
+        self._new_engine = new_engine
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, uc_tt_config):
+        """ Use an engine for a TT config (with upper case keys), creating one if none is idle """
+        key = tt_config_digest(uc_tt_config)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            engine = idle.pop() if idle else None
+        if engine is None:
+            engine = self._new_engine(uc_tt_config)
+        try:
+            yield engine
+        finally:
+            with self._lock:
+                self._idle[key].append(engine)
+
+    def size(self, uc_tt_config=None):
+        """ Number of idle engines, for a TT config or in total """
+        with self._lock:
+            if uc_tt_config is not None:
+                return len(self._idle.get(tt_config_digest(uc_tt_config), []))
+            return sum(len(engines) for engines in self._idle.values())
+
+
+def tt_config_digest(uc_tt_config):
+    """ Short digest identifying a TT config, used to keep compiled templates apart """
+    config_json = json.dumps(uc_tt_config, sort_keys=True, default=str)
+    return hashlib.sha256(config_json.encode('utf-8')).hexdigest()[:16]
+
+
+class TemplateCacheProvider(Provider):
+    """ Template Toolkit provider with a compiled template cache on disk
+
+    The template files it loads are recorded for the rendered output cache.
+
+    Compiled templates are saved under a name derived from the resolved path, modification time
+    and size of the template file, so a template (or any template it includes) that has changed
+    is never served from the cache. The directory can be shared by several processes, as TT
+    writes each compiled template to a temporary file and renames it into place.
+    """
+
+    def __init__(self, params, cache_dir=None):
+        """
+        :param params:      (dict)    TT config, with the keys in upper case
+        :param cache_dir:   (string)  directory for compiled templates; if None, the TT
+                                      COMPILE_DIR and COMPILE_EXT settings apply as usual
+        """
+        super().__init__(params)
+        self.cache_dir = cache_dir
+
+    def _fetch(self, name, t_name=None):
+        # every path looked at is a dependency of the render, found or not: a template
+        # that appears earlier in the INCLUDE_PATH changes the output too
+        record_dependency(name)
+        return super()._fetch(name, t_name)
+
+    def _compiled_filename(self, path):
+        if not self.cache_dir:
+            return super()._compiled_filename(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = '\0'.join([os.path.realpath(path), str(st.st_mtime_ns), str(st.st_size)])
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.py')
+
+    def _compile(self, data, compfile=None):
+        # templates that change while they are in the memory cache are recompiled without a
+        # compiled file name; use the disk cache for those too
+        if self.cache_dir and data is not None and compfile is None:
+            compfile = self._compiled_filename(data.path)
+            if compfile and os.path.isfile(compfile):
+                data.data = self._load_compiled(compfile)
+                return data
+        return super()._compile(data, compfile)
+
+    def _compiled_is_current(self, template_name):
+        if not self.cache_dir:
+            return super()._compiled_is_current(template_name)
+        # the file name changes whenever the template does
+        compiled_name = self._compiled_filename(template_name)
+        return bool(compiled_name) and os.path.isfile(compiled_name)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+""" Index of previously uploaded content, used to avoid sending the same bytes to shock twice """
+
+# read files in 4 MB chunks when hashing
+_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def file_digest(path):
+    """ sha256 hex digest of the contents of a file """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def dir_digest(path, file_digests=None):
+    """
+    sha256 hex digest of a directory tree
+    Covers the relative path and contents of every file, so renames and moves are detected.
+    :param file_digests: (dict)  output of dir_file_digests for `path`, if already known
+    """
+    if file_digests is None:
+        file_digests = dir_file_digests(path)
+    sha = hashlib.sha256()
+    for (rel_path, digest) in sorted(file_digests.items()):
+        sha.update(rel_path.encode('utf-8') + b'\0' + digest.encode('ascii') + b'\n')
+    return sha.hexdigest()
+
+
+def dir_file_digests(path):
+    """ map of relative path to file_digest for every file under a directory """
+    digests = {}
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            full_path = os.path.join(root, name)
+            digests[os.path.relpath(full_path, path)] = file_digest(full_path)
+    return digests
+
+
+def content_digest(path, pack=None, name=None, file_digests=None):
+    """
+    Cache key for uploading `path` to shock
+    :param path:    (string)  file or directory to upload
+    :param pack:    (string)  DataFileUtil 'pack' setting used for the upload
+    :param name:    (string)  file name that will be visible on the shock node (optional)
+    :param file_digests: (dict)  output of dir_file_digests for `path`, if already known
+    """
+    if os.path.isdir(path):
+        digest = dir_digest(path, file_digests)
+    else:
+        digest = file_digest(path)
+    key = json.dumps([digest, pack, name])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class UploadCache:
+
+    def __init__(self, cache_dir, max_entries=10000, max_age_days=30, max_manifests=0):
+        """
+        :param cache_dir:     (string)  directory to keep the index database in
+        :param max_entries:   (int)     number of entries to keep; least recently used go first
+        :param max_age_days:  (int)     entries not used for this long are discarded
+        :param max_manifests: (int)     number of directory manifests (and their archives)
+                                        to keep; 0 turns manifests off
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, 'upload_cache.sqlite')
+        self.archive_dir = os.path.join(cache_dir, 'archives')
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.max_manifests = max_manifests
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS upload ('
+                '  digest TEXT PRIMARY KEY,'
+                '  shock_id TEXT NOT NULL,'
+                '  handle TEXT,'
+                '  created REAL NOT NULL,'
+                '  last_used REAL NOT NULL'
+                ')'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS manifest ('
+                '  dir_path TEXT PRIMARY KEY,'
+                '  files TEXT NOT NULL,'
+                '  archive TEXT,'
+                '  shock_id TEXT NOT NULL,'
+                '  last_used REAL NOT NULL'
+                ')'
+            )
+
+    @contextmanager
+    def _connect(self):
+        """ Open a connection and run the enclosed statements as one transaction """
+        # a fresh connection per operation keeps the cache safe to use across threads,
+        # and sqlite's own locking covers separate worker processes
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, digest):
+        """ Return the cached {'shock_id': ..., 'handle': ...} for a digest, or None """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT shock_id, handle, last_used FROM upload WHERE digest = ?', (digest,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[2] < now - self.max_age:
+                conn.execute('DELETE FROM upload WHERE digest = ?', (digest,))
+                return None
+            conn.execute('UPDATE upload SET last_used = ? WHERE digest = ?', (now, digest))
+        return {'shock_id': row[0], 'handle': json.loads(row[1]) if row[1] else None}
+
+    def add(self, digest, shock):
+        """ Record the shock node (output of file_to_shock) holding the content for a digest """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO upload (digest, shock_id, handle, created, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (digest, shock['shock_id'], json.dumps(shock.get('handle')), now, now)
+            )
+            self._evict(conn, now)
+
+    def discard(self, digest):
+        """ Remove a stale entry, e.g. one whose shock node can no longer be fetched """
+        with self._connect() as conn:
+            conn.execute('DELETE FROM upload WHERE digest = ?', (digest,))
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM upload WHERE last_used < ?', (now - self.max_age,))
+        conn.execute(
+            'DELETE FROM upload WHERE digest NOT IN '
+            '(SELECT digest FROM upload ORDER BY last_used DESC LIMIT ?)',
+            (self.max_entries,)
+        )
+
+    def get_manifest(self, dir_path):
+        """
+        Return the manifest recorded for the last upload of a directory, or None
+        The manifest has keys 'files' (relative path => file digest), 'shock_id' and 'archive',
+        the path to a copy of the uploaded zip archive (or None if there is no copy).
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT files, archive, shock_id FROM manifest WHERE dir_path = ?', (dir_path,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE manifest SET last_used = ? WHERE dir_path = ?',
+                         (time.time(), dir_path))
+        return {'files': json.loads(row[0]), 'archive': row[1], 'shock_id': row[2]}
+
+    def add_manifest(self, dir_path, files, shock, archive=None):
+        """
+        Record the files in a directory that has just been uploaded
+        :param dir_path:  (string)  the directory
+        :param files:     (dict)    relative path => file digest
+        :param shock:     (dict)    output of file_to_shock for the upload
+        :param archive:   (string)  zip archive that was uploaded; it is moved into the cache
+        """
+        kept_archive = None
+        if archive:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            kept_archive = os.path.join(self.archive_dir, uuid4().hex + '.zip')
+            shutil.move(archive, kept_archive)
+
+        with self._connect() as conn:
+            old = conn.execute(
+                'SELECT archive FROM manifest WHERE dir_path = ?', (dir_path,)
+            ).fetchone()
+            conn.execute(
+                'INSERT OR REPLACE INTO manifest (dir_path, files, archive, shock_id, last_used) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (dir_path, json.dumps(files), kept_archive, shock['shock_id'], time.time())
+            )
+            evicted = conn.execute(
+                'SELECT dir_path, archive FROM manifest ORDER BY last_used DESC '
+                'LIMIT -1 OFFSET ?', (self.max_manifests,)
+            ).fetchall()
+            conn.executemany('DELETE FROM manifest WHERE dir_path = ?',
+                             [(row[0],) for row in evicted])
+
+        self._remove_archives([old] + evicted)
+
+    def discard_manifest(self, dir_path):
+        """ Remove the manifest for a directory, e.g. if its shock node can no longer be used """
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT dir_path, archive FROM manifest WHERE dir_path = ?', (dir_path,)
+            ).fetchone()
+            conn.execute('DELETE FROM manifest WHERE dir_path = ?', (dir_path,))
+        self._remove_archives([row])
+
+    def _remove_archives(self, rows):
+        # anything still reading an archive has it open, so it can safely be unlinked
+        for row in rows:
+            if row and row[-1] and os.path.exists(row[-1]):
+                os.remove(row[-1])
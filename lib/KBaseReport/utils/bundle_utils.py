@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+import posixpath
+import re
+from urllib.parse import unquote
+from uuid import uuid4
+from .html_utils import GZIP_EXTENSIONS
+
+"""
+Utilities for bundling html_links directories that hold many small files into fewer files
+
+Two things are done, in a copy of the directory that is about to be zipped:
+
+  * Small images, style sheets and scripts are inlined into the pages that use them (as data:
+    URIs, <style> and <script> elements), and removed if nothing else refers to them.
+  * Pages that are alike, such as one page per gene, are merged into bundles of up to
+    page_size pages. Each page becomes a <div> in the bundle, with an id made from its file
+    name, and links to it are rewritten to point to bundle_N.html#<id>; a browser that supports
+    :has() shows only the linked page.
+
+Both are conservative. Pages are only alike if they are in the same directory and have the
+same <head> (apart from the <title>), and are only bundled if their <body> has no scripts,
+forms or element ids, every mention of their file name in the directory is a link that can be
+rewritten, and at least one page links to them. Links built by scripts, e.g.
+'gene_' + id + '.html', cannot be rewritten, so bundling must be turned on for each app.
+"""
+
+# a directory needs at least this many alike pages for them to be bundled
+MIN_BUNDLE_PAGES = 20
+
+# pages bigger than this are never bundled
+_MAX_PAGE_SIZE = 256 * 1024
+
+_IMAGE_TYPES = {
+    '.gif': 'image/gif', '.ico': 'image/x-icon', '.jpeg': 'image/jpeg', '.jpg': 'image/jpeg',
+    '.png': 'image/png', '.svg': 'image/svg+xml', '.webp': 'image/webp',
+}
+_HTML_EXTENSIONS = ('.htm', '.html')
+# files that are searched for mentions of the files being inlined or bundled
+_TEXT_EXTENSIONS = tuple(sorted(GZIP_EXTENSIONS))
+_JS_TYPES = {'application/javascript', 'text/ecmascript', 'text/javascript'}
+
+_PAGE = re.compile(
+    r'(?P<prefix>.*?<head\b[^>]*>)(?P<head>.*?)(?P<middle></head\s*>\s*<body\b[^>]*>)'
+    r'(?P<body>.*)(?P<suffix></body\s*>.*)',
+    re.I | re.S
+)
+_TITLE = re.compile(r'<title\b[^>]*>.*?</title\s*>', re.I | re.S)
+# page contents that would not work the same once merged with other pages
+_UNBUNDLABLE = re.compile(r'<(?:script|form|base|frameset)\b|\s(?:id|name)\s*=', re.I)
+
+_ATTRS = r'((?:"[^"]*"|\'[^\']*\'|[^\'">])*)'
+_IMG = re.compile(r'<img\b' + _ATTRS + '>', re.I)
+_STYLESHEET = re.compile(r'<link\b' + _ATTRS + '>', re.I)
+_SCRIPT = re.compile(r'<script\b' + _ATTRS + r'>\s*</script\s*>', re.I)
+_ATTR = re.compile(r'([^\s=/>"\']+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s"\'>]+))?')
+_URL_ATTR = re.compile(r'(\s(?:href|src)\s*=\s*)("[^"]*"|\'[^\']*\')', re.I)
+_SCHEME = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+_NAME_TOKEN = re.compile(r'[^\s"\'<>()=,;:/\\#?&`]+')
+
+_BUNDLE_STYLE = ('<style>body:has(> .kbr-bundle-page:target) > .kbr-bundle-page:not(:target)'
+                 '{display:none}</style>')
+
+
+def bundle_dir(root, index_name=None, inline_size=4096, page_size=500):
+    """ Inline small assets and bundle alike pages in a directory, in place
+
+    Files are never written to in place: changed files are replaced, so a file that is a hard
+    link to one outside the directory is not affected.
+
+    :param root:        (string)  the directory
+    :param index_name:  (string)  the report's main page, which is never bundled
+    :param inline_size: (int)     images, style sheets and scripts up to this many bytes are
+                                  inlined; 0 turns inlining off
+    :param page_size:   (int)     number of pages in each bundle; 0 or 1 turns bundling off
+
+    :return:
+    {
+        'inlined': 40,      # references to assets replaced by their contents
+        'bundled': 5000,    # pages merged into bundles
+        'bundles': 10,      # bundles written
+        'removed': 5003,    # files removed (bundled pages, and inlined assets)
+    }
+    """
+    scan = _scan(root, index_name, inline_size, page_size)
+    fragments = _plan_bundles(root, scan, page_size)
+
+    # inlined assets are removed if every mention of them was inlined
+    removable_assets = {path for path in scan['inlinable']
+                        if scan['inline_refs'].get(path) and
+                        scan['mentions'].get(posixpath.basename(path), 0) ==
+                        scan['inline_refs_by_name'].get(posixpath.basename(path), 0)}
+
+    stats = {'inlined': 0, 'bundled': len(fragments), 'bundles': 0, 'removed': 0}
+    rewriter = _Rewriter(scan['inlinable'], fragments, stats)
+    bundles = {}
+    for (page, (bundle, fragment_id)) in sorted(fragments.items()):
+        bundles.setdefault(bundle, []).append((page, fragment_id))
+    for (bundle, pages) in sorted(bundles.items()):
+        _write_bundle(root, bundle, pages, rewriter)
+        stats['bundles'] += 1
+    for page in scan['html']:
+        if page in fragments:
+            continue
+        text = _read(root, page)
+        rewritten = rewriter.rewrite(text, page)
+        if rewritten != text:
+            _replace(root, page, rewritten)
+
+    for path in sorted(set(fragments) | removable_assets):
+        os.remove(os.path.join(root, path))
+        stats['removed'] += 1
+    return stats
+
+
+def _scan(root, index_name, inline_size, page_size):
+    """ Find the files that could be inlined or bundled, and count the references to them """
+    files = {}
+    for (dir_path, dirs, names) in os.walk(root):
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(dir_path, name)
+            if os.path.isfile(path):
+                files[posixpath.relpath(path, root)] = os.path.getsize(path)
+
+    scan = {
+        'files': files,
+        'html': [path for path in files if path.lower().endswith(_HTML_EXTENSIONS)],
+        # mentions of each file name in any text file
+        'mentions': {},
+        # links to each page that can be rewritten
+        'link_refs': {},
+        # references to each asset that can be inlined
+        'inline_refs': {},
+        'inline_refs_by_name': {},
+        # assets small enough to inline, and their contents
+        'inlinable': {},
+        # pages that could be bundled, by directory and head
+        'groups': {},
+    }
+    names = {posixpath.basename(path) for path in files}
+    for path in files:
+        if not path.lower().endswith(_TEXT_EXTENSIONS):
+            continue
+        text = _read(root, path)
+        if text is None:
+            continue
+        for token in _NAME_TOKEN.findall(text):
+            if token in names:
+                scan['mentions'][token] = scan['mentions'].get(token, 0) + 1
+        if not path.lower().endswith(_HTML_EXTENSIONS):
+            continue
+
+        if inline_size:
+            for (target, kind) in _inline_targets(text, path):
+                content = _inlinable(root, target, kind, files, inline_size)
+                if content is None:
+                    continue
+                scan['inlinable'][target] = content
+                scan['inline_refs'][target] = scan['inline_refs'].get(target, 0) + 1
+                name = posixpath.basename(target)
+                scan['inline_refs_by_name'][name] = scan['inline_refs_by_name'].get(name, 0) + 1
+        for match in _URL_ATTR.finditer(text):
+            target = _resolve(path, match.group(2)[1:-1])
+            if target is not None and target in files:
+                scan['link_refs'][target] = scan['link_refs'].get(target, 0) + 1
+
+        if page_size > 1 and path != index_name and files[path] <= _MAX_PAGE_SIZE:
+            match = _PAGE.fullmatch(text)
+            if match and not _UNBUNDLABLE.search(match.group('body')):
+                key = (posixpath.dirname(path), ' '.join(
+                    (match.group('prefix') + _TITLE.sub('', match.group('head')) +
+                     match.group('middle') + match.group('suffix')).split()))
+                scan['groups'].setdefault(key, []).append(path)
+    return scan
+
+
+def _plan_bundles(root, scan, page_size):
+    """ Choose the pages to bundle
+    :return: dict of page path => (bundle path, id of the page in the bundle)
+    """
+    links_by_name = {}
+    for (path, count) in scan['link_refs'].items():
+        name = posixpath.basename(path)
+        links_by_name[name] = links_by_name.get(name, 0) + count
+
+    fragments = {}
+    taken = set(scan['files'])
+    for ((dir_path, _), pages) in sorted(scan['groups'].items(), key=lambda item: item[1][0]):
+        # every mention of the page must be a link that is rewritten
+        pages = [page for page in pages if scan['link_refs'].get(page) and
+                 scan['mentions'].get(posixpath.basename(page), 0) ==
+                 links_by_name[posixpath.basename(page)]]
+        if len(pages) < MIN_BUNDLE_PAGES:
+            continue
+        for start in range(0, len(pages), page_size):
+            bundle = _free_name(dir_path, taken)
+            ids = set()
+            for page in pages[start:start + page_size]:
+                fragments[page] = (bundle, _fragment_id(page, ids))
+    return fragments
+
+
+def _free_name(dir_path, taken):
+    n = 1
+    while posixpath.join(dir_path, f'bundle_{n}.html') in taken:
+        n += 1
+    bundle = posixpath.join(dir_path, f'bundle_{n}.html')
+    taken.add(bundle)
+    return bundle
+
+
+def _fragment_id(page, ids):
+    """ Unique id for a page in a bundle, made from its file name """
+    base = 'page-' + re.sub(r'[^A-Za-z0-9_-]', '_', posixpath.splitext(
+        posixpath.basename(page))[0])
+    fragment_id = base
+    n = 2
+    while fragment_id in ids:
+        fragment_id = f'{base}-{n}'
+        n += 1
+    ids.add(fragment_id)
+    return fragment_id
+
+
+def _inline_targets(text, page):
+    """ (path, kind) for each image, style sheet and script in a page that could be inlined """
+    for match in _IMG.finditer(text):
+        src = _attrs(match.group(1)).get('src')
+        if src:
+            yield (_resolve(page, src), 'image')
+    for match in _STYLESHEET.finditer(text):
+        href = _stylesheet_href(_attrs(match.group(1)))
+        if href:
+            yield (_resolve(page, href), 'css')
+    for match in _SCRIPT.finditer(text):
+        src = _script_src(_attrs(match.group(1)))
+        if src:
+            yield (_resolve(page, src), 'js')
+
+
+def _inlinable(root, target, kind, files, inline_size):
+    """ The contents to inline for an asset, or None if it cannot be inlined """
+    if target is None or files.get(target) is None or files[target] > inline_size:
+        return None
+    ext = posixpath.splitext(target)[1].lower()
+    if kind == 'image':
+        if ext not in _IMAGE_TYPES:
+            return None
+        with open(os.path.join(root, target), 'rb') as f:
+            data = base64.b64encode(f.read()).decode('ascii')
+        return f'data:{_IMAGE_TYPES[ext]};base64,{data}'
+
+    if ext != {'css': '.css', 'js': '.js'}[kind]:
+        return None
+    text = _read(root, target)
+    if text is None:
+        return None
+    # relative urls in a style sheet would be resolved against the page instead
+    if kind == 'css' and re.search(r'url\(|@import|</style', text, re.I):
+        return None
+    if kind == 'js' and re.search(r'</script', text, re.I):
+        return None
+    return text
+
+
+def _stylesheet_href(attrs):
+    if set(attrs) <= {'rel', 'href', 'type'} and attrs.get('rel', '').lower() == 'stylesheet':
+        return attrs.get('href')
+    return None
+
+
+def _script_src(attrs):
+    if set(attrs) <= {'src', 'type'} and attrs.get('type', 'text/javascript').lower() in _JS_TYPES:
+        return attrs.get('src')
+    return None
+
+
+def _attrs(text):
+    """ Attributes of a tag, with lower case names and unquoted values """
+    attrs = {}
+    for (name, value) in _ATTR.findall(text):
+        if value[:1] in ('"', "'"):
+            value = value[1:-1]
+        attrs[name.lower()] = value
+    return attrs
+
+
+def _resolve(page, url):
+    """ Path in the directory of a relative url in a page, or None for any other url """
+    if not url or url.startswith(('#', '/', '?')) or '?' in url or _SCHEME.match(url):
+        return None
+    path = unquote(url.split('#', 1)[0])
+    if not path:
+        return None
+    resolved = posixpath.normpath(posixpath.join(posixpath.dirname(page), path))
+    if resolved.startswith('../') or resolved == '..':
+        return None
+    return resolved
+
+
+class _Rewriter:
+    """ Inlines assets and points links at bundled pages """
+
+    def __init__(self, inlinable, fragments, stats):
+        self.inlinable = inlinable
+        self.fragments = fragments
+        self.stats = stats
+
+    def rewrite(self, text, page):
+        """
+        :param text:    (string)  HTML to rewrite
+        :param page:    (string)  path in the directory that relative urls are resolved against
+        """
+        if self.inlinable:
+            text = _IMG.sub(lambda m: self._image(m, page), text)
+            text = _STYLESHEET.sub(lambda m: self._stylesheet(m, page), text)
+            text = _SCRIPT.sub(lambda m: self._script(m, page), text)
+        if self.fragments:
+            text = _URL_ATTR.sub(lambda m: self._link(m, page), text)
+        return text
+
+    def _inline(self, page, url):
+        target = _resolve(page, url) if url else None
+        if target is None or target not in self.inlinable:
+            return None
+        self.stats['inlined'] += 1
+        return self.inlinable[target]
+
+    def _image(self, match, page):
+        content = self._inline(page, _attrs(match.group(1)).get('src'))
+        if content is None:
+            return match.group()
+        attrs = re.sub(r'(\ssrc\s*=\s*)("[^"]*"|\'[^\']*\'|[^\s"\'>]+)',
+                       lambda m: m.group(1) + '"' + content + '"', match.group(1),
+                       count=1, flags=re.I)
+        return '<img' + attrs + '>'
+
+    def _stylesheet(self, match, page):
+        content = self._inline(page, _stylesheet_href(_attrs(match.group(1))))
+        return match.group() if content is None else '<style>' + content + '</style>'
+
+    def _script(self, match, page):
+        content = self._inline(page, _script_src(_attrs(match.group(1))))
+        return match.group() if content is None else '<script>' + content + '</script>'
+
+    def _link(self, match, page):
+        (quote, url) = (match.group(2)[0], match.group(2)[1:-1])
+        target = _resolve(page, url)
+        if target not in self.fragments:
+            return match.group()
+        (bundle, fragment_id) = self.fragments[target]
+        new_url = posixpath.relpath(bundle, posixpath.dirname(page) or '.') + '#' + fragment_id
+        return match.group(1) + quote + new_url + quote
+
+
+def _write_bundle(root, bundle, pages, rewriter):
+    """ Write the pages [(path, id), ...] to a bundle, with the head of the first page """
+    parts = []
+    for (n, (page, fragment_id)) in enumerate(pages):
+        match = _PAGE.fullmatch(_read(root, page))
+        if n == 0:
+            (head, suffix) = (match.group('prefix') + match.group('head') + _BUNDLE_STYLE +
+                              match.group('middle'), match.group('suffix'))
+            parts.append(rewriter.rewrite(head, bundle))
+        parts.append(f'<div class="kbr-bundle-page" id="{fragment_id}">' +
+                     rewriter.rewrite(match.group('body'), page) + '</div>\n')
+    parts.append(suffix)
+    _replace(root, bundle, ''.join(parts))
+
+
+def _read(root, path):
+    try:
+        with open(os.path.join(root, path), 'r', encoding='utf-8', newline='') as f:
+            return f.read()
+    except UnicodeDecodeError:
+        return None
+
+
+def _replace(root, path, text):
+    """ Write a file as a new file, so that any other links to the old one keep its contents """
+    full_path = os.path.join(root, path)
+    tmp_path = os.path.join(os.path.dirname(full_path), f'.{uuid4().hex}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+    if os.path.exists(full_path):
+        os.chmod(tmp_path, os.stat(full_path).st_mode & 0o7777)
+    os.replace(tmp_path, full_path)
@@ -1,84 +1,811 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
+import random
 import shutil
+import tempfile
+import threading
+import time as _time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import requests as _requests
+from installed_clients.baseclient import ServerError as _DFUError
+from functools import partial
 from uuid import uuid4
+from .UploadCache import UploadCache, content_digest, dir_file_digests
+from .bundle_utils import bundle_dir
+from .html_utils import optimise_dir
+from .validation_utils import validate_upload_config
+from .zip_utils import zip_directory
+
+try:
+    import fcntl as _fcntl
+except ImportError:  # not available on Windows
+    _fcntl = None
 
 """
 Utilities for fetching/uploading files
 We use an instance of DataFileUtil here
 """
 
+# ioctl request for cloning a file on copy-on-write filesystems (linux/fs.h)
+_FICLONE = 0x40049409
+
+# transport errors that are worth retrying, along with HTTP 5xx responses (see _is_transient);
+# DataFileUtil's own errors and HTTP 4xx responses are not
+_TRANSIENT_ERRORS = (
+    _requests.exceptions.ConnectionError,
+    _requests.exceptions.Timeout,
+)
+
+
+class LinkUploadError(Exception):
+    """ One or more file_links or html_links entries could not be fetched or uploaded """
+
+    def __init__(self, failures):
+        """
+        :param failures: list of (link, exception) tuples, in input order
+        """
+        self.failures = failures
+        super().__init__("\n".join(
+            [f'{len(failures)} link(s) could not be fetched or uploaded:'] +
+            [f"  {link.get('name', '')}: {err}" for (link, err) in failures]
+        ))
+
+
+def fetch_or_upload_links(dfu, file_links, html_links, templater, config=None, timings=None,
+                          request_id=None):
+    """
+    Fetch by shock ID or upload the entries for both the `file_links` and `html_links`
+    parameters of an extended report, running all of the DataFileUtil calls concurrently
+    :param dfu: DataFileUtil client instance
+    :param file_links: list of file dictionaries for `file_links`
+    :param html_links: list of file dictionaries for `html_links`
+    :param templater: TemplateUtil instance
+    :param config: upload config (see validation_utils.validate_upload_config)
+    :param timings: if given, a list that the time spent on each link is appended to
+        (see _link_timings)
+    :param request_id: identifies the request for the upload journal (see _journal_key)
+    :return: tuple of (file_links, html_links) lists of file dictionaries that can be
+        uploaded to the workspace for the report, in the same order as the input
+    """
+    journal_key = _journal_key(file_links, html_links, request_id)
+    # templates are rendered up front, one at a time; the uploads are what we parallelise
+    tasks = [_prepare_file_link(templater, each_file) for each_file in file_links]
+    tasks += [_prepare_html_link(templater, each_file) for each_file in html_links]
+    out_files = _run_link_tasks(dfu, tasks, config, journal_key)
+    if timings is not None:
+        timings.extend(_link_timings(tasks))
+    return out_files[:len(file_links)], out_files[len(file_links):]
+
 
-def fetch_or_upload_file_links(dfu, files, templater):
+def fetch_or_upload_file_links(dfu, files, templater, config=None, timings=None,
+                               request_id=None):
     """
     Given a list of dictionaries of files for the `file_links` parameter in an extended_report
     Fetch by shock ID or upload the file or zipped directory
     :param dfu: DataFileUtil client instance
     :param templater: TemplateUtil instance
     :param files: list of file dictionaries (having the File type from the KIDL spec)
+    :param config: upload config (see validation_utils.validate_upload_config)
+    :param timings: if given, a list that the time spent on each link is appended to
+    :param request_id: identifies the request for the upload journal (see _journal_key)
     :return: list of file dictionaries that that can be uploaded to the workspace for the report
     """
-    out_files = []
-    for each_file in files:
-        if 'template' in each_file:
-            each_file = _render_template_add_path(templater, each_file)
-
-        if 'path' in each_file:
-            # Only zip if the path is a directory
-            isdir = os.path.isdir(each_file['path'])
-            shock = dfu.file_to_shock({
-                'file_path': each_file['path'],
-                'make_handle': 1,
-                'pack': 'zip' if isdir else None
-            })
-        elif 'shock_id' in each_file:
-            # Having a 'shock_id' means it is already uploaded
-            shock = dfu.own_shock_node({'shock_id': each_file['shock_id'], 'make_handle': 1})
-        out_files.append(_create_file_link(each_file, shock))
+    journal_key = _journal_key(files, [], request_id)
+    tasks = [_prepare_file_link(templater, each_file) for each_file in files]
+    out_files = _run_link_tasks(dfu, tasks, config, journal_key)
+    if timings is not None:
+        timings.extend(_link_timings(tasks))
     return out_files
 
 
-def fetch_or_upload_html_links(dfu, files, templater):
+def fetch_or_upload_html_links(dfu, files, templater, config=None, timings=None,
+                               request_id=None):
     """
     Given a list of dictionaries of files that each have either 'path' or 'shock_id'
     Fetch by shock ID or upload a zipped directory
     :param dfu: DataFileUtil client instance
     :param templater: TemplateUtil instance
     :param files: list of file dictionaries (having the File type from the KIDL spec)
+    :param config: upload config (see validation_utils.validate_upload_config)
+    :param timings: if given, a list that the time spent on each link is appended to
+    :param request_id: identifies the request for the upload journal (see _journal_key)
     :return: list of file dictionaries that that can be uploaded to the workspace for the report
     """
-    out_files = []
-    for each_file in files:
-        if 'template' in each_file:
+    journal_key = _journal_key([], files, request_id)
+    tasks = [_prepare_html_link(templater, each_file) for each_file in files]
+    out_files = _run_link_tasks(dfu, tasks, config, journal_key)
+    if timings is not None:
+        timings.extend(_link_timings(tasks))
+    return out_files
+
+
+def _prepare_file_link(templater, each_file):
+    """
+    Work out which DataFileUtil call is needed for a `file_links` entry
+    :return: task dictionary with the file dictionary, DataFileUtil method name and params
+    """
+    timings = {}
+    with _timed(timings, 'stat'):
+        stamp = _link_stamp(each_file, templater)
+    if 'template' in each_file:
+        with _timed(timings, 'render'):
+            each_file = _render_template_add_path(templater, each_file)
+
+    if 'path' in each_file:
+        # Only zip if the path is a directory
+        isdir = os.path.isdir(each_file['path'])
+        return _link_task(each_file, 'file', 'file_to_shock', {
+            'file_path': each_file['path'],
+            'make_handle': 1,
+            'pack': 'zip' if isdir else None
+        }, stamp, timings)
+    # Having a 'shock_id' means it is already uploaded
+    return _link_task(each_file, 'file', 'own_shock_node', {
+        'shock_id': each_file['shock_id'],
+        'make_handle': 1
+    }, timings=timings)
+
+
+def _prepare_html_link(templater, each_file):
+    """
+    Work out which DataFileUtil call is needed for an `html_links` entry
+    :return: task dictionary with the file dictionary, DataFileUtil method name and params
+    """
+    timings = {}
+    with _timed(timings, 'stat'):
+        stamp = _link_stamp(each_file, templater)
+    if 'template' in each_file:
+        with _timed(timings, 'render'):
             each_file = _render_template_add_path(templater, each_file)
 
-        if 'path' in each_file:
-            # Having a 'path' key means we have to upload to shock
-            if os.path.isfile(each_file['path']):
-                # If it is not a directory, we have to move it into one before zipping
-                new_dir = os.path.join(os.path.dirname(each_file['path']), str(uuid4()))
-                os.makedirs(new_dir)
-                os.chmod(new_dir, 0o775)
-                # Move the file to dir/name
-                new_path = os.path.join(new_dir, each_file['name'])
-                shutil.copy2(each_file['path'], new_path)
-                each_file['path'] = new_dir
-            shock = dfu.file_to_shock({
-                'file_path': each_file['path'],
+    if 'path' in each_file:
+        # Having a 'path' key means we have to upload to shock
+        if os.path.isfile(each_file['path']):
+            # If it is not a directory, we have to move it into one before zipping
+            new_dir = os.path.join(os.path.dirname(each_file['path']), str(uuid4()))
+            os.makedirs(new_dir)
+            os.chmod(new_dir, 0o775)
+            # Put the file in dir/name without copying it if we can
+            new_path = os.path.join(new_dir, each_file['name'])
+            _link_or_copy(each_file['path'], new_path)
+            each_file['path'] = new_dir
+            task = _link_task(each_file, 'html', 'file_to_shock', {
+                'file_path': new_dir,
                 'make_handle': 1,
-                'pack': 'zip'  # Always zip for HTML
-            })
+                'pack': 'zip'
+            }, stamp, timings)
+            # the directory is only needed until the upload is done
+            task['staging_dir'] = new_dir
+            return task
+        return _link_task(each_file, 'html', 'file_to_shock', {
+            'file_path': each_file['path'],
+            'make_handle': 1,
+            'pack': 'zip'  # Always zip for HTML
+        }, stamp, timings)
+    # Having a 'shock_id' means it is already uploaded
+    return _link_task(each_file, 'html', 'own_shock_node', {
+        'shock_id': each_file['shock_id'],
+        'make_handle': 1
+    }, timings=timings)
+
+
+def _link_task(each_file, kind, method, method_params, stamp=None, timings=None):
+    """
+    :param each_file: file dictionary from the report params
+    :param kind: 'file' or 'html'
+    :param method: DataFileUtil method to call
+    :param method_params: params for the DataFileUtil method
+    :param stamp: size and modification time of the link's path (see _link_stamp)
+    :param timings: seconds spent so far on each stage of handling the link (see _timed)
+    """
+    return {'link': each_file, 'kind': kind, 'method': method, 'params': method_params,
+            'stamp': stamp, 'timings': timings if timings is not None else {}}
+
+
+def _run_link_tasks(dfu, tasks, config=None, journal_key=None):
+    """
+    Run the DataFileUtil calls for a list of prepared links in a bounded thread pool
+    Calls are scheduled largest first, with a cap on the bytes in flight (see _run_scheduled).
+    Uploads that do not need packing are grouped into DataFileUtil.file_to_shock_mass calls
+    of up to 'upload-batch-size' files; everything else gets a call of its own. Each shock
+    node referenced by the links is only owned once, however many links point to it.
+    If 'html-minify', 'html-gzip' or 'html-bundle' is set, html_links directories are first
+    copied to a staging directory with their files minified, gzipped or bundled (see
+    _optimise_html_links).
+    If the upload cache is enabled, content that has been uploaded before is not sent again,
+    and html_links directories that were uploaded before are packed incrementally.
+    Calls that fail with a transient error are retried. If the request has an id, completed
+    calls are recorded in a journal in scratch, so if the request fails and is retried with the
+    same id and links, only the links that did not complete (or have changed) are uploaded
+    again.
+    :param dfu: DataFileUtil client instance
+    :param tasks: list of task dictionaries (see _link_task)
+    :param config: upload config; 'upload-concurrency' sets the number of worker threads
+    :param journal_key: identifies the request for the journal (see _journal_key; optional)
+    :return: list of file dictionaries in the same order as `tasks`
+    """
+    config = validate_upload_config(config or {})
+    batch_size = config['upload-batch-size']
+    dfu = _RetryingClient(dfu, config)
+    journal = None
+    if journal_key and config.get('scratch'):
+        journal = _UploadJournal(os.path.join(config['scratch'], 'upload_journal',
+                                              journal_key + '.jsonl'))
+        for (idx, shock) in journal.completed(tasks).items():
+            tasks[idx]['journaled'] = shock
+    todo = [(idx, task) for (idx, task) in enumerate(tasks) if not task.get('journaled')]
+    if config['html-minify'] or config['html-gzip'] or config['html-bundle']:
+        _optimise_html_links([task for (idx, task) in todo if task['kind'] == 'html' and
+                              task['method'] == 'file_to_shock'], config)
+    cache = _get_upload_cache(config)
+    if cache:
+        _find_cached_uploads(cache, [task for (idx, task) in todo], config)
+
+    # links to the same shock node share a single own_shock_node call; with no data to send,
+    # these have size 0, so they are scheduled last, filling threads left free by the uploads
+    owner = _ShockNodeOwner(dfu)
+    own_batches = {}
+    for (idx, task) in todo:
+        if task['method'] == 'own_shock_node':
+            own_batches.setdefault(task['params']['shock_id'], []).append(idx)
+    batches = list(own_batches.values())
+
+    batchable = [idx for (idx, task) in todo
+                 if task['method'] == 'file_to_shock' and not task['params'].get('pack') and
+                 not task.get('cached')]
+    batches += [batchable[i:i + batch_size] for i in range(0, len(batchable), batch_size)]
+    batched = set(batchable)
+    batches += [[idx] for (idx, task) in todo
+                if task['method'] == 'file_to_shock' and idx not in batched]
+
+    # directories are zipped here rather than by DataFileUtil if 'zip-workers' is set;
+    # all the directories in the request share one pool of compression threads
+    packer = None
+    if config['zip-workers'] and any(task['params'].get('pack') == 'zip' for task in tasks):
+        packer = ThreadPoolExecutor(max_workers=config['zip-workers'])
+
+    def pack_dir(path, reuse_from=None, unchanged=()):
+        staging_dir = tempfile.mkdtemp(dir=config.get('scratch') or os.path.dirname(path))
+        zip_path = os.path.join(staging_dir, os.path.basename(os.path.normpath(path)) + '.zip')
+        return zip_directory(path, zip_path, packer, config['zip-workers'],
+                             reuse_from=reuse_from, unchanged=unchanged)
+
+    def run_batch(batch):
+        task = tasks[batch[0]]
+        # a call made for several links counts in full towards each of them
+        batch_timings = [tasks[idx]['timings'] for idx in batch]
+        if task['method'] == 'own_shock_node':
+            with _timed(batch_timings, 'own'):
+                shocks = [owner.own(task['params']['shock_id'])] * len(batch)
+        elif len(batch) == 1:
+            shocks = [_run_task(dfu, task, owner, cache, pack_dir if packer else None)]
+        else:
+            with _timed(batch_timings, 'upload'):
+                shocks = dfu.file_to_shock_mass([tasks[idx]['params'] for idx in batch])
+        if journal:
+            journal.record([(idx, tasks[idx].get('stamp')) for idx in batch], shocks)
+        return shocks
 
-        elif 'shock_id' in each_file:
-            # Having a 'shock_id' means it is already uploaded
-            shock = dfu.own_shock_node({'shock_id': each_file['shock_id'], 'make_handle': 1})
-        out_files.append(_create_file_link(each_file, shock))
+    sizes = []
+    for batch in batches:
+        size = 0
+        for idx in batch:
+            with _timed(tasks[idx]['timings'], 'stat'):
+                size += _task_size(tasks[idx])
+        sizes.append(size)
+    try:
+        (batch_results, failures) = _run_scheduled(
+            run_batch, batches, sizes, config['upload-concurrency'],
+            config['upload-max-bytes-in-flight'], config['upload-small-file-size']
+        )
+    finally:
+        if packer:
+            packer.shutdown()
+        for task in tasks:
+            if task.get('staging_dir'):
+                shutil.rmtree(task['staging_dir'], ignore_errors=True)
+    if failures:
+        failed = sorted([(idx, err) for (batch_idx, err) in failures
+                         for idx in batches[batch_idx]], key=lambda failure: failure[0])
+        raise LinkUploadError([(tasks[idx]['link'], err) for (idx, err) in failed])
+
+    out_files = [None] * len(tasks)
+    for (idx, task) in enumerate(tasks):
+        if task.get('journaled'):
+            out_files[idx] = _create_file_link(task['link'], task['journaled'])
+    for (batch, shocks) in zip(batches, batch_results):
+        for (idx, shock) in zip(batch, shocks):
+            task = tasks[idx]
+            if cache and task.get('digest') and not task.get('cached'):
+                cache.add(task['digest'], shock)
+            out_files[idx] = _create_file_link(task['link'], shock)
+    if journal:
+        # the request went through, so there is nothing left to resume
+        journal.remove()
     return out_files
 
 
+def _run_task(dfu, task, owner, cache=None, pack_dir=None):
+    """
+    Make the DataFileUtil call for a single upload task, reusing a cached shock node if possible
+    html_links directories are checked against the manifest of their last upload: if no file
+    has changed the previous node is reused, otherwise only the changed files are recompressed.
+    :param owner: _ShockNodeOwner for the request
+    :param cache: UploadCache (optional)
+    :param pack_dir: function to zip a directory locally, returning the archive path (optional)
+    """
+    timings = task['timings']
+    if task.get('cached'):
+        try:
+            with _timed(timings, 'own'):
+                return owner.own(task['cached']['shock_id'])
+        except Exception as err:
+            # upload as usual; unless the call failed in transit, the node has been deleted or
+            # is not readable, so forget it
+            print(f"{_time.time()} Cached shock node {task['cached']['shock_id']} "
+                  f"could not be reused: {err}")
+            if not _is_transient(err):
+                cache.discard(task['digest'])
+            task['cached'] = None
+
+    method_params = task['params']
+    manifest_key = _manifest_key(task, cache)
+    manifest = None
+    if manifest_key:
+        if 'file_digests' not in task:
+            with _timed(timings, 'hash'):
+                task['file_digests'] = dir_file_digests(method_params['file_path'])
+        files = task['file_digests']
+        manifest = cache.get_manifest(manifest_key)
+        if manifest and manifest['files'] == files:
+            try:
+                with _timed(timings, 'own'):
+                    return owner.own(manifest['shock_id'])
+            except Exception as err:
+                print(f"{_time.time()} Shock node {manifest['shock_id']} for {manifest_key} "
+                      f"could not be reused: {err}")
+                if not _is_transient(err):
+                    cache.discard_manifest(manifest_key)
+                manifest = None
+
+    if pack_dir and method_params.get('pack') == 'zip':
+        (reuse_from, unchanged) = (None, ())
+        if manifest and manifest['archive']:
+            reuse_from = manifest['archive']
+            unchanged = {path for (path, digest) in files.items()
+                         if manifest['files'].get(path) == digest}
+        with _timed(timings, 'pack'):
+            zip_path = pack_dir(method_params['file_path'], reuse_from, unchanged)
+        method_params = {**method_params, 'file_path': zip_path, 'pack': None}
+        try:
+            with _timed(timings, 'upload'):
+                shock = getattr(dfu, task['method'])(method_params)
+            if manifest_key:
+                # keep the archive, so the next upload can copy unchanged files from it
+                cache.add_manifest(manifest_key, files, shock, zip_path)
+            return shock
+        finally:
+            shutil.rmtree(os.path.dirname(zip_path), ignore_errors=True)
+
+    with _timed(timings, 'upload'):
+        shock = getattr(dfu, task['method'])(method_params)
+    if manifest_key:
+        cache.add_manifest(manifest_key, files, shock)
+    return shock
+
+
+@contextmanager
+def _timed(timings, stage):
+    """
+    Add the seconds spent in the enclosed block to timings[stage]
+    :param timings: a task's 'timings' dictionary, or a list of them
+    """
+    start = _time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = _time.perf_counter() - start
+        for each in (timings if isinstance(timings, list) else [timings]):
+            each[stage] = each.get(stage, 0) + elapsed
+
+
+def _link_timings(tasks):
+    """
+    Seconds spent on each stage of handling each link, in input order
+    Stages are 'stat', 'render', 'optimise', 'hash', 'pack', 'upload' and 'own'; DataFileUtil
+    makes the handle as part of the upload or own call, so handle creation is included in those.
+    :return: list of {'name': ..., 'kind': 'file' or 'html', 'timings': {stage: seconds}}
+    """
+    return [{
+        'name': task['link'].get('name', ''),
+        'kind': task['kind'],
+        'timings': {stage: round(seconds, 4) for (stage, seconds) in task['timings'].items()},
+    } for task in tasks]
+
+
+def _manifest_key(task, cache):
+    """ Path under which the manifest for an html_links directory is kept, or None """
+    if not cache or not cache.max_manifests or task['kind'] != 'html' or \
+            task['params'].get('pack') != 'zip':
+        return None
+    # a minified copy is uploaded in place of the directory the link gave
+    if task.get('source_dir'):
+        return os.path.realpath(task['source_dir'])
+    if task.get('staging_dir'):
+        return None
+    return os.path.realpath(task['params']['file_path'])
+
+
+def _optimise_html_links(tasks, config):
+    """
+    Copy each html_links directory to a staging directory to be uploaded in its place, with
+    HTML, CSS and JavaScript minified if 'html-minify' is set, small assets inlined and alike
+    pages bundled if 'html-bundle' is set (see bundle_utils.bundle_dir), and .gz copies of text
+    files added if 'html-gzip' is set (see html_utils.optimise_dir)
+    Files that are not minified are linked into the copy rather than copied where possible, and
+    the directory the link gave is left as it is.
+    """
+    def optimise(task):
+        src_dir = task['params']['file_path']
+        staging_dir = tempfile.mkdtemp(dir=config.get('scratch') or os.path.dirname(src_dir))
+        os.chmod(staging_dir, 0o775)
+        # keep the directory name, which the local zip archive is named after
+        dest_dir = os.path.join(staging_dir, os.path.basename(os.path.normpath(src_dir)))
+        bundle = None
+        if config['html-bundle']:
+            # the main page is never bundled
+            bundle = partial(bundle_dir, index_name=task['link'].get('name'),
+                             inline_size=config['html-bundle-inline-size'],
+                             page_size=config['html-bundle-page-size'])
+        try:
+            with _timed(task['timings'], 'optimise'):
+                optimise_dir(src_dir, dest_dir, config['html-minify'], config['html-gzip'],
+                             _link_or_copy, bundle)
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+        if task.get('staging_dir'):
+            # a single file that was staged in a directory of its own; the copy replaces it
+            shutil.rmtree(task['staging_dir'], ignore_errors=True)
+        else:
+            task['source_dir'] = src_dir
+        task['staging_dir'] = staging_dir
+        task['params'] = {**task['params'], 'file_path': dest_dir}
+
+    (_, failures) = _run_in_pool(optimise, tasks, config['upload-concurrency'])
+    if failures:
+        raise LinkUploadError([(tasks[idx]['link'], err) for (idx, err) in failures])
+
+
+class _RetryingClient:
+    """
+    Wraps a DataFileUtil client so that calls failing with a transient error are retried,
+    with exponential backoff and full jitter between attempts
+    """
+
+    def __init__(self, client, config):
+        """
+        :param client: DataFileUtil client instance
+        :param config: upload config with the 'upload-retries' and 'upload-retry-*' settings
+        """
+        self.client = client
+        self.retries = config['upload-retries']
+        self.delay = config['upload-retry-delay']
+        self.max_delay = config['upload-retry-max-delay']
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return method(*args, **kwargs)
+                except Exception as err:
+                    if attempt >= self.retries or not _is_transient(err):
+                        raise
+                    delay = random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+                    attempt += 1
+                    print(f'{_time.time()} DataFileUtil.{name} failed (attempt {attempt} of '
+                          f'{self.retries + 1}), retrying in {delay:.1f}s: {err}')
+                    _time.sleep(delay)
+        return call
+
+
+def _is_transient(err):
+    """ Whether a failed DataFileUtil call is worth retrying """
+    if isinstance(err, _TRANSIENT_ERRORS):
+        return True
+    if isinstance(err, _requests.exceptions.HTTPError):
+        # 4xx responses (bad token, no permission, too large) fail the same way every time
+        return getattr(err.response, 'status_code', 0) >= 500
+    # code 0 means the server (or a proxy in front of it) did not send a JSON-RPC error
+    return isinstance(err, _DFUError) and err.code == 0
+
+
+class _UploadJournal:
+    """
+    Records the shock nodes of the links that have been uploaded for a request
+    One JSON object is appended per completed link, so the journal survives the process dying
+    part way through; an incomplete last line is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def completed(self, tasks):
+        """
+        Return {task index: shock} for the tasks that completed in an earlier attempt
+        Entries are only used if the link's path has not been modified since it was uploaded.
+        """
+        done = {}
+        try:
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    idx = entry['index']
+                    if idx < len(tasks) and entry['stamp'] == tasks[idx].get('stamp'):
+                        done[idx] = entry['shock']
+        except FileNotFoundError:
+            pass
+        return done
+
+    def record(self, entries, shocks):
+        """
+        :param entries: list of (task index, stamp) tuples
+        :param shocks: output of the DataFileUtil call for each entry
+        """
+        lines = ''.join(json.dumps({'index': idx, 'stamp': stamp, 'shock': shock}) + '\n'
+                        for ((idx, stamp), shock) in zip(entries, shocks))
+        with self._lock, open(self.path, 'a') as fh:
+            fh.write(lines)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _journal_key(file_links, html_links, request_id):
+    """
+    Identify a request by its id and links, before any templates have been rendered
+    Requests without an id are not journalled, as two requests with the same links could
+    otherwise add to and remove each other's journal.
+    :param request_id: JSON-serialisable id that stays the same when the request is retried,
+        e.g. the workspace and the report name
+    :return: hex digest, or None if there is no request id
+    """
+    if not request_id:
+        return None
+    links = json.dumps([request_id, file_links, html_links], sort_keys=True, default=str)
+    return hashlib.sha256(links.encode('utf-8')).hexdigest()
+
+
+def _link_stamp(each_file, templater):
+    """
+    Size and latest modification time of a link's path, used to check journal entries
+    Rendered templates get a new path each time, so they are stamped with the template file
+    (and template_data_file) instead; see TemplateUtil.template_stamps.
+    """
+    if 'template' in each_file:
+        return templater.template_stamps(each_file['template'])
+    if 'path' not in each_file:
+        return None
+    path = each_file['path']
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(root, name) for (root, dirs, files) in os.walk(path)
+                 for name in files]
+    stats = [os.stat(each_path) for each_path in paths]
+    return [sum(st.st_size for st in stats), max([st.st_mtime_ns for st in stats], default=0)]
+
+
+class _ShockNodeOwner:
+    """
+    Takes ownership of shock nodes and makes handles for them, calling
+    DataFileUtil.own_shock_node at most once per node; results are kept for one request
+    """
+
+    def __init__(self, dfu):
+        self.dfu = dfu
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def own(self, shock_id):
+        """ Return the output of own_shock_node for a node, making the call if needed """
+        with self._lock:
+            future = self._results.get(shock_id)
+            first_request = future is None
+            if first_request:
+                future = self._results[shock_id] = Future()
+        if first_request:
+            try:
+                future.set_result(self.dfu.own_shock_node({'shock_id': shock_id,
+                                                           'make_handle': 1}))
+            except Exception as err:
+                future.set_exception(err)
+        return future.result()
+
+
+def _get_upload_cache(config):
+    """
+    Return an UploadCache if the cache is enabled in the upload config, otherwise None
+    The cache is opt-in, with 'upload-cache-dir', as every upload is hashed in full to look it up.
+    """
+    cache_dir = config.get('upload-cache-dir')
+    if not cache_dir or not config['upload-cache-max-entries']:
+        return None
+    return UploadCache(cache_dir, config['upload-cache-max-entries'],
+                       config['upload-cache-max-age-days'],
+                       config['upload-manifest-max-entries'])
+
+
+def _find_cached_uploads(cache, tasks, config):
+    """
+    Hash the content of every path upload and look it up in the upload cache
+    Sets 'digest' on each upload task, and 'cached' on those with a previously uploaded node.
+    The per-file digests of directories are kept in 'file_digests' for the manifest check.
+    """
+    uploads = [task for task in tasks if task['method'] == 'file_to_shock']
+
+    def lookup(task):
+        # the node's file name matters for downloads, but not for zipped HTML pages
+        path = task['params']['file_path']
+        name = None if task['kind'] == 'html' else os.path.basename(path)
+        with _timed(task['timings'], 'hash'):
+            if os.path.isdir(path):
+                task['file_digests'] = dir_file_digests(path)
+            task['digest'] = content_digest(path, task['params'].get('pack'), name,
+                                            task.get('file_digests'))
+        task['cached'] = cache.get(task['digest'])
+
+    (_, failures) = _run_in_pool(lookup, uploads, config['upload-concurrency'])
+    if failures:
+        raise LinkUploadError([(uploads[idx]['link'], err) for (idx, err) in failures])
+
+
+def _task_size(task):
+    """ Number of bytes a task will upload; 0 if it only owns an existing node """
+    if task['method'] != 'file_to_shock' or task.get('cached'):
+        return 0
+    path = task['params']['file_path']
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for (root, dirs, files) in os.walk(path) for name in files)
+
+
+def _run_scheduled(func, items, sizes, max_tasks, max_bytes, small_size):
+    """
+    Apply `func` to each item using at most `max_tasks` threads, starting the largest items first
+    Items bigger than `small_size` are only started while the total size of the large items
+    in flight stays within `max_bytes`; a single item bigger than that runs once no other large
+    item is in flight. Small items only count against `max_tasks`, so they fill the free
+    threads while the large transfers are running.
+    As soon as one call fails, no more calls are started.
+    :param sizes: size in bytes of each item
+    :return: tuple of (results in input order, list of (item index, exception) for failures)
+    """
+    if not items:
+        return ([], [])
+
+    results = [None] * len(items)
+    failures = []
+    pending = sorted(range(len(items)), key=lambda idx: -sizes[idx])
+    running = {}
+    bytes_in_flight = 0
+    with ThreadPoolExecutor(max_workers=min(max_tasks, len(items))) as executor:
+        while running or (pending and not failures):
+            waiting = []
+            for idx in ([] if failures else pending):
+                large = sizes[idx] > small_size
+                if len(running) >= max_tasks or \
+                        (large and bytes_in_flight and bytes_in_flight + sizes[idx] > max_bytes):
+                    waiting.append(idx)
+                    continue
+                running[executor.submit(func, items[idx])] = idx
+                if large:
+                    bytes_in_flight += sizes[idx]
+            pending = waiting
+
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx = running.pop(future)
+                if sizes[idx] > small_size:
+                    bytes_in_flight -= sizes[idx]
+                try:
+                    results[idx] = future.result()
+                except Exception as err:
+                    failures.append((idx, err))
+
+    return (results, sorted(failures, key=lambda failure: failure[0]))
+
+
+def _run_in_pool(func, items, max_workers):
+    """
+    Apply `func` to each item using at most `max_workers` threads
+    As soon as one call fails, any calls that have not started yet are cancelled.
+    :return: tuple of (results in input order, list of (item index, exception) for failures)
+    """
+    if not items:
+        return ([], [])
+
+    results = [None] * len(items)
+    failures = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = {executor.submit(func, item): idx for (idx, item) in enumerate(items)}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception as err:
+                failures.append((idx, err))
+                for other in futures:
+                    other.cancel()
+
+    return (results, sorted(failures, key=lambda failure: failure[0]))
+
+
+def _link_or_copy(src, dest):
+    """
+    Make `src` available at `dest` as cheaply as possible
+    Tries a hard link, then a reflink (copy-on-write clone), then a symlink, and only
+    copies the data if none of those are possible.
+    :return: the method used: 'hardlink', 'reflink', 'symlink' or 'copy'
+    """
+    try:
+        os.link(src, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    if _reflink(src, dest):
+        return 'reflink'
+
+    try:
+        os.symlink(os.path.abspath(src), dest)
+        return 'symlink'
+    except OSError:
+        pass
+
+    shutil.copy2(src, dest)
+    return 'copy'
+
+
+def _reflink(src, dest):
+    """ Clone `src` to `dest` with the Linux FICLONE ioctl; returns False if unsupported """
+    if _fcntl is None:
+        return False
+    try:
+        with open(src, 'rb') as src_fh, open(dest, 'wb') as dest_fh:
+            _fcntl.ioctl(dest_fh.fileno(), _FICLONE, src_fh.fileno())
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
 def _render_template_add_path(templater, file_data):
     # render the template to a temporary file and set the 'path' attribute
-    rendered_file = templater.render_template_to_scratch_file(file_data['template'])
+    if 'paginate' in file_data['template']:
+        # the pages are written to a directory of their own, and the first is named for the link
+        rendered_file = templater.render_template_to_scratch_dir(file_data['template'],
+                                                                 file_data['name'])
+    else:
+        rendered_file = templater.render_template_to_scratch_file(file_data['template'])
     file_data['path'] = rendered_file['path']
     del file_data['template']
     return file_data
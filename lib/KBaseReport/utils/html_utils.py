@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import re
+import shutil
+
+"""
+Utilities for shrinking the contents of html_links directories before they are zipped
+
+HTML, CSS and JavaScript files are minified conservatively: comments are removed and runs of
+whitespace are collapsed, but nothing is renamed or rewritten, and the contents of <pre> and
+<textarea> elements, string literals and regular expressions are left alone. A file that
+cannot be tokenised (e.g. it has an unterminated string) is kept as it is.
+
+Text files can also get a gzip-compressed copy alongside them (index.html.gz next to
+index.html). The copies are made with a fixed header, so the same content always gives the
+same bytes, and the upload cache and directory manifests still recognise unchanged content.
+"""
+
+MINIFY_EXTENSIONS = {'.css', '.htm', '.html', '.js', '.mjs'}
+
+# text files that get a .gz copy
+GZIP_EXTENSIONS = {
+    '.css', '.csv', '.htm', '.html', '.js', '.json', '.map', '.mjs', '.svg', '.tsv', '.txt',
+    '.xml',
+}
+
+# files smaller than this gain little or nothing from compression
+GZIP_MIN_SIZE = 1024
+
+# bigger files are kept as they are, rather than being read into memory to minify
+_MAX_MINIFY_SIZE = 64 * 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+_HTML_WHITESPACE = re.compile(r'[ \t\r\n\f]+')
+_HTML_TOKENS = re.compile(
+    r'(?P<comment><!--.*?-->)'
+    r'|(?P<raw><(?P<raw_tag>pre|textarea|script|style)\b'
+    r'(?P<raw_attrs>(?:"[^"]*"|\'[^\']*\'|[^\'">])*)>(?P<raw_body>.*?)</(?P=raw_tag)\s*>)'
+    r'|(?P<tag><[a-zA-Z/!?](?:"[^"]*"|\'[^\']*\'|[^\'">])*>)',
+    re.I | re.S
+)
+_HTML_TAG_PARTS = re.compile(r'("[^"]*"|\'[^\']*\')|[ \t\r\n\f]+')
+_SCRIPT_TYPE = re.compile(r'\btype\s*=\s*["\']?([^"\'\s>]+)', re.I)
+_JS_TYPES = {'application/javascript', 'module', 'text/ecmascript', 'text/javascript'}
+
+_CSS_TOKENS = re.compile(
+    r'(?P<string>"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\')'
+    r'|(?P<comment>/\*.*?\*/)'
+    r'|(?P<ws>\s+)'
+    r'|(?P<other>[^"\'/\s]+|/(?!\*))',
+    re.S
+)
+# whitespace next to these is never needed in CSS
+_CSS_PUNCTUATION = '{};,>'
+
+_JS_TOKENS = re.compile(
+    r'(?P<ws>[ \t\r\n\f\v]+)'
+    r'|(?P<line_comment>//[^\r\n]*)'
+    r'|(?P<block_comment>/\*.*?\*/)'
+    r'|(?P<string>"(?:\\.|[^"\\\r\n])*"|\'(?:\\.|[^\'\\\r\n])*\')'
+    r'|(?P<word>[\w$\\]+)'
+    r'|(?P<brace>[{}])'
+    r'|(?P<punct>[^\s/\'"`\w$\\{}]+|/(?![/*]))',
+    re.S
+)
+_JS_REGEX = re.compile(r'/(?:\\.|\[(?:\\.|[^\]\\\r\n])*\]|[^/\\\[\r\n])+/[a-zA-Z]*')
+_JS_TEMPLATE_PART = re.compile(r'(?:\\.|\$(?!\{)|[^`\\$])*(?:`|\$\{)', re.S)
+# keywords after which a / starts a regular expression rather than a division
+_JS_REGEX_KEYWORDS = {
+    'await', 'case', 'delete', 'do', 'else', 'in', 'instanceof', 'new', 'of', 'return',
+    'throw', 'typeof', 'void', 'yield',
+}
+
+
+class MinifyError(ValueError):
+    """ Content that cannot be tokenised, and so is left as it is """
+
+
+def optimise_dir(src_dir, dest_dir, minify=True, gzip_copies=True, copy_file=shutil.copy2,
+                 bundle=None):
+    """ Copy a directory for upload, minifying files and adding .gz copies on the way
+
+    src_dir is not changed. Files are handled in sorted order, so the same input always gives
+    the same output.
+
+    :param src_dir:     (string)    directory to copy
+    :param dest_dir:    (string)    directory to copy it to, which is created if need be
+    :param minify:      (bool)      minify HTML, CSS and JavaScript files
+    :param gzip_copies: (bool)      add a .gz copy of each text file, unless src_dir has one
+    :param copy_file:   (callable)  puts a file that is not minified at a new path; e.g. a
+                                    function that makes a hard link rather than a copy
+    :param bundle:      (callable)  called with dest_dir once the files are copied, and before
+                                    the .gz copies are added (e.g. bundle_utils.bundle_dir);
+                                    must replace rather than write to the files it changes
+
+    :return:
+    {
+        'files': 12,                # files in src_dir
+        'minified': 3,              # files made smaller by minifying
+        'gzipped': 4,               # .gz copies added
+        'bytes_saved': 10240,       # total reduction in size from minifying
+        'bundle': {...},            # what bundle returned, if given
+    }
+    """
+    stats = {'files': 0, 'minified': 0, 'gzipped': 0, 'bytes_saved': 0}
+    for (root, dirs, files) in os.walk(src_dir):
+        dirs.sort()
+        dest_root = os.path.normpath(os.path.join(dest_dir, os.path.relpath(root, src_dir)))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            dest = os.path.join(dest_root, name)
+            if not os.path.isfile(src):
+                continue
+            stats['files'] += 1
+
+            saved = minify_file(src, dest) if minify else None
+            if saved is None:
+                copy_file(src, dest)
+            else:
+                stats['minified'] += 1
+                stats['bytes_saved'] += saved
+
+    if bundle is not None:
+        stats['bundle'] = bundle(dest_dir)
+
+    if gzip_copies:
+        for (root, dirs, files) in os.walk(dest_dir):
+            dirs.sort()
+            existing = set(files)
+            for name in sorted(files):
+                dest = os.path.join(root, name)
+                if name.endswith('.gz') or name + '.gz' in existing or \
+                        not os.path.isfile(dest) or not _gzip_worthwhile(dest):
+                    continue
+                write_gzip(dest, dest + '.gz')
+                stats['gzipped'] += 1
+    return stats
+
+
+def minify_file(src, dest):
+    """ Write a minified copy of an HTML, CSS or JavaScript file
+
+    :return: number of bytes saved, or None if nothing was written because the file is not
+             one that is minified, is already minified, or would not get any smaller
+    """
+    name = os.path.basename(src).lower()
+    ext = os.path.splitext(name)[1]
+    if ext not in MINIFY_EXTENSIONS or '.min.' in name:
+        return None
+    size = os.path.getsize(src)
+    if size > _MAX_MINIFY_SIZE:
+        return None
+
+    minify = minify_html if ext in ('.htm', '.html') else \
+        minify_css if ext == '.css' else minify_js
+    try:
+        # newline='' keeps the line endings as they are
+        with open(src, 'r', encoding='utf-8', newline='') as f:
+            text = minify(f.read())
+    except (UnicodeDecodeError, MinifyError):
+        return None
+
+    data = text.encode('utf-8')
+    if len(data) >= size:
+        return None
+    with open(dest, 'wb') as f:
+        f.write(data)
+    shutil.copystat(src, dest)
+    return size - len(data)
+
+
+def write_gzip(src, dest, compresslevel=9):
+    """ gzip a file, with no file name or time in the header so the output is reproducible """
+    with open(src, 'rb') as f, open(dest, 'wb') as out:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=out, compresslevel=compresslevel,
+                           mtime=0) as gz:
+            shutil.copyfileobj(f, gz, _CHUNK_SIZE)
+
+
+def _gzip_worthwhile(path):
+    return os.path.splitext(path)[1].lower() in GZIP_EXTENSIONS and \
+        os.path.getsize(path) >= GZIP_MIN_SIZE
+
+
+def minify_html(text):
+    """ Remove comments and collapse whitespace in an HTML document """
+    out = []
+    pos = 0
+    for match in _HTML_TOKENS.finditer(text):
+        out.append(_collapse_html_text(text[pos:match.start()]))
+        pos = match.end()
+        if match.group('comment'):
+            comment = match.group('comment')
+            # conditional comments and <!--! ... --> are kept
+            if comment.startswith(('<!--[if', '<!--<![endif]', '<!--!')):
+                out.append(comment)
+        elif match.group('tag'):
+            out.append(_collapse_tag(match.group('tag')))
+        else:
+            out.append(_minify_raw_element(match))
+    out.append(_collapse_html_text(text[pos:]))
+    return ''.join(out)
+
+
+def _collapse_html_text(text):
+    """ A run of whitespace renders as a single space, so one character of it is enough """
+    return _HTML_WHITESPACE.sub(lambda m: '\n' if '\n' in m.group() else ' ', text)
+
+
+def _collapse_tag(tag):
+    """ Collapse the whitespace between the attributes of a tag, leaving the values alone """
+    return _HTML_TAG_PARTS.sub(lambda m: m.group(1) or ' ', tag)
+
+
+def _minify_raw_element(match):
+    """ <pre> and <textarea> contents are kept as they are; <script> and <style> are minified """
+    element = match.group('raw')
+    start_tag = element[:match.start('raw_body') - match.start()]
+    end_tag = element[match.end('raw_body') - match.start():]
+    body = match.group('raw_body')
+    tag = match.group('raw_tag').lower()
+    if tag == 'script':
+        script_type = _SCRIPT_TYPE.search(match.group('raw_attrs'))
+        if script_type is None or script_type.group(1).lower() in _JS_TYPES:
+            body = _minify_or_keep(minify_js, body)
+    elif tag == 'style':
+        body = _minify_or_keep(minify_css, body)
+    return _collapse_tag(start_tag) + body + end_tag
+
+
+def _minify_or_keep(minify, text):
+    try:
+        return minify(text).strip()
+    except MinifyError:
+        return text
+
+
+def minify_css(text):
+    """ Remove comments and unneeded whitespace from a style sheet """
+    out = []
+    space = False
+    pos = 0
+    while pos < len(text):
+        match = _CSS_TOKENS.match(text, pos)
+        if match is None:
+            raise MinifyError(f'unterminated string or comment at position {pos}')
+        pos = match.end()
+        (kind, token) = (match.lastgroup, match.group())
+        if kind == 'ws':
+            space = True
+            continue
+        # /*! ... */ comments are usually licences, and are kept
+        if kind == 'comment' and not token.startswith('/*!'):
+            continue
+
+        if kind == 'other':
+            token = token.replace(';}', '}')
+            if token.startswith('}') and out and out[-1].endswith(';') and \
+                    not out[-1].endswith(('"', "'")):
+                out[-1] = out[-1][:-1]
+                if not out[-1]:
+                    out.pop()
+        # whitespace before a colon can be part of a selector (`div :first-child`), but
+        # whitespace after one never matters
+        if space and out and out[-1][-1] not in _CSS_PUNCTUATION + ':' and \
+                token[0] not in _CSS_PUNCTUATION:
+            out.append(' ')
+        space = False
+        out.append(token)
+    return ''.join(out)
+
+
+def minify_js(text):
+    """ Remove comments and unneeded whitespace from a script
+
+    Line breaks are kept wherever they might end a statement, so automatic semicolon insertion
+    works as before.
+    """
+    out = []
+    # whitespace since the last token written: None, ' ' or '\n'
+    pending = None
+    # the last token written, to tell a regular expression from a division
+    last = (None, None)
+    # brace depth inside each ${...} of the template literals being read
+    templates = []
+    pos = 0
+    while pos < len(text):
+        char = text[pos]
+        if char == '`' or (char == '}' and templates and templates[-1] == 0):
+            if char == '}':
+                templates.pop()
+            match = _JS_TEMPLATE_PART.match(text, pos + 1)
+            if match is None:
+                raise MinifyError(f'unterminated template literal at position {pos}')
+            (kind, token) = ('template', char + match.group())
+            if token.endswith('${'):
+                templates.append(0)
+        elif char == '/' and not text.startswith(('//', '/*'), pos) and _js_regex_allowed(last):
+            match = _JS_REGEX.match(text, pos)
+            if match is None:
+                raise MinifyError(f'unterminated regular expression at position {pos}')
+            (kind, token) = ('regex', match.group())
+        else:
+            match = _JS_TOKENS.match(text, pos)
+            if match is None:
+                raise MinifyError(f'unterminated string or comment at position {pos}')
+            (kind, token) = (match.lastgroup, match.group())
+        pos = match.end()
+
+        if kind in ('ws', 'line_comment') or \
+                (kind == 'block_comment' and not token.startswith('/*!')):
+            # a comment with a line break in it counts as a line break
+            if '\n' in token or '\r' in token or pending == '\n':
+                pending = '\n'
+            elif kind != 'line_comment':
+                pending = ' '
+            continue
+
+        if kind == 'brace' and templates:
+            templates[-1] += 1 if token == '{' else -1
+        if pending and out:
+            out.append(_js_separator(pending, out[-1][-1], token[0]))
+        pending = None
+        out.append(token)
+        if kind != 'block_comment':
+            last = (kind, token)
+    return ''.join(out)
+
+
+def _js_regex_allowed(last):
+    """ Whether a / after the token `last` starts a regular expression """
+    (kind, token) = last
+    if kind is None:
+        return True
+    if kind == 'punct':
+        return token[-1] not in ')]'
+    if kind == 'brace':
+        return True
+    if kind == 'word':
+        return token in _JS_REGEX_KEYWORDS
+    return False
+
+
+def _js_separator(pending, before, after):
+    """ The whitespace needed between two tokens that had whitespace between them """
+    if pending == '\n':
+        # a line break after these, or before these, can never end a statement
+        if before in '{;,([' or after in '}]);,':
+            return ''
+        return '\n'
+    if (_js_word_char(before) and _js_word_char(after)) or \
+            (before in '+-' and after == before) or '/' in (before, after) or \
+            (before == '<' and after == '!') or (before == '-' and after == '>'):
+        return ' '
+    return ''
+
+
+def _js_word_char(char):
+    return char.isalnum() or char in '_$\\' or ord(char) > 127
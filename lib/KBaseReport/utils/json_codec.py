@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+"""
+JSON encoding and decoding for template data
+
+The functions here use orjson, which is several times faster than the json module, when it is
+installed ('json-codec' in the config picks the codec; see use_codec). The results are always
+exactly what the json module gives: orjson is only used where its result is known to be the
+same, and the json module otherwise.
+
+    loads:  orjson parses anything but numbers of 19 or more digits, as it turns integers that
+            do not fit in 64 bits into floats. Anything orjson rejects (NaN, Infinity, lone
+            surrogates, numbers too big for a double, invalid JSON) goes to json.loads, which
+            parses it or raises the same error as always.
+
+    dumps:  orjson writes compact output (compact=True), with non-ASCII characters escaped as
+            json.dumps escapes them. Output with the default separators, which orjson cannot
+            write, comes from json.dumps, as does any output that orjson would write
+            differently: NaN and Infinity (which orjson writes as null), floats that json.dumps
+            writes with an exponent, integers beyond 64 bits, non-string keys, and subclasses of
+            the JSON types. An encoder class (cls) works with both, as its default() is used
+            for the objects that neither codec can encode itself.
+"""
+
+_COMPACT = (',', ':')
+
+# maps every digit to '0' and everything else to ' ', to find long numbers quickly
+_DIGITS = bytes(48 if 48 <= i <= 57 else 32 for i in range(256))
+_LONG_NUMBER = b'0' * 19
+
+# maps digits to '0', 'e' and 'E' to 'e' and everything else to ' ', to find exponents quickly
+_EXPONENTS = bytes(48 if 48 <= i <= 57 else 101 if i in (69, 101) else 32 for i in range(256))
+
+# \U escapes of characters beyond the BMP, which json.dumps writes as surrogate pairs
+_ASTRAL = re.compile(rb'\\U([0-9a-f]{8})')
+
+
+class JSONCodec:
+    """ Interface for a JSON codec """
+
+    name = None
+
+    def loads(self, data):
+        """ Parse a JSON str or bytes """
+        raise NotImplementedError
+
+    def dumps(self, obj, cls=None, sort_keys=False, compact=False):
+        """ Serialise an object to a JSON str
+
+        :param obj:         object to serialise
+        :param cls:         (class)  json.JSONEncoder subclass whose default() converts objects
+                                     that are not JSON types, e.g. sets
+        :param sort_keys:   (bool)   sort the keys of objects
+        :param compact:     (bool)   no spaces after ',' and ':'
+        """
+        raise NotImplementedError
+
+
+class StdlibCodec(JSONCodec):
+    """ The json module """
+
+    name = 'stdlib'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, cls=None, sort_keys=False, compact=False):
+        return json.dumps(obj, cls=cls, sort_keys=sort_keys,
+                          separators=_COMPACT if compact else None)
+
+
+class OrjsonCodec(StdlibCodec):
+    """ orjson, falling back to the json module wherever the results could differ """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('orjson must be installed to use the orjson JSON codec')
+
+    def loads(self, data):
+        if isinstance(data, str):
+            # json.loads rejects a str with a byte order mark, which orjson would skip
+            if data.startswith('\ufeff'):
+                return super().loads(data)
+            encoded = data.encode('utf-8', 'surrogatepass')
+        else:
+            encoded = bytes(data)
+        if _LONG_NUMBER in encoded.translate(_DIGITS):
+            return super().loads(data)
+        try:
+            return orjson.loads(encoded)
+        except orjson.JSONDecodeError:
+            return super().loads(data)
+
+    def dumps(self, obj, cls=None, sort_keys=False, compact=False):
+        if not compact:
+            return super().dumps(obj, cls=cls, sort_keys=sort_keys)
+        option = orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_PASSTHROUGH_DATETIME | \
+            orjson.OPT_PASSTHROUGH_SUBCLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            output = orjson.dumps(obj, default=cls().default if cls else None, option=option)
+        except orjson.JSONEncodeError:
+            output = None
+        if output is None or _maybe_different(output):
+            return super().dumps(obj, cls=cls, sort_keys=sort_keys, compact=True)
+        if output.isascii():
+            return output.decode('ascii').replace('\x7f', '\\u007f')
+        return _ensure_ascii(output)
+
+
+def _maybe_different(output):
+    """ whether json.dumps may write something differently to orjson's output
+
+    'null' may be NaN or Infinity, and floats below 1e-4 or from 1e16 up are written with an
+    exponent by json.dumps, but not always by orjson
+    """
+    return b'null' in output or b'0.0000' in output or b'0e' in output.translate(_EXPONENTS)
+
+
+def _ensure_ascii(output):
+    """ escape the non-ASCII characters in orjson's output as json.dumps escapes them
+
+    backslashreplace escapes them as \\xhh, \\uhhhh or \\Uhhhhhhhh, of which json.dumps writes the
+    first as \\u00hh and the last as a surrogate pair. Escaped backslashes are swapped out for NUL,
+    which JSON always escapes, so that '\\\\x' is not taken for an escape.
+    """
+    escaped = output.decode('utf-8').encode('ascii', 'backslashreplace')
+    escaped = escaped.replace(b'\\\\', b'\x00').replace(b'\\x', b'\\u00')
+    if b'\\U' in escaped:
+        escaped = _ASTRAL.sub(_surrogate_pair, escaped)
+    return escaped.replace(b'\x00', b'\\\\').replace(b'\x7f', b'\\u007f').decode('ascii')
+
+
+def _surrogate_pair(match):
+    code = int(match.group(1), 16) - 0x10000
+    return b'\\u%04x\\u%04x' % (0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+
+_CODECS = {'stdlib': StdlibCodec, 'orjson': OrjsonCodec}
+_codec = OrjsonCodec() if orjson is not None else StdlibCodec()
+
+
+def use_codec(name='auto'):
+    """ Set the codec used by loads, load and dumps
+
+    :param name:    (string)  'orjson', 'stdlib', or 'auto' for orjson if it is installed
+    """
+    global _codec
+    if name in (None, '', 'auto'):
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in _CODECS:
+        raise ValueError(f"json-codec must be one of 'auto', 'orjson' or 'stdlib', not '{name}'")
+    _codec = _CODECS[name]()
+
+
+def codec_name():
+    return _codec.name
+
+
+def loads(data):
+    """ Parse a JSON str or bytes, as json.loads does """
+    return _codec.loads(data)
+
+
+def load(fp):
+    """ Parse the JSON in a file, as json.load does """
+    return _codec.loads(fp.read())
+
+
+def dumps(obj, cls=None, sort_keys=False, compact=False):
+    """ Serialise an object to JSON, as json.dumps does; see JSONCodec.dumps """
+    return _codec.dumps(obj, cls=cls, sort_keys=sort_keys, compact=compact)
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
-from .file_utils import fetch_or_upload_file_links, fetch_or_upload_html_links
+from .file_utils import fetch_or_upload_links
+from .template_profile import summarise_profile
+import json
 import time as _time
 from installed_clients.baseclient import ServerError as _DFUError
 from uuid import uuid4
 
 """ Utilities for creating reports using DataFileUtil """
 
+# longest link name written to the report object's metadata
+_MAX_META_NAME = 100
+
 
 def create_report(params, dfu):
     """
@@ -37,18 +42,35 @@ def create_report(params, dfu):
     return {'ref': ref, 'name': report_name}
 
 
-def create_extended(params, dfu, templater):
+def create_extended(params, dfu, templater, upload_config=None, ctx=None):
     """
     Create an extended report
     This will upload files to shock if you provide scratch paths instead of shock_ids
     :param params: see the KIDL spec for create_extended_report() parameters
     :param dfu: instance of DataFileUtil
+    :param templater: instance of TemplateUtil
+    :param upload_config: file upload settings (see validation_utils.validate_upload_config)
+    :param ctx: MethodContext to log upload timings to (optional)
     :return: uploaded report data - {'ref': r, 'name': n}
     """
     file_links = params.get('file_links', [])
     html_links = params.get('html_links', [])
-    files = fetch_or_upload_file_links(dfu, file_links, templater)  # see ./file_utils.py
-    html_files = fetch_or_upload_html_links(dfu, html_links, templater)
+    timings = []
+    request_id = None
+    if 'report_object_name' in params:
+        # a retry of the request saves the same report, so it can skip the links it uploaded
+        request_id = [params.get('workspace_id') or params.get('workspace_name'),
+                      params['report_object_name']]
+    # see ./file_utils.py
+    (files, html_files) = fetch_or_upload_links(dfu, file_links, html_links, templater,
+                                                upload_config, timings, request_id)
+    for link in timings:
+        stages = ' '.join(f'{stage}={seconds:.3f}s' for (stage, seconds)
+                          in link['timings'].items())
+        _log_info(ctx, f"{link['kind']} link '{link['name']}': {stages}")
+    meta = {}
+    if timings and (upload_config or {}).get('upload-timings-in-meta'):
+        meta['link_timings'] = _summarise_timings(timings)
     report_data = {
         'text_message': params.get('message'),
         'file_links': files,
@@ -68,7 +90,7 @@ def create_extended(params, dfu, templater):
             'type': 'KBaseReport.Report',
             'data': report_data,
             'name': report_name,
-            'meta': {},
+            'meta': meta,
             'hidden': 1
         }]
     }
@@ -77,6 +99,51 @@ def create_extended(params, dfu, templater):
     return {'ref': ref, 'name': report_name}
 
 
+def log_template_profiles(ctx, profiles):
+    """
+    Log a summary of each render profile (see TemplateUtil.collect_profiles)
+    :param ctx: MethodContext to log to (optional)
+    :param profiles: list of render profiles
+    """
+    for profile in profiles:
+        _log_info(ctx, summarise_profile(profile))
+
+
+def _log_info(ctx, message):
+    """ Log through the MethodContext, or print if there is no logger (e.g. in tests) """
+    if ctx is not None:
+        try:
+            ctx.log_info(message)
+            return
+        except AttributeError:
+            # a MethodContext made without a logger, as in the tests
+            pass
+    print(f'{_time.time()} {message}')
+
+
+def _truncate(text, length):
+    return text if len(text) <= length else text[:length - 3] + '...'
+
+
+def _summarise_timings(timings):
+    """
+    Compact summary of the link timings for the report object's metadata
+    Workspace metadata values are strings, so this is a JSON string with the number of links,
+    the total seconds spent on each stage and the name of the slowest link, cut to
+    _MAX_META_NAME characters, as each metadata value is limited in size.
+    """
+    totals = {}
+    for link in timings:
+        for (stage, seconds) in link['timings'].items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    slowest = max(timings, key=lambda link: sum(link['timings'].values()))
+    return json.dumps({
+        'links': len(timings),
+        'seconds': {stage: round(seconds, 3) for (stage, seconds) in totals.items()},
+        'slowest': _truncate(slowest['name'], _MAX_META_NAME),
+    }, separators=(',', ':'))
+
+
 def _get_workspace_id(dfu, params):
     """
     Get the workspace ID from the params, which may either have 'workspace_id'
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+from template.util import TemplateException
+from .RenderCache import record_dependency
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+"""
+Template engines used by TemplateUtil
+
+Templates ending in .tt or .tt2 are rendered by Template Toolkit (TTBackend, in TemplateUtil),
+and templates ending in .j2, .jinja or .jinja2 by Jinja2 (JinjaBackend), which compiles
+templates to Python bytecode. Any other template goes to the backend set by 'template-backend'
+in the config, which is 'tt' unless set otherwise.
+
+Both backends find templates with the same TT config: INCLUDE_PATH (split on DELIMITER),
+ABSOLUTE and RELATIVE. Jinja2 applies TRIM to the whole output only, and ignores the other
+TT options.
+"""
+
+TT_EXTENSIONS = ('.tt', '.tt2')
+JINJA_EXTENSIONS = ('.j2', '.jinja', '.jinja2')
+
+
+def backend_name(template_file, default='tt'):
+    """ Name of the backend that renders a template file """
+    if template_file.endswith(JINJA_EXTENSIONS):
+        return 'jinja2'
+    if template_file.endswith(TT_EXTENSIONS):
+        return 'tt'
+    return default
+
+
+def include_paths(uc_tt_config):
+    """ The INCLUDE_PATH directories of a TT config, with the keys in upper case """
+    paths = uc_tt_config.get('INCLUDE_PATH') or []
+    if isinstance(paths, str):
+        paths = paths.split(uc_tt_config.get('DELIMITER') or ':')
+    return [path for path in paths if path]
+
+
+class TemplateBackend:
+    """ Interface for a template engine
+
+    Backends must be safe to use from several threads at once.
+    """
+
+    name = None
+
+    def render(self, template_file, template_data, uc_tt_config):
+        """ Render a template; return the output as a string """
+        raise NotImplementedError
+
+    def can_stream(self, uc_tt_config):
+        """ Whether stream() can be used with a TT config """
+        return False
+
+    def stream(self, template_file, template_data, output, uc_tt_config):
+        """ Render a template, writing the output to output.write() as it is produced
+
+        :return: any output that was not written
+        """
+        raise NotImplementedError
+
+    def compile(self, template_file, uc_tt_config):
+        """ Compile a template into the backend's caches without rendering it """
+        raise NotImplementedError
+
+
+class JinjaBackend(TemplateBackend):
+    """ Jinja2 templates
+
+    Each TT config has one Jinja2 environment, shared by all threads. An environment keeps up
+    to 'template-cache-size' compiled templates in memory, and checks the template files for
+    changes every time they are used; if 'template-cache-dir' is set, the compiled bytecode is
+    also saved there and shared between processes.
+
+    Errors are raised as TemplateExceptions, as Template Toolkit does: a template that cannot
+    be found is a 'file' error, and any other problem a 'jinja2' error.
+    """
+
+    name = 'jinja2'
+
+    @staticmethod
+    def available():
+        """ Whether Jinja2 is installed """
+        return jinja2 is not None
+
+    def __init__(self, config):
+        """
+        :param config:  (dict)  validated TemplateUtil config
+        """
+        if jinja2 is None:
+            raise ImportError('Jinja2 must be installed to render Jinja2 templates')
+        self.config = config
+        self._environments = {}
+        self._lock = threading.Lock()
+
+    def render(self, template_file, template_data, uc_tt_config):
+        template = self._get_template(template_file, uc_tt_config)
+        try:
+            output = template.render(template_data)
+        except jinja2.TemplateError as err:
+            raise _template_exception(err)
+        return output.strip() if uc_tt_config.get('TRIM') else output
+
+    def can_stream(self, uc_tt_config):
+        return True
+
+    def stream(self, template_file, template_data, output, uc_tt_config):
+        template = self._get_template(template_file, uc_tt_config)
+        try:
+            for chunk in template.generate(template_data):
+                output.write(chunk)
+        except jinja2.TemplateError as err:
+            raise _template_exception(err)
+        return ''
+
+    def compile(self, template_file, uc_tt_config):
+        self._get_template(template_file, uc_tt_config)
+
+    def _get_template(self, template_file, uc_tt_config):
+        try:
+            return self._environment(uc_tt_config).get_template(template_file)
+        except jinja2.TemplateError as err:
+            raise _template_exception(err)
+
+    def _environment(self, uc_tt_config):
+        key = json.dumps(uc_tt_config, sort_keys=True, default=str)
+        with self._lock:
+            environment = self._environments.get(key)
+            if environment is None:
+                environment = self._new_environment(uc_tt_config)
+                self._environments[key] = environment
+        return environment
+
+    def _new_environment(self, uc_tt_config):
+        bytecode_cache = None
+        if self.config['template-cache-dir']:
+            cache_dir = os.path.join(self.config['template-cache-dir'], 'jinja2')
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+
+        return jinja2.Environment(
+            loader=jinja2.FunctionLoader(_template_loader(uc_tt_config)),
+            cache_size=self.config['template-cache-size'],
+            auto_reload=True,
+            bytecode_cache=bytecode_cache,
+            keep_trailing_newline=True,
+        )
+
+
+def _template_loader(uc_tt_config):
+    """ Jinja2 load function that finds templates the way TT does """
+    paths = include_paths(uc_tt_config)
+    absolute = bool(uc_tt_config.get('ABSOLUTE'))
+    relative = bool(uc_tt_config.get('RELATIVE'))
+
+    def load(name):
+        if os.path.isabs(name):
+            candidates = [name] if absolute else []
+        elif name.startswith(('./', '../')):
+            candidates = [name] if relative else []
+        else:
+            candidates = [os.path.join(dir_path, name) for dir_path in paths]
+
+        for (idx, path) in enumerate(candidates):
+            # every path looked at is a dependency of the render, found or not: a template
+            # that appears earlier in the INCLUDE_PATH changes the output too
+            record_dependency(path)
+            try:
+                st = os.stat(path)
+                with open(path, 'r', encoding='utf-8') as f:
+                    source = f.read()
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                continue
+            return (source, path, _uptodate(path, st, candidates[:idx]))
+        return None
+
+    return load
+
+
+def _uptodate(path, st, shadowing):
+    """ Jinja2 uptodate function, which is called each time a cached template is used
+
+    :param path:        (string)  the template file
+    :param st:          (stat)    its os.stat when it was loaded
+    :param shadowing:   (list)    paths that would be used instead of it, if they existed
+    """
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    def uptodate():
+        for other in shadowing + [path]:
+            record_dependency(other)
+        if any(os.path.isfile(other) for other in shadowing):
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (st.st_mtime_ns, st.st_size) == stamp
+
+    return uptodate
+
+
+def _template_exception(err):
+    if isinstance(err, jinja2.TemplateNotFound):
+        return TemplateException('file', f'{err.name}: not found')
+    message = str(err)
+    if isinstance(err, jinja2.TemplateSyntaxError) and err.filename:
+        message = f'{err.filename} line {err.lineno}: {err.message}'
+    return TemplateException('jinja2', message)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import os
+import sys
+import time
+
+"""
+Render profiles: wall time spent in each template and block during a render
+
+A profile is recorded for each render when 'template-profile' is set in the config. Each
+component (the main template, and every template or BLOCK processed with INCLUDE, PROCESS,
+WRAPPER, etc.) has:
+
+    calls:  number of times it was processed
+    total:  seconds spent in it, including the components it processed
+    self:   seconds spent in it, excluding the components it processed
+
+Profiles can be saved as JSON lines to 'template-profile-dir' and summarised across many
+requests with aggregate_profiles, or from the command line:
+
+    python -m KBaseReport.utils.template_profile /path/to/template-profile-dir
+"""
+
+
+class RenderProfile:
+    """ Times the components processed during one render """
+
+    def __init__(self, template_file):
+        """
+        :param template_file:   (string)  the template being rendered
+        """
+        self.template = template_file
+        self.components = {}
+        self._stack = []
+        self._created = time.time()
+        self._start = time.perf_counter()
+        self._total = None
+
+    def enter(self, name):
+        self._stack.append([name, time.perf_counter(), 0.0])
+
+    def leave(self):
+        (name, start, child_time) = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        component = self.components.setdefault(name, {'calls': 0, 'total': 0.0, 'self': 0.0})
+        component['calls'] += 1
+        # time in a recursive call is already counted by the outer call
+        if not any(frame[0] == name for frame in self._stack):
+            component['total'] += elapsed
+        component['self'] += elapsed - child_time
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def finish(self):
+        self._total = time.perf_counter() - self._start
+
+    def to_dict(self):
+        """ The profile as a JSON-serialisable dict, with components slowest first """
+        return {
+            'template': self.template,
+            'time': self._created,
+            'pid': os.getpid(),
+            'total': self._total,
+            'components': [
+                {'name': name, **values} for (name, values) in sorted(
+                    self.components.items(), key=lambda item: item[1]['total'], reverse=True
+                )
+            ],
+        }
+
+
+def save_profile(profile_dir, profile):
+    """ Append a profile (output of RenderProfile.to_dict) to this process's file in profile_dir """
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f'profile-{os.getpid()}.jsonl')
+    with open(path, 'a') as f:
+        f.write(json.dumps(profile) + '\n')
+
+
+def summarise_profile(profile, limit=5):
+    """ One-line summary of a profile, for logging """
+    components = ', '.join(
+        f"{c['name']} {c['total']:.3f}s ({c['self']:.3f}s self, {c['calls']} calls)"
+        for c in profile['components'][:limit]
+    )
+    return f"template '{profile['template']}' rendered in {profile['total']:.3f}s: {components}"
+
+
+def read_profiles(paths):
+    """ Profiles from .jsonl files, and from .jsonl files in any directories given """
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.endswith('.jsonl'))
+        else:
+            files = [path]
+        for file_path in files:
+            with open(file_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def aggregate_profiles(profiles):
+    """ Totals across many profiles
+
+    :param profiles:    (iterable)  profiles, as produced by RenderProfile.to_dict
+
+    :return:
+    {
+        'renders': {    # by main template
+            'page.tt': {'count': 10, 'total': 1.5, 'mean': 0.15, 'p50': 0.1, 'p95': 0.4,
+                        'max': 0.5},
+            ...
+        },
+        'components': [     # by template or block, most self time first
+            {'name': 'row', 'renders': 10, 'calls': 1000, 'total': 0.9, 'self': 0.8},
+            ...
+        ],
+    }
+    """
+    render_times = {}
+    components = {}
+    for profile in profiles:
+        render_times.setdefault(profile['template'], []).append(profile['total'])
+        for c in profile['components']:
+            agg = components.setdefault(c['name'], {
+                'name': c['name'], 'renders': 0, 'calls': 0, 'total': 0.0, 'self': 0.0,
+            })
+            agg['renders'] += 1
+            for key in ['calls', 'total', 'self']:
+                agg[key] += c[key]
+
+    renders = {}
+    for (template, times) in render_times.items():
+        times.sort()
+        renders[template] = {
+            'count': len(times),
+            'total': sum(times),
+            'mean': sum(times) / len(times),
+            'p50': _percentile(times, 50),
+            'p95': _percentile(times, 95),
+            'max': times[-1],
+        }
+
+    return {
+        'renders': renders,
+        'components': sorted(components.values(), key=lambda c: c['self'], reverse=True),
+    }
+
+
+def _percentile(sorted_values, pct):
+    """ Nearest-rank percentile of a sorted list """
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def format_aggregate(aggregate, top=20):
+    """ Plain-text tables of the output of aggregate_profiles """
+    lines = [f"{'template':<40} {'renders':>8} {'mean s':>9} {'p50 s':>9} {'p95 s':>9} "
+             f"{'max s':>9}"]
+    for (template, r) in sorted(aggregate['renders'].items(), key=lambda item: -item[1]['total']):
+        lines.append(f"{template:<40} {r['count']:>8} {r['mean']:>9.4f} {r['p50']:>9.4f} "
+                     f"{r['p95']:>9.4f} {r['max']:>9.4f}")
+    lines.append('')
+    lines.append(f"{'component':<40} {'renders':>8} {'calls':>9} {'total s':>9} {'self s':>9}")
+    for c in aggregate['components'][:top]:
+        lines.append(f"{c['name']:<40} {c['renders']:>8} {c['calls']:>9} {c['total']:>9.4f} "
+                     f"{c['self']:>9.4f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Summarise template render profiles saved in template-profile-dir')
+    parser.add_argument('paths', nargs='+',
+                        help='profile directories or .jsonl files')
+    parser.add_argument('--template', help='only include renders of this template')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of components to list (default: 20)')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    profiles = read_profiles(args.paths)
+    if args.template:
+        profiles = (p for p in profiles if p['template'] == args.template)
+    aggregate = aggregate_profiles(profiles)
+    if args.json:
+        print(json.dumps(aggregate, indent=2))
+    else:
+        print(format_aggregate(aggregate, args.top))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
-from cerberus import Validator
+from cerberus import TypeDefinition, Validator
 import pprint
 from json import JSONDecodeError
-import json
+
+from . import json_codec
 
 """
 Utilities for validating parameters
@@ -13,94 +14,24 @@ We use the `cerberus` schema validation library: http://docs.python-cerberus.org
 
 def validate_simple_report_params(params):
     """ Validate all parameters to KBaseReportImpl#create """
-    validator = Validator({
-        'workspace_name': {'type': 'string', 'minlength': 1},
-        'workspace_id': {'type': 'integer', 'min': 0},
-        'report': {
-            'type': 'dict',
-            'required': True,
-            'schema': {
-                'text_message': {
-                    'type': 'string',
-                    'nullable': True
-                },
-                'warnings': {
-                    'type': 'list',
-                    'schema': {'type': 'string'}
-                },
-                'objects_created': {
-                    'type': 'list',
-                    'schema': object_created_schema
-                },
-                'direct_html': {
-                    'type': 'string',
-                    'nullable': True,
-                },
-                'template': {
-                    'type': 'dict',
-                    'excludes': 'direct_html',
-                    'schema': template_schema,
-                },
-            }
-        }
-    })
+    validator = _validator('simple_report')
     _require_workspace_id_or_name(params)
     if not validator.validate(params):
         raise TypeError(_format_errors(validator.errors, params))
-    return params
+    # with template_data_json parsed (see ParsedJSON)
+    return validator.document
 
 
 def validate_extended_report_params(params):
     """ Validate all parameters to KBaseReportImpl#create_extended_report """
-    validator = Validator({
-        'workspace_name': {'type': 'string', 'minlength': 1},
-        'workspace_id': {'type': 'integer', 'min': 0},
-        'message': {'type': 'string', 'nullable': True},
-        'objects_created': {
-            'type': 'list',
-            'schema': object_created_schema,
-        },
-        'warnings': {
-            'type': 'list',
-            'schema': {'type': 'string'}
-        },
-        'html_links': {
-            'type': 'list',
-            'schema': extended_file_schema,
-            'dependencies': 'direct_html_link_index',
-            'excludes': 'template',
-        },
-        'file_links': {
-            'type': 'list',
-            'schema': extended_file_schema
-        },
-        'report_object_name': {'type': 'string', 'nullable': True},
-        'html_window_height': {'type': 'integer', 'min': 1, 'nullable': True},
-        'summary_window_height': {'type': 'integer', 'min': 1, 'nullable': True},
-        'direct_html_link_index': {
-            'type': 'integer',
-            'min': 0,
-            'nullable': True,
-            'dependencies': 'html_links',
-            'excludes': 'template',
-        },
-        'direct_html': {
-            'type': 'string',
-            'nullable': True,
-            'excludes': 'template',
-        },
-        'template': {
-            'type': 'dict',
-            'excludes': ['direct_html', 'direct_html_link_index'],
-            'schema': template_schema,
-        },
-    })
+    validator = _validator('extended_report')
     _require_workspace_id_or_name(params)
     _validate_html_index(params.get('html_links', []), params.get('direct_html_link_index'))
 
     if not validator.validate(params):
         raise TypeError(_format_errors(validator.errors, params))
-    return params
+    # with template_data_json parsed (see ParsedJSON)
+    return validator.document
 
 
 def validate_template_params(params, config, with_output_file=False):
@@ -117,48 +48,67 @@ def validate_template_params(params, config, with_output_file=False):
     # ensure that the supplied config has the required values
     validated_config = validate_template_util_config(config)
 
-    scratch_path = validated_config['scratch']
-
-    def path_contains_scratch(field, file_path, error):
-        if file_path.find(scratch_path) != 0:
-            error(field, 'is not in the scratch directory')
-
-    validator = Validator(purge_unknown=True)
-
-    tmpl_validation_schema = {
-        'template_file': {
-            'type': 'string',
-            'minlength': 3,
-            'required': True,
-        },
-        'template_data_json': {
-            'type': 'string',
-            'validator': valid_json,
-        },
-    }
-
-    if with_output_file:
-        tmpl_validation_schema['output_file'] = {
-            'type': 'string',
-            'minlength': len(scratch_path) + 2,
-            'required': True,
-            'validator': path_contains_scratch,
-        }
-
-    if not validator.validate(params, tmpl_validation_schema):
+    validator = _validator('template_output_params' if with_output_file else 'template_params',
+                           purge_unknown=True, scratch=validated_config['scratch'])
+    if not validator.validate(params):
         raise TypeError(_format_errors(validator.errors, params))
 
     validated_params = validator.document
 
     if 'template_data_json' in validated_params:
-        validated_params['template_data'] = json.loads(validated_params['template_data_json'])
-        del validated_params['template_data_json']
+        # parsed while validating, or earlier if the params were validated before
+        validated_params['template_data'] = validated_params.pop('template_data_json').value
+    elif 'template_data_file' in validated_params:
+        # the file is only parsed here, as it may be large
+        try:
+            validated_params['template_data'] = load_template_data_file(
+                validated_params['template_data_file'])
+        except JSONDecodeError as err:
+            raise TypeError(_format_errors({'template_data_file': [
+                'Invalid JSON: ' + err.msg + ' ' + str(err.pos)
+            ]}, params))
+        del validated_params['template_data_file']
     else:
         validated_params['template_data'] = {}
 
+    if 'paginate' in validated_params:
+        data_key = validated_params['paginate']['data_key']
+        if not isinstance(validated_params['template_data'], dict) or \
+                not isinstance(validated_params['template_data'].get(data_key), list):
+            raise TypeError(_format_errors({'paginate': [
+                f"data_key '{data_key}' must be a list in the template data"
+            ]}, params))
+
     return validated_params
 
 
+def load_template_data_file(file_path):
+    """ Load template data from a JSON file, or from an NDJSON file (extension .ndjson or .jsonl)
+
+    The records in an NDJSON file, one JSON value per line, are available to the template as the
+    list `records`. The file is read one line at a time, so only the parsed records are held in
+    memory.
+
+    :param file_path:   (string)  path to the file
+
+    :return:
+    template_data (dict)
+    """
+    with open(file_path, 'r') as f:
+        if not file_path.lower().endswith(NDJSON_EXTENSIONS):
+            return json_codec.load(f)
+
+        records = []
+        for (line_no, line) in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json_codec.loads(line))
+            except JSONDecodeError as err:
+                raise JSONDecodeError(f'{err.msg} on line {line_no}', err.doc, err.pos)
+        return {'records': records}
+
+
 def validate_template_util_config(config):
     """ Ensure that TemplateUtil has the necessary config parameters
 
@@ -167,26 +117,35 @@ def validate_template_util_config(config):
     :return:
     params (dict) - validated params
     """
-    validator = Validator(allow_unknown=True)
+    validator = _validator('template_util_config', allow_unknown=True)
+    if not validator.validate(config):
+        raise TypeError(_format_errors(validator.errors, config))
 
-    config_validation_schema = {
-        'scratch': {
-            'type': 'string',
-            'minlength': 2,
-            'required': True,
-            'validator': valid_dir_path,
-        },
-        'template_toolkit': {
-            'type': 'dict',
-            'required': True,
-        }
-    }
-    if not validator.validate(config, config_validation_schema):
+    return validator.document
+
+
+def validate_upload_config(config):
+    """ Check the file upload settings in the app config, filling in defaults
+
+    :param config:  (dict)  app config; see upload_config_schema for the keys used
+
+    :return:
+    config (dict) - validated config, with values coerced to the correct types
+    """
+    validator = _validator('upload_config', allow_unknown=True)
+    if not validator.validate(config):
         raise TypeError(_format_errors(validator.errors, config))
 
     return validator.document
 
 
+def to_bool(value):
+    """ coerce a config value such as 'true', 'false', '1' or '0' to a boolean """
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 def valid_dir_path(field, dir_path, error):
     """ ensure a directory exists """
     if not os.path.isdir(dir_path):
@@ -207,12 +166,37 @@ def valid_file_or_dir(field, path, error):
 
 
 def valid_json(field, string, error):
+    """ report a JSON string that the 'json' coercion could not parse """
+    if isinstance(string, ParsedJSON):
+        return
     try:
-        json.loads(string)
+        json_codec.loads(string)
     except JSONDecodeError as err:
         error(field, 'Invalid JSON: ' + err.msg + ' ' + str(err.pos))
 
 
+class ParsedJSON:
+    """ A JSON string parameter, parsed while validating the params it is in
+
+    template_data_json strings are replaced by these, so that however many times the params
+    are validated (e.g. by validate_extended_report_params and then by TemplateUtil for each
+    template in file_links), the data is parsed once. The value is handed to the template as
+    it is. str() and repr() give the JSON string, so params print and serialise as before.
+    """
+
+    __slots__ = ('source', 'value')
+
+    def __init__(self, source, value):
+        self.source = source
+        self.value = value
+
+    def __str__(self):
+        return self.source
+
+    def __repr__(self):
+        return repr(self.source)
+
+
 def _require_workspace_id_or_name(params):
     """
     We need either workspace_id or workspace_name, but we don't need both
@@ -273,6 +257,59 @@ def _format_errors(errors, params):
     ])
 
 
+class _Validator(Validator):
+    """ Validator with rules for paths in the scratch directory, which is given as `scratch`,
+    and a 'json' coercion that parses JSON strings into ParsedJSONs
+    """
+
+    # a ParsedJSON is still the string it was parsed from
+    types_mapping = {
+        **Validator.types_mapping,
+        'string': TypeDefinition('string', (str, ParsedJSON), ()),
+    }
+
+    def __init__(self, *args, **kwargs):
+        self.scratch = kwargs.get('scratch')
+        super().__init__(*args, **kwargs)
+
+    def _normalize_coerce_json(self, value):
+        if not isinstance(value, str):
+            return value
+        try:
+            return ParsedJSON(value, json_codec.loads(value))
+        except JSONDecodeError:
+            # left as it is for valid_json to report
+            return value
+
+    def _validator_in_scratch(self, field, value):
+        if value.find(self.scratch) != 0:
+            self._error(field, 'is not in the scratch directory')
+
+    def _validator_file_in_scratch(self, field, value):
+        """ a file in the scratch directory, rather than the directory itself """
+        if len(value) < len(self.scratch) + 2:
+            self._error(field, f'min length is {len(self.scratch) + 2}')
+        self._validator_in_scratch(field, value)
+
+
+def _prebuilt(schema):
+    """ Expand and check a schema once, rather than every time a validator is made with it """
+    return _Validator(schema).schema.schema
+
+
+def _validator(name, **config):
+    """ A validator for one of the schemas in _prebuilt_schemas
+
+    Validators keep the state of the document being validated, so every call gets a new one;
+    the prebuilt schema is only read, and is shared between threads. It is set as a plain dict,
+    as cerberus does for the schemas of child validators: given a DefinitionSchema, cerberus
+    expands and checks the schema again each time it normalises a document.
+    """
+    validator = _Validator(**config)
+    validator._schema = _prebuilt_schemas[name]
+    return validator
+
+
 # Re-used validations
 
 # Workspace object (corresponding to the KIDL spec's WorkspaceObject)
@@ -305,8 +342,41 @@ template_schema = {
     },
     'template_data_json': {
         'type': 'string',
+        'coerce': 'json',
         'validator': valid_json,
     },
+    # parsed when the template is rendered
+    'template_data_file': {
+        'type': 'string',
+        'excludes': 'template_data_json',
+        'validator': valid_file_path,
+    },
+}
+
+# template_data_file extensions for files with one JSON value per line
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+# split a list in the template data across several output files
+paginate_schema = {
+    'type': 'dict',
+    'schema': {
+        'data_key': {
+            'type': 'string',
+            'required': True,
+            'minlength': 1,
+        },
+        'page_size': {
+            'type': 'integer',
+            'required': True,
+            'min': 1,
+        },
+    },
+}
+
+# templates for file_links and html_links, which can be paginated
+linked_template_schema = {
+    **template_schema,
+    'paginate': paginate_schema,
 }
 
 # Type validation for the extended report's File (see KIDL spec)
@@ -333,7 +403,7 @@ extended_file_schema = {
             'type': 'dict',
             'excludes': ['path', 'shock_id'],
             'required': True,
-            'schema': template_schema,
+            'schema': linked_template_schema,
         },
         'description': {
             'type': 'string',
@@ -345,3 +415,333 @@ extended_file_schema = {
         },
     }
 }
+
+# File upload settings from the [KBaseReport] section of deploy.cfg
+upload_config_schema = {
+    # maximum number of concurrent DataFileUtil calls per report
+    'upload-concurrency': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 8,
+    },
+    # maximum number of files uploaded in a single DataFileUtil.file_to_shock_mass call
+    'upload-batch-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 100,
+    },
+    # uploads bigger than upload-small-file-size only start while the total size of those
+    # in flight stays under this many bytes
+    'upload-max-bytes-in-flight': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 2 * 1024 ** 3,
+    },
+    # uploads up to this many bytes are not counted against upload-max-bytes-in-flight
+    'upload-small-file-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 16 * 1024 ** 2,
+    },
+    # number of times a DataFileUtil call that failed with a transient error is retried
+    'upload-retries': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 3,
+    },
+    # seconds to wait before the first retry; doubled for each retry after that
+    'upload-retry-delay': {
+        'type': 'float',
+        'coerce': float,
+        'min': 0,
+        'default': 1.0,
+    },
+    # upper limit on the wait between retries, in seconds
+    'upload-retry-max-delay': {
+        'type': 'float',
+        'coerce': float,
+        'min': 0,
+        'default': 30.0,
+    },
+    # record a summary of the time spent on each link in the report object's metadata
+    'upload-timings-in-meta': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # directory for the index of uploaded content; the upload cache is off unless this is set
+    'upload-cache-dir': {
+        'type': 'string',
+        'nullable': True,
+        'default': None,
+    },
+    # number of entries kept in the upload cache; 0 turns the cache off
+    'upload-cache-max-entries': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 10000,
+    },
+    # upload cache entries that have not been used for this many days are discarded
+    'upload-cache-max-age-days': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 30,
+    },
+    # directory manifests to keep for incremental html_links uploads; 0 turns them off
+    'upload-manifest-max-entries': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 0,
+    },
+    # number of threads used to zip directories locally; 0 leaves the zipping to DataFileUtil
+    'zip-workers': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 0,
+    },
+    # minify the HTML, CSS and JavaScript in html_links before they are zipped
+    'html-minify': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # add a gzipped copy of each text file in html_links (e.g. index.html.gz)
+    'html-gzip': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # inline small assets and merge alike pages in html_links into bundles (see bundle_utils)
+    'html-bundle': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # images, style sheets and scripts up to this many bytes are inlined; 0 turns it off
+    'html-bundle-inline-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 4096,
+    },
+    # number of pages in each bundle; 1 turns page bundling off
+    'html-bundle-page-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 500,
+    },
+}
+
+# Top-level validations
+
+# KBaseReportImpl#create
+simple_report_schema = {
+    'workspace_name': {'type': 'string', 'minlength': 1},
+    'workspace_id': {'type': 'integer', 'min': 0},
+    'report': {
+        'type': 'dict',
+        'required': True,
+        'schema': {
+            'text_message': {
+                'type': 'string',
+                'nullable': True
+            },
+            'warnings': {
+                'type': 'list',
+                'schema': {'type': 'string'}
+            },
+            'objects_created': {
+                'type': 'list',
+                'schema': object_created_schema
+            },
+            'direct_html': {
+                'type': 'string',
+                'nullable': True,
+            },
+            'template': {
+                'type': 'dict',
+                'excludes': 'direct_html',
+                'schema': template_schema,
+            },
+        }
+    }
+}
+
+# KBaseReportImpl#create_extended_report
+extended_report_schema = {
+    'workspace_name': {'type': 'string', 'minlength': 1},
+    'workspace_id': {'type': 'integer', 'min': 0},
+    'message': {'type': 'string', 'nullable': True},
+    'objects_created': {
+        'type': 'list',
+        'schema': object_created_schema,
+    },
+    'warnings': {
+        'type': 'list',
+        'schema': {'type': 'string'}
+    },
+    'html_links': {
+        'type': 'list',
+        'schema': extended_file_schema,
+        'dependencies': 'direct_html_link_index',
+        'excludes': 'template',
+    },
+    'file_links': {
+        'type': 'list',
+        'schema': extended_file_schema
+    },
+    'report_object_name': {'type': 'string', 'nullable': True},
+    'html_window_height': {'type': 'integer', 'min': 1, 'nullable': True},
+    'summary_window_height': {'type': 'integer', 'min': 1, 'nullable': True},
+    'direct_html_link_index': {
+        'type': 'integer',
+        'min': 0,
+        'nullable': True,
+        'dependencies': 'html_links',
+        'excludes': 'template',
+    },
+    'direct_html': {
+        'type': 'string',
+        'nullable': True,
+        'excludes': 'template',
+    },
+    'template': {
+        'type': 'dict',
+        'excludes': ['direct_html', 'direct_html_link_index'],
+        'schema': template_schema,
+    },
+}
+
+# TemplateUtil templates
+template_params_schema = {
+    'template_file': {
+        'type': 'string',
+        'minlength': 3,
+        'required': True,
+    },
+    'template_data_json': {
+        'type': 'string',
+        'coerce': 'json',
+        'validator': valid_json,
+    },
+    'template_data_file': {
+        'type': 'string',
+        'excludes': 'template_data_json',
+        'validator': [valid_file_path, 'in_scratch'],
+    },
+}
+
+# TemplateUtil templates rendered to a file
+template_output_params_schema = {
+    **template_params_schema,
+    'output_file': {
+        'type': 'string',
+        'required': True,
+        'validator': 'file_in_scratch',
+    },
+    'paginate': paginate_schema,
+}
+
+# TemplateUtil config
+template_util_config_schema = {
+    'scratch': {
+        'type': 'string',
+        'minlength': 2,
+        'required': True,
+        'validator': valid_dir_path,
+    },
+    'template_toolkit': {
+        'type': 'dict',
+        'required': True,
+    },
+    # engine for templates whose extension does not pick one; see template_backends
+    'template-backend': {
+        'type': 'string',
+        'allowed': ['tt', 'jinja2'],
+        'default': 'tt',
+    },
+    # number of compiled templates kept in memory per TT config; 0 turns this off
+    'template-cache-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 256,
+    },
+    # number of processes render_template_list_to_files renders across; 0 or 1 renders
+    # the templates one at a time
+    'template-render-workers': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 0,
+    },
+    # write template output to files as it is produced, rather than all at the end
+    'template-stream-output': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # compile the templates on the INCLUDE_PATH when the server starts
+    'template-warm-up': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # directory for compiled templates shared between processes; None turns this off
+    'template-cache-dir': {
+        'type': 'string',
+        'nullable': True,
+        'default': None,
+    },
+    # record the time spent in each template and block while rendering
+    'template-profile': {
+        'type': 'boolean',
+        'coerce': to_bool,
+        'default': False,
+    },
+    # directory to save render profiles to; None only logs them
+    'template-profile-dir': {
+        'type': 'string',
+        'nullable': True,
+        'default': None,
+    },
+    # number of rendered outputs kept in memory; 0 turns this off
+    'template-output-cache-size': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 0,
+        'default': 0,
+    },
+    # directory for rendered outputs shared between processes; None turns this off
+    'template-output-cache-dir': {
+        'type': 'string',
+        'nullable': True,
+        'default': None,
+    },
+    # size in MB that the rendered output directory is cut back to
+    'template-output-cache-max-mb': {
+        'type': 'integer',
+        'coerce': int,
+        'min': 1,
+        'default': 1024,
+    },
+}
+
+_prebuilt_schemas = {
+    'simple_report': _prebuilt(simple_report_schema),
+    'extended_report': _prebuilt(extended_report_schema),
+    'template_params': _prebuilt(template_params_schema),
+    'template_output_params': _prebuilt(template_output_params_schema),
+    'template_util_config': _prebuilt(template_util_config_schema),
+    'upload_config': _prebuilt(upload_config_schema),
+}
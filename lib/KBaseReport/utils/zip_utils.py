@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Utilities for packing directories into zip archives locally
+Members are compressed in parallel and written to the archive as they become ready, so the
+archive is streamed to disk and only a bounded number of members are held at any time.
+Members that have not changed since a previous archive can be copied from it as-is.
+"""
+
+# file types that are already compressed and are stored in the archive as-is
+STORED_EXTENSIONS = {
+    '.7z', '.bz2', '.bam', '.gif', '.gz', '.jpeg', '.jpg', '.png', '.svgz', '.tgz', '.webp',
+    '.woff', '.woff2', '.xz', '.zip', '.zst',
+}
+
+# compressed members smaller than this are kept in memory rather than spooled to disk
+_IN_MEMORY_LIMIT = 1024 * 1024
+_CHUNK_SIZE = 1024 * 1024
+
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+# sizes, offsets and counts at or above these limits need zip64 records
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP_FILECOUNT_LIMIT = 0xFFFF
+# placeholder values written in the standard records when the zip64 record holds the value
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP_FILECOUNT_MARKER = 0xFFFF
+
+
+def zip_directory(src_dir, zip_path, executor=None, workers=4, compresslevel=6,
+                  reuse_from=None, unchanged=()):
+    """ Zip the contents of a directory, with archive paths relative to the directory
+
+    :param src_dir:         (string)  directory to pack
+    :param zip_path:        (string)  path of the archive to create
+    :param executor:        (Executor)  pool to compress members in (optional)
+    :param workers:         (int)     number of workers in the pool
+    :param compresslevel:   (int)     zlib compression level
+    :param reuse_from:      (string)  a previous archive of the same directory (optional)
+    :param unchanged:       (set)     archive paths of files whose content has not changed
+                                      since `reuse_from` was made; their compressed data is
+                                      copied across from the old archive
+
+    :return:
+    zip_path (string)   the path to the archive
+    """
+    entries = _list_entries(src_dir)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(zip_path))
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    previous = _open_previous(reuse_from, unchanged)
+    try:
+        with open(zip_path, 'wb') as out:
+            writer = _ZipWriter(out)
+            # bound the number of compressed members waiting to be written
+            window = 4 * workers
+            members = _ordered_map(
+                executor,
+                lambda entry: _prepare_member(entry, tmp_dir, compresslevel, previous),
+                entries, window
+            )
+            for member in members:
+                writer.write_member(member)
+            writer.close()
+    finally:
+        if own_executor:
+            executor.shutdown()
+        if previous:
+            os.close(previous['fd'])
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return zip_path
+
+
+def _open_previous(reuse_from, unchanged):
+    """
+    Open a previous archive for copying members from
+    The file is read with os.pread on a single descriptor, so the archive can safely be
+    replaced or deleted by another process while we are using it.
+    :return: dict with the descriptor and the ZipInfo of each reusable member, or None
+    """
+    if not reuse_from or not unchanged:
+        return None
+    try:
+        fd = os.open(reuse_from, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        with zipfile.ZipFile(os.fdopen(os.dup(fd), 'rb')) as zf:
+            infos = {info.filename: info for info in zf.infolist()
+                     if info.filename in unchanged and not info.is_dir()}
+    except (zipfile.BadZipFile, OSError):
+        os.close(fd)
+        return None
+    return {'fd': fd, 'infos': infos}
+
+
+def _list_entries(src_dir):
+    """ All directories and files under src_dir, in a stable order """
+    entries = []
+    for (root, dirs, files) in os.walk(src_dir):
+        dirs.sort()
+        for name in dirs:
+            path = os.path.join(root, name)
+            entries.append((os.path.relpath(path, src_dir) + '/', path))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            entries.append((os.path.relpath(path, src_dir), path))
+    return entries
+
+
+def _ordered_map(executor, func, items, window):
+    """ executor.map, but with at most `window` items submitted ahead of the consumer """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _prepare_member(entry, tmp_dir, compresslevel, previous=None):
+    """ Compress (or just checksum) one archive member """
+    (arcname, path) = entry
+    st = os.stat(path)
+    member = {
+        'arcname': arcname,
+        'mtime': st.st_mtime,
+        'mode': st.st_mode,
+        'crc': 0,
+        'file_size': 0,
+        'compress_size': 0,
+        'method': _ZIP_STORED,
+        'data': b'',
+        'data_path': None,
+        'data_range': None,
+        'remove': False,
+    }
+    if arcname.endswith('/'):
+        return member
+
+    if previous and arcname in previous['infos']:
+        info = previous['infos'][arcname]
+        # skip the old local header to find the start of the compressed data
+        header = os.pread(previous['fd'], 30, info.header_offset)
+        (name_len, extra_len) = struct.unpack('<HH', header[26:30])
+        member.update({
+            'crc': info.CRC,
+            'file_size': info.file_size,
+            'compress_size': info.compress_size,
+            'method': info.compress_type,
+            'data_range': (previous['fd'], info.header_offset + 30 + name_len + extra_len),
+        })
+        return member
+
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        (crc, file_size) = (0, 0)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+        member.update({
+            'crc': crc,
+            'file_size': file_size,
+            'compress_size': file_size,
+            'data_path': path,
+        })
+        return member
+
+    member['method'] = _ZIP_DEFLATED
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    if st.st_size <= _IN_MEMORY_LIMIT:
+        with open(path, 'rb') as f:
+            data = f.read()
+        member['data'] = compressor.compress(data) + compressor.flush()
+        member.update({
+            'crc': zlib.crc32(data),
+            'file_size': len(data),
+            'compress_size': len(member['data']),
+        })
+        return member
+
+    (crc, file_size) = (0, 0)
+    (fd, data_path) = tempfile.mkstemp(dir=tmp_dir)
+    with open(path, 'rb') as f, os.fdopen(fd, 'wb') as tmp:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            tmp.write(compressor.compress(chunk))
+        tmp.write(compressor.flush())
+        compress_size = tmp.tell()
+    member.update({
+        'crc': crc,
+        'file_size': file_size,
+        'compress_size': compress_size,
+        'data_path': data_path,
+        'remove': True,
+    })
+    return member
+
+
+def _dos_date_time(mtime):
+    t = time.localtime(mtime)
+    year = min(max(t.tm_year, 1980), 2107)
+    return (
+        (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+        t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+    )
+
+
+class _ZipWriter:
+    """ Minimal zip archive writer for members whose data has already been compressed """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.central_dir = []
+
+    def write_member(self, member):
+        name = member['arcname'].encode('utf-8')
+        (dos_date, dos_time) = _dos_date_time(member['mtime'])
+        offset = self.fh.tell()
+        zip64 = member['file_size'] >= _ZIP64_LIMIT or member['compress_size'] >= _ZIP64_LIMIT
+
+        extra = b''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, member['file_size'], member['compress_size'])
+        self.fh.write(struct.pack(
+            '<4sHHHHHLLLHH', b'PK\x03\x04',
+            45 if zip64 else 20, 0x800, member['method'], dos_time, dos_date, member['crc'],
+            _ZIP64_MARKER if zip64 else member['compress_size'],
+            _ZIP64_MARKER if zip64 else member['file_size'],
+            len(name), len(extra)
+        ))
+        self.fh.write(name)
+        self.fh.write(extra)
+
+        if member['data_path']:
+            with open(member['data_path'], 'rb') as f:
+                shutil.copyfileobj(f, self.fh, _CHUNK_SIZE)
+            if member['remove']:
+                os.remove(member['data_path'])
+        elif member['data_range']:
+            (fd, position) = member['data_range']
+            remaining = member['compress_size']
+            while remaining:
+                chunk = os.pread(fd, min(remaining, _CHUNK_SIZE), position)
+                if not chunk:
+                    raise IOError('previous archive is truncated')
+                self.fh.write(chunk)
+                position += len(chunk)
+                remaining -= len(chunk)
+        else:
+            self.fh.write(member['data'])
+            # only the metadata is needed for the central directory
+            member['data'] = b''
+
+        self.central_dir.append((member, name, dos_date, dos_time, offset, zip64))
+
+    def close(self):
+        cd_offset = self.fh.tell()
+        for (member, name, dos_date, dos_time, offset, zip64) in self.central_dir:
+            extra_fields = []
+            if zip64:
+                extra_fields += [member['file_size'], member['compress_size']]
+            if offset >= _ZIP64_LIMIT:
+                extra_fields.append(offset)
+            extra = b''
+            if extra_fields:
+                extra = struct.pack('<HH' + 'Q' * len(extra_fields), 1, 8 * len(extra_fields),
+                                    *extra_fields)
+            is_dir = member['arcname'].endswith('/')
+            external_attr = (stat.S_IMODE(member['mode']) |
+                             (stat.S_IFDIR if is_dir else stat.S_IFREG)) << 16
+            if is_dir:
+                external_attr |= 0x10
+            self.fh.write(struct.pack(
+                '<4sHHHHHHLLLHHHHHLL', b'PK\x01\x02',
+                3 << 8 | 45, 45 if extra_fields else 20, 0x800, member['method'],
+                dos_time, dos_date, member['crc'],
+                _ZIP64_MARKER if zip64 else member['compress_size'],
+                _ZIP64_MARKER if zip64 else member['file_size'],
+                len(name), len(extra), 0, 0, 0, external_attr,
+                _ZIP64_MARKER if offset >= _ZIP64_LIMIT else offset
+            ))
+            self.fh.write(name)
+            self.fh.write(extra)
+
+        cd_end = self.fh.tell()
+        cd_size = cd_end - cd_offset
+        count = len(self.central_dir)
+        if count >= _ZIP_FILECOUNT_LIMIT or cd_offset >= _ZIP64_LIMIT or \
+                cd_size >= _ZIP64_LIMIT:
+            # zip64 end of central directory record and locator
+            self.fh.write(struct.pack('<4sQHHLLQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                                      count, count, cd_size, cd_offset))
+            self.fh.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, cd_end, 1))
+            (count, cd_size, cd_offset) = (_ZIP_FILECOUNT_MARKER, _ZIP64_MARKER, _ZIP64_MARKER)
+        self.fh.write(struct.pack(
+            '<4sHHHHLLH', b'PK\x05\x06', 0, 0, count, count, cd_size, cd_offset, 0
+        ))
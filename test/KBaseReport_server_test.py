@@ -284,6 +284,16 @@ class KBaseReportTest(unittest.TestCase):
         }
         self.check_validation_errors(params, ['template.*?must be of dict type'])
 
+        # the report template is rendered to direct_html, so it cannot be paginated
+        params = {
+            'workspace_id': self.getWsID(),
+            'template': {
+                'template_file': 'my_template_file.txt',
+                'paginate': {'data_key': 'genes', 'page_size': 10},
+            },
+        }
+        self.check_validation_errors(params, ["template.*?'paginate'.*?unknown field"])
+
         # no template + direct_html
         params = {
             'workspace_id': self.getWsID(),
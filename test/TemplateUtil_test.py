@@ -5,14 +5,24 @@ import os
 import re
 import unittest
 
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from configparser import ConfigParser
 from template import Template
-from template.util import TemplateException
+from template.util import StringBuffer, TemplateException
+from unittest.mock import patch
 from uuid import uuid4
 
 from KBaseReport.KBaseReportImpl import KBaseReport
-from KBaseReport.utils.TemplateUtil import TemplateUtil
-from KBaseReport.utils.validation_utils import validate_template_params
+from KBaseReport.utils.TemplateUtil import StreamingOutput, TemplateUtil, TemplateRenderError
+from KBaseReport.utils.template_backends import JinjaBackend
+from KBaseReport.utils.template_profile import aggregate_profiles, read_profiles
+from KBaseReport.utils import json_codec, validation_utils
+from KBaseReport.utils.validation_utils import (
+    ParsedJSON,
+    validate_extended_report_params,
+    validate_template_params,
+)
 
 
 def get_test_data():
@@ -283,6 +293,265 @@ class TestTemplateUtils(unittest.TestCase):
         tmpl_engine = tmpl_util.template_engine()
         self.assertIsInstance(tmpl_engine, Template)
 
+    def test_compiled_template_cache(self):
+        """ compiled templates are cached in memory and on disk, and changes are picked up """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'main.tt'), 'w') as f:
+            f.write('<h1>[% title %]</h1>[% INCLUDE inc.tt %]')
+        with open(os.path.join(tmpl_dir, 'inc.tt'), 'w') as f:
+            f.write('include v1')
+
+        config = {
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+            'template-cache-dir': os.path.join(tmpl_dir, 'cache'),
+        }
+        tmpl_util = TemplateUtil(config)
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'one'}),
+                         '<h1>one</h1>include v1')
+
+        # a change to an included template is picked up straight away
+        with open(os.path.join(tmpl_dir, 'inc.tt'), 'w') as f:
+            f.write('include v2')
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'two'}),
+                         '<h1>two</h1>include v2')
+
+        # another TemplateUtil with the same config uses the templates compiled on disk
+        with patch('template.parser.Parser.parse', side_effect=AssertionError('parsed')):
+            self.assertEqual(TemplateUtil(config)._render_template('main.tt', {'title': '3'}),
+                             '<h1>3</h1>include v2')
+
+    def test_render_cache(self):
+        """ rendered output is reused until the data or any template it loads changes """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'main.tt'), 'w') as f:
+            f.write('<h1>[% title %]</h1>[% INCLUDE inc.tt %]')
+        with open(os.path.join(tmpl_dir, 'inc.tt'), 'w') as f:
+            f.write('include v1')
+
+        config = {
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+            'template-output-cache-size': 4,
+            'template-output-cache-dir': os.path.join(tmpl_dir, 'output_cache'),
+        }
+        tmpl_util = TemplateUtil(config)
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'one'}),
+                         '<h1>one</h1>include v1')
+        with patch('template.Template.process', side_effect=AssertionError('rendered')):
+            self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'one'}),
+                             '<h1>one</h1>include v1')
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'two'}),
+                         '<h1>two</h1>include v1')
+
+        # a change to an included template is picked up straight away
+        with open(os.path.join(tmpl_dir, 'inc.tt'), 'w') as f:
+            f.write('include version 2')
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'one'}),
+                         '<h1>one</h1>include version 2')
+        self.assertEqual(tmpl_util.render_cache_stats(),
+                         {'hits': 1, 'misses': 3, 'disk_hits': 0, 'evictions': 0})
+
+        # another TemplateUtil with the same config uses the output saved on disk, including
+        # when streaming to a file
+        tmpl_util = TemplateUtil({**config, 'template-stream-output': True})
+        output_file = os.path.join(self.scratch, 'cached-' + str(uuid4()) + '.txt')
+        with patch('template.Template.process', side_effect=AssertionError('rendered')):
+            self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'one'}),
+                             '<h1>one</h1>include version 2')
+            tmpl_util.render_template_to_file({
+                'template_file': 'main.tt',
+                'template_data_json': '{"title": "one"}',
+                'output_file': output_file,
+            })
+        self.check_file_contents(output_file, '<h1>one</h1>include version 2')
+        self.assertEqual(tmpl_util.render_cache_stats(),
+                         {'hits': 2, 'misses': 0, 'disk_hits': 1, 'evictions': 0})
+
+        # the cache is off by default
+        self.assertIsNone(TemplateUtil({
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+        }).render_cache_stats())
+
+    def test_render_profiles(self):
+        """ the time spent in each template and block can be recorded and summarised """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'page.tt'), 'w') as f:
+            f.write('[% BLOCK row %]<tr>[% r %]</tr>[% END %]'
+                    '[% INCLUDE header.tt %][% FOREACH r IN rows %][% PROCESS row %][% END %]')
+        with open(os.path.join(tmpl_dir, 'header.tt'), 'w') as f:
+            f.write('<h1>[% title %]</h1>')
+
+        profile_dir = os.path.join(tmpl_dir, 'profiles')
+        tmpl_util = TemplateUtil({
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+            'template-profile': True,
+            'template-profile-dir': profile_dir,
+        })
+        with tmpl_util.collect_profiles() as profiles:
+            tmpl_util._render_template('page.tt', {'title': 'x', 'rows': [1, 2, 3]})
+            tmpl_util._render_template('page.tt', {'title': 'y', 'rows': [4]})
+
+        self.assertEqual(len(profiles), 2)
+        self.assertEqual(profiles[0]['template'], 'page.tt')
+        calls = {c['name']: c['calls'] for c in profiles[0]['components']}
+        self.assertEqual(calls, {'page.tt': 1, 'header.tt': 1, 'row': 3})
+        page = profiles[0]['components'][0]
+        self.assertEqual(page['name'], 'page.tt')
+        self.assertLess(page['self'], page['total'])
+
+        # the saved profiles can be aggregated
+        aggregate = aggregate_profiles(read_profiles([profile_dir]))
+        self.assertEqual(aggregate['renders']['page.tt']['count'], 2)
+        rows = [c for c in aggregate['components'] if c['name'] == 'row'][0]
+        self.assertEqual((rows['renders'], rows['calls']), (2, 4))
+
+        # nothing is recorded unless template-profile is set
+        tmpl_util = TemplateUtil({
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+        })
+        with tmpl_util.collect_profiles() as profiles:
+            tmpl_util._render_template('page.tt', {'title': 'x', 'rows': [1, 2, 3]})
+        self.assertEqual(profiles, [])
+
+    def test_warm_up(self):
+        """ templates on the INCLUDE_PATH are compiled ahead of the first render """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(os.path.join(tmpl_dir, 'views'))
+        files = {
+            'page.tt': 'page [% INCLUDE view.tt %]',
+            'style.css': 'not a template',
+            os.path.join('views', 'view.tt'): 'view',
+            os.path.join('views', 'broken.tt'): '[% IF %]',
+        }
+        for (name, content) in files.items():
+            with open(os.path.join(tmpl_dir, name), 'w') as f:
+                f.write(content)
+
+        tmpl_util = TemplateUtil({
+            'scratch': self.scratch,
+            'template_toolkit': {
+                'INCLUDE_PATH': tmpl_dir + ':' + os.path.join(tmpl_dir, 'views'),
+            },
+        })
+        warm_up = tmpl_util.warm_up()
+        self.assertEqual(warm_up['compiled'], 2)
+        self.assertEqual(list(warm_up['failed'].keys()),
+                         [os.path.join(tmpl_dir, 'views', 'broken.tt')])
+        self.assertRegex(warm_up['failed'][os.path.join(tmpl_dir, 'views', 'broken.tt')],
+                         'parse error')
+
+        # rendering uses the compiled templates
+        with patch('template.parser.Parser.parse', side_effect=AssertionError('parsed')):
+            self.assertEqual(tmpl_util._render_template('page.tt'), 'page view')
+            self.assertEqual(tmpl_util._render_template('view.tt'), 'view')
+
+    def test_template_engine_pool(self):
+        """ renders with different configs can run at once without replacing each other """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'main.tt'), 'w') as f:
+            f.write('  <h1>[% title %]</h1>  ')
+
+        tmpl_util = TemplateUtil({
+            'scratch': self.scratch,
+            'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+        })
+        trim_config = {'include_path': tmpl_dir, 'trim': 1}
+
+        def render(n):
+            if n % 2:
+                return tmpl_util._render_template('main.tt', {'title': n}, trim_config)
+            return tmpl_util._render_template('main.tt', {'title': n})
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            output = list(executor.map(render, range(40)))
+
+        for (n, tmpl_str) in enumerate(output):
+            if n % 2:
+                self.assertEqual(tmpl_str, f'<h1>{n}</h1>')
+            else:
+                self.assertEqual(tmpl_str, f'  <h1>{n}</h1>  ')
+
+        # engines are kept for reuse, no more than one per concurrent render for each config
+        self.assertLessEqual(tmpl_util._engines.size({'INCLUDE_PATH': tmpl_dir, 'TRIM': 1}), 4)
+        self.assertLessEqual(tmpl_util._engines.size(), 8)
+        self.assertEqual(tmpl_util._render_template('main.tt', {'title': 'x'}, trim_config),
+                         '<h1>x</h1>')
+
+    @unittest.skipUnless(JinjaBackend.available(), 'Jinja2 is not installed')
+    def test_jinja_backend(self):
+        """ Jinja2 templates are rendered by the Jinja2 backend """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(os.path.join(tmpl_dir, 'views'))
+        files = {
+            'page.html.j2': "  {% include 'header.j2' %}"
+                            "{% for g in genes %}<li>{{ g }}</li>{% endfor %}  ",
+            'plain.html': '{{ title }}',
+            os.path.join('views', 'header.j2'): '<h1>{{ title }}</h1>',
+            os.path.join('views', 'broken.j2'): '{% for %}',
+        }
+        for (name, content) in files.items():
+            with open(os.path.join(tmpl_dir, name), 'w') as f:
+                f.write(content)
+
+        config = {
+            'scratch': self.scratch,
+            'template_toolkit': {
+                'INCLUDE_PATH': tmpl_dir + ':' + os.path.join(tmpl_dir, 'views'),
+                'ABSOLUTE': 1,
+                'TRIM': 1,
+            },
+            'template-output-cache-size': 8,
+        }
+        tmpl_util = TemplateUtil(config)
+        data = {'title': 'Genes', 'genes': [1, 2]}
+        expected = '<h1>Genes</h1><li>1</li><li>2</li>'
+        self.assertEqual(tmpl_util._render_template('page.html.j2', data), expected)
+
+        # streamed output is the same
+        output_file = os.path.join(self.scratch, 'jinja-' + str(uuid4()) + '.html')
+        TemplateUtil({**config, 'template-stream-output': True}).render_template_to_file({
+            'template_file': os.path.join(tmpl_dir, 'page.html.j2'),
+            'template_data_json': json.dumps(data),
+            'output_file': output_file,
+        })
+        self.check_file_contents(output_file, expected)
+
+        # cached output is not used once an included template changes
+        with open(os.path.join(tmpl_dir, 'views', 'header.j2'), 'w') as f:
+            f.write('<h2>{{ title }}</h2>')
+        self.assertEqual(tmpl_util._render_template('page.html.j2', data),
+                         expected.replace('h1', 'h2'))
+
+        # errors are raised as TemplateExceptions
+        with self.assertRaisesRegex(TemplateException, 'file error - missing.j2: not found'):
+            tmpl_util._render_template('missing.j2')
+        with self.assertRaisesRegex(TemplateException, 'jinja2 error - .*?broken.j2 line 1'):
+            tmpl_util._render_template('broken.j2')
+
+        # other templates go to the 'template-backend' backend
+        self.assertEqual(tmpl_util._render_template('plain.html', data), '{{ title }}')
+        jinja_util = TemplateUtil({**config, 'template-backend': 'jinja2'})
+        self.assertEqual(jinja_util._render_template('plain.html', data), 'Genes')
+
+        warm_up = jinja_util.warm_up()
+        self.assertEqual(warm_up['compiled'], 2)
+        self.assertEqual(list(warm_up['failed'].keys()),
+                         [os.path.join(tmpl_dir, 'views', 'broken.j2')])
+
     def test_validate_template_params_errors(self):
         """ test TemplateUtil input validation errors """
 
@@ -360,6 +629,177 @@ class TestTemplateUtils(unittest.TestCase):
             expected
         )
 
+    def test_template_data_file(self):
+        """ template data can be read from a JSON or NDJSON file in scratch """
+
+        data_dir = os.path.join(self.scratch, 'data-' + str(uuid4()))
+        os.makedirs(data_dir)
+        json_file = os.path.join(data_dir, 'data.json')
+        with open(json_file, 'w') as f:
+            json.dump(TEST_DATA['title'], f)
+        ndjson_file = os.path.join(data_dir, 'data.ndjson')
+        with open(ndjson_file, 'w') as f:
+            f.write('{"id": 1}\n\n{"id": 2}\n')
+
+        params = {
+            'template_file': TEST_DATA['template'],
+            'template_data_file': json_file,
+            'output_file': TEST_DATA['output_file'],
+        }
+        self.assertEqual(
+            validate_template_params(params, self.getTmpl().config, True),
+            {
+                'template_file': TEST_DATA['template'],
+                'template_data': TEST_DATA['title'],
+                'output_file': TEST_DATA['output_file'],
+            }
+        )
+        self.assertEqual(
+            validate_template_params({**params, 'template_data_file': ndjson_file},
+                                     self.getTmpl().config, True)['template_data'],
+            {'records': [{'id': 1}, {'id': 2}]}
+        )
+
+        tmpl_util = self.getTmpl()
+        self.assertEqual(tmpl_util.render_template_to_file(params),
+                         {'path': TEST_DATA['output_file']})
+        self.check_file_contents(TEST_DATA['output_file'],
+                                 TEST_DATA['render_test']['title']['abs_path'])
+
+        invalid_file = os.path.join(data_dir, 'invalid.jsonl')
+        with open(invalid_file, 'w') as f:
+            f.write('{"id": 1}\n{"id":\n')
+        outside_scratch = os.path.join(TEST_DATA['template_dir'], 'data.json')
+        errors = [
+            ({'template_data_file': invalid_file}, 'Invalid JSON: .*? on line 2'),
+            ({'template_data_file': os.path.join(data_dir, 'missing.json')},
+             'does not exist on filesystem'),
+            ({'template_data_file': outside_scratch}, 'is not in the scratch directory'),
+            ({'template_data_json': TEST_DATA['title_json']},
+             "'template_data_json' must not be present with 'template_data_file'"),
+        ]
+        for (error_params, regex) in errors:
+            with self.subTest(regex):
+                with self.assertRaisesRegex(TypeError, regex):
+                    validate_template_params({**params, **error_params},
+                                             self.getTmpl().config, True)
+
+    def test_template_data_parsed_once(self):
+        """ template_data_json is parsed once, however many times it is validated """
+        config = self.getTmpl().config
+        params = {
+            'workspace_id': 12345,
+            'template': {
+                'template_file': TEST_DATA['template'],
+                'template_data_json': TEST_DATA['title_json'],
+            },
+            'file_links': [{
+                'name': 'content.html',
+                'template': {
+                    'template_file': TEST_DATA['template'],
+                    'template_data_json': TEST_DATA['content_json'],
+                },
+            }],
+        }
+        with patch.object(validation_utils.json_codec, 'loads', wraps=json_codec.loads) as loads:
+            validated = validate_extended_report_params(params)
+            self.assertIsInstance(validated['template']['template_data_json'], ParsedJSON)
+            self.assertEqual(validate_template_params(validated['template'], config), {
+                'template_file': TEST_DATA['template'],
+                'template_data': TEST_DATA['title'],
+            })
+            link_template = validated['file_links'][0]['template']
+            self.assertEqual(validate_template_params(
+                {**link_template, 'output_file': TEST_DATA['output_file']}, config, True
+            )['template_data'], TEST_DATA['content'])
+        self.assertEqual(loads.call_count, 2)
+        # the params that were passed in are not changed, and serialise as before
+        self.assertEqual(params['template']['template_data_json'], TEST_DATA['title_json'])
+        self.assertEqual(json.dumps(validated, default=str), json.dumps(params))
+
+    def test_validate_template_params_threads(self):
+        """ validators share their prebuilt schemas, but not their state, between threads """
+        config = self.getTmpl().config
+        scratch_dirs = []
+        for n in range(4):
+            scratch_dirs.append(os.path.join(self.scratch, f'validate-{n}-{uuid4()}'))
+            os.makedirs(scratch_dirs[-1])
+
+        def validate(n):
+            scratch = scratch_dirs[n % 4]
+            params = {
+                'template_file': TEST_DATA['template'],
+                'template_data_json': json.dumps({'n': n}),
+                # every other call has an output file in another call's scratch directory
+                'output_file': os.path.join(scratch_dirs[(n + n % 2) % 4], f'{n}.html'),
+            }
+            try:
+                return validate_template_params(params, {**config, 'scratch': scratch}, True)
+            except TypeError as err:
+                return 'not in the scratch directory' in str(err)
+
+        expected = [validate(n) for n in range(40)]
+        self.assertEqual(expected[:2], [{
+            'template_file': TEST_DATA['template'],
+            'template_data': {'n': 0},
+            'output_file': os.path.join(scratch_dirs[0], '0.html'),
+        }, True])
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(validate, range(40))), expected)
+
+    def test_render_template_pages(self):
+        """ a list in the template data can be split across several pages """
+
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'genes.tt'), 'w') as f:
+            f.write('<h1>[% title %]</h1>[% FOREACH g IN genes %][% g %],[% END %]'
+                    '|[% pagination.page %]/[% pagination.pages %] '
+                    '[% pagination.first %]-[% pagination.last %] of [% pagination.total %] '
+                    '<[% pagination.prev %]> <[% pagination.next %]>')
+
+        template_data_json = json.dumps({'title': 'Genes', 'genes': list(range(1, 26))})
+        expected = {
+            'genes.html': '<h1>Genes</h1>1,2,3,4,5,6,7,8,9,10,|1/3 1-10 of 25 <> <genes_2.html>',
+            'genes_2.html': '<h1>Genes</h1>11,12,13,14,15,16,17,18,19,20,|2/3 11-20 of 25 '
+                            '<genes.html> <genes_3.html>',
+            'genes_3.html': '<h1>Genes</h1>21,22,23,24,25,|3/3 21-25 of 25 <genes_2.html> <>',
+        }
+        for workers in [0, 2]:
+            with self.subTest(f'template-render-workers: {workers}'):
+                tmpl_util = TemplateUtil({
+                    'scratch': self.scratch,
+                    'template_toolkit': {'INCLUDE_PATH': tmpl_dir},
+                    'template-render-workers': workers,
+                })
+                output_dir = os.path.join(self.scratch, 'pages-' + str(uuid4()))
+                params = {
+                    'template_file': 'genes.tt',
+                    'template_data_json': template_data_json,
+                    'output_file': os.path.join(output_dir, 'genes.html'),
+                    'paginate': {'data_key': 'genes', 'page_size': 10},
+                }
+                self.assertEqual(tmpl_util.render_template_to_file(params),
+                                 {'path': params['output_file']})
+                self.assertEqual(sorted(os.listdir(output_dir)), sorted(expected.keys()))
+                for (name, text) in expected.items():
+                    self.check_file_contents(os.path.join(output_dir, name), text)
+
+        # the data key must be a list
+        with self.assertRaisesRegex(TypeError, "data_key 'title' must be a list"):
+            tmpl_util.render_template_to_file({
+                **params, 'paginate': {'data_key': 'title', 'page_size': 10}
+            })
+
+        # pages are written to a new directory in scratch, for uploading as html_links
+        output = tmpl_util.render_template_to_scratch_dir({
+            'template_file': 'genes.tt',
+            'template_data_json': template_data_json,
+            'paginate': {'data_key': 'genes', 'page_size': 20},
+        }, 'index.html')
+        self.assertEqual(os.path.dirname(output['path']), self.scratch)
+        self.assertEqual(sorted(os.listdir(output['path'])), ['index.html', 'index_2.html'])
+
     def test_render_template(self):
         """
         basic rendering test
@@ -480,6 +920,110 @@ class TestTemplateUtils(unittest.TestCase):
                 self.check_file_contents(
                     tmp_file['path'], TEST_DATA['render_test'][test_item]['abs_path'])
 
+    def test_render_template_to_file_streaming(self):
+        """ streaming template output to a file gives the same output """
+
+        tmpl_util = TemplateUtil({**self.cfg, 'template-stream-output': True})
+        for test_item in TEST_DATA['render_test'].keys():
+            desc = test_item if test_item is not None else 'None'
+            with self.subTest('streamed content: ' + desc):
+                params = {
+                    'template_file': TEST_DATA['template'],
+                    'output_file': os.path.join(self.scratch, 'stream-' + str(uuid4()) + '.txt'),
+                }
+                if test_item:
+                    params['template_data_json'] = TEST_DATA[test_item + '_json']
+                with patch.object(StreamingOutput, 'write', autospec=True,
+                                  side_effect=StreamingOutput.write) as write:
+                    self.assertEqual(tmpl_util.render_template_to_file(params),
+                                     {'path': params['output_file']})
+                # the output went through the StreamingOutput
+                self.assertTrue(write.called)
+                self.check_file_contents(params['output_file'],
+                                         TEST_DATA['render_test'][test_item]['abs_path'])
+
+        # the compiled template only writes to the StreamingOutput while it is streamed
+        with tmpl_util._engines.checkout(tmpl_util._tt_config()) as engine:
+            document = engine.context().template(TEST_DATA['template'])
+        self.assertIs(document.block().__globals__['Buffer'], StringBuffer)
+
+        # the partly written file is removed if rendering fails
+        tmpl_dir = os.path.join(self.scratch, 'tmpl-' + str(uuid4()))
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'fail.tt'), 'w') as f:
+            f.write('some output[% THROW oops "failed" %]')
+        output_file = os.path.join(self.scratch, 'stream-' + str(uuid4()) + '.txt')
+        with self.assertRaisesRegex(TemplateException, 'oops error - failed'):
+            tmpl_util.render_template_to_file({
+                'template_file': os.path.join(tmpl_dir, 'fail.tt'),
+                'output_file': output_file,
+            })
+        self.assertFalse(os.path.exists(output_file))
+
+    def test_render_template_list_to_files_parallel(self):
+        """ rendering a list of templates across a pool of processes """
+
+        tmpl_util = TemplateUtil({**self.cfg, 'template-render-workers': 3})
+        param_list = [{
+            'template_file': TEST_DATA['template'],
+            'template_data_json': TEST_DATA['title_json'],
+            'output_file': os.path.join(self.scratch, 'parallel-' + str(uuid4()) + '.txt'),
+        } for _ in range(8)]
+
+        output = tmpl_util.render_template_list_to_files(param_list)
+        self.assertEqual(output, [{'path': params['output_file']} for params in param_list])
+        for each_output in output:
+            self.check_file_contents(each_output['path'],
+                                     TEST_DATA['render_test']['title']['abs_path'])
+
+        # errors are reported with the index of the template
+        param_list[2]['template_file'] = '/does/not/exist'
+        param_list[5]['output_file'] = 'path/to/file'
+        with self.assertRaisesRegex(TemplateRenderError, '2 template') as cm:
+            tmpl_util.render_template_list_to_files(param_list)
+        self.assertEqual([idx for (idx, err) in cm.exception.failures], [2, 5])
+        self.assertIsInstance(cm.exception.failures[0][1], TemplateException)
+        self.assertIsInstance(cm.exception.failures[1][1], TypeError)
+
+    def test_template_stamps(self):
+        """ template links are stamped with the template file wherever TT would find it """
+
+        tmpl_util = self.getTmpl()
+        st = os.stat(TEST_DATA['template'])
+        stamps = tmpl_util.template_stamps({'template_file': TEST_DATA['template']})
+        self.assertEqual(stamps, [[TEST_DATA['template'], st.st_mtime_ns, st.st_size]])
+
+        # relative paths are looked for in the working directory and on the INCLUDE_PATH
+        stamps = tmpl_util.template_stamps({'template_file': TEST_DATA['template_file']})
+        self.assertIn([TEST_DATA['template'], st.st_mtime_ns, st.st_size], stamps)
+        self.assertIn([os.path.abspath(TEST_DATA['template_file']), None, None], stamps)
+
+        data_file = os.path.join(self.scratch, 'stamp-' + str(uuid4()) + '.json')
+        with open(data_file, 'w') as fh:
+            fh.write('{}')
+        stamps = tmpl_util.template_stamps({'template_file': TEST_DATA['template'],
+                                            'template_data_file': data_file})
+        self.assertEqual([stamp[0] for stamp in stamps],
+                         sorted([TEST_DATA['template'], data_file]))
+        os.remove(data_file)
+
+    def test_render_pool(self):
+        """ one pool is started however many renders ask for it; a broken one is shut down """
+
+        tmpl_util = TemplateUtil({**self.cfg, 'template-render-workers': 3})
+        with patch('KBaseReport.utils.TemplateUtil.ProcessPoolExecutor') as executor:
+            with ThreadPoolExecutor(max_workers=8) as threads:
+                pools = list(threads.map(lambda _: tmpl_util._get_render_pool(), range(32)))
+            self.assertEqual(executor.call_count, 1)
+            self.assertTrue(all(pool is pools[0] for pool in pools))
+
+            broken = pools[0]
+            broken.submit.return_value.result.side_effect = BrokenProcessPool()
+            with self.assertRaises(BrokenProcessPool):
+                tmpl_util._run_in_pool(print, [('a',), ('b',)])
+            broken.shutdown.assert_called_once_with(wait=False)
+            self.assertIsNone(tmpl_util._render_pool)
+
     def test_impl_render_template_errors(self):
         """ full Impl test errors """
         input_tests = self.get_input_set()
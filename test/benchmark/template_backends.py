@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from KBaseReport.utils.TemplateUtil import TemplateUtil
+
+"""
+Compare the render times of the Template Toolkit and Jinja2 template backends
+
+Each template in templates/ is written for both backends (name.tt and name.html.j2), giving
+the same output. The benchmark checks that they do, then times each pair with generated data
+of several sizes:
+
+    cold:       first render in a new TemplateUtil, including compiling the templates
+    render:     mean time to render to a string, with the templates already compiled
+    stream:     mean time to render to a file with 'template-stream-output' set
+
+Run from the repo root with
+
+    PYTHONPATH=lib python test/benchmark/template_backends.py [--rows 10 1000] [--repeat 20]
+"""
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+TEMPLATES = {
+    'report': {'tt': 'report.tt', 'jinja2': 'report.html.j2'},
+}
+
+
+def template_data(n_rows):
+    """ Data like that of a gene table report, with n_rows genes """
+    return {
+        'title': f'Genes & functions ({n_rows})',
+        'stats': {f'stat_{n}': n * 1.5 for n in range(20)},
+        'genes': [{
+            'id': f'gene_{n}',
+            'name': f'<gene {n}>',
+            'length': (n * 37) % 2000,
+            'functions': [f'function {n % 7}', f'function {n % 11} & more'],
+        } for n in range(n_rows)],
+    }
+
+
+def mean_time(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark(scratch, n_rows, repeat):
+    """ Timings for each template and backend, as rows for the results table """
+    config = {
+        'scratch': scratch,
+        'template_toolkit': {'INCLUDE_PATH': TEMPLATE_DIR},
+    }
+    data = template_data(n_rows)
+    results = []
+    for (name, files) in TEMPLATES.items():
+        outputs = {}
+        for (backend, template_file) in files.items():
+            templater = TemplateUtil(config)
+            start = time.perf_counter()
+            outputs[backend] = templater._render_template(template_file, data)
+            cold = time.perf_counter() - start
+
+            render = mean_time(lambda: templater._render_template(template_file, data), repeat)
+
+            streamer = TemplateUtil({**config, 'template-stream-output': True})
+            output_file = os.path.join(scratch, f'{name}-{backend}.html')
+            stream = mean_time(
+                lambda: streamer._render_to_file(template_file, data, output_file), repeat)
+
+            results.append((name, backend, n_rows, cold, render, stream))
+
+        if outputs['tt'] != outputs['jinja2']:
+            raise ValueError(f"the '{name}' templates give different output with {n_rows} rows")
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare Template Toolkit and Jinja2 render times')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 1000, 10000],
+                        help='numbers of table rows to render (default: 10 1000 10000)')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='renders to average over (default: 20)')
+    args = parser.parse_args(argv)
+
+    print(f"{'template':<12} {'backend':<8} {'rows':>7} {'cold s':>9} {'render s':>9} "
+          f"{'stream s':>9} {'speed-up':>9}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for n_rows in args.rows:
+            results = benchmark(scratch, n_rows, args.repeat)
+            tt_render = {name: render for (name, backend, _, _, render, _) in results
+                         if backend == 'tt'}
+            for (name, backend, rows, cold, render, stream) in results:
+                print(f'{name:<12} {backend:<8} {rows:>7} {cold:>9.4f} {render:>9.4f} '
+                      f'{stream:>9.4f} {tt_render[name] / render:>8.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
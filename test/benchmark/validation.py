@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+import tempfile
+import time
+
+from KBaseReport.utils import validation_utils
+from KBaseReport.utils.validation_utils import (
+    validate_extended_report_params,
+    validate_template_params,
+)
+
+"""
+Compare parameter validation with prebuilt schemas against normalising the schema on every call
+
+Each validate_* function makes its validator from a schema that was normalised when
+validation_utils was loaded. The 'per call' timings make a validator from the plain schema
+instead, as the functions used to, so the difference is the saving per request:
+
+    extended report:    validate_extended_report_params with n file_links
+    template:           validate_template_params with n rows of template_data_json
+
+Timings are the best of several rounds, as validation takes little more than a millisecond.
+
+Run from the repo root with
+
+    PYTHONPATH=lib python test/benchmark/validation.py [--sizes 1 1000] [--repeat 50]
+"""
+
+
+def extended_report_params(n_links):
+    return {
+        'workspace_id': 12345,
+        'message': 'a report',
+        'objects_created': [{'ref': '1/2/3', 'description': 'genome'}],
+        'file_links': [{
+            'shock_id': f'node_{n}',
+            'name': f'file_{n}.txt',
+            'description': f'file {n}',
+        } for n in range(n_links)],
+    }
+
+
+def template_params(n_rows):
+    rows = ','.join(f'{{"id": "gene_{n}", "length": {n}}}' for n in range(n_rows))
+    return {
+        'template_file': 'views/report.tt',
+        'template_data_json': f'{{"genes": [{rows}]}}',
+    }
+
+
+def mean_time(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def best_times(funcs, repeat, rounds):
+    """ Best mean time of each function over several rounds, taking turns to even out noise """
+    best = [float('inf')] * len(funcs)
+    for _ in range(rounds):
+        for (idx, func) in enumerate(funcs):
+            best[idx] = min(best[idx], mean_time(func, repeat))
+    return best
+
+
+def per_call_schemas():
+    """ Validators made from the plain schemas, normalising them each time """
+    prebuilt = validation_utils._prebuilt_schemas
+    plain = {
+        'extended_report': validation_utils.extended_report_schema,
+        'template_params': validation_utils.template_params_schema,
+        'template_util_config': validation_utils.template_util_config_schema,
+    }
+
+    def validator(name, **config):
+        if name in plain:
+            return validation_utils._Validator(plain[name], **config)
+        return validation_utils._Validator(prebuilt[name], **config)
+
+    return validator
+
+
+def benchmark(scratch, size, repeat, rounds):
+    """ [(payload, size, per call seconds, prebuilt seconds), ...] """
+    config = {'scratch': scratch, 'template_toolkit': {}}
+    cases = {
+        'extended report': lambda params=extended_report_params(size):
+            validate_extended_report_params(params),
+        'template': lambda params=template_params(size):
+            validate_template_params(dict(params), config),
+    }
+    prebuilt_validator = validation_utils._validator
+    per_call_validator = per_call_schemas()
+
+    def with_validator(validator, func):
+        def run():
+            validation_utils._validator = validator
+            try:
+                func()
+            finally:
+                validation_utils._validator = prebuilt_validator
+        return run
+
+    results = []
+    for (name, func) in cases.items():
+        (per_call, prebuilt) = best_times([with_validator(per_call_validator, func),
+                                           with_validator(prebuilt_validator, func)],
+                                          repeat, rounds)
+        results.append((name, size, per_call, prebuilt))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Compare validation with prebuilt and per-call schemas')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 1000],
+                        help='numbers of file links / template rows (default: 1 1000)')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='validations to average over in each round (default: 50)')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='rounds to take the best of (default: 5)')
+    args = parser.parse_args(argv)
+
+    print(f"{'payload':<16} {'size':>6} {'per call ms':>12} {'prebuilt ms':>12} "
+          f"{'saving ms':>10} {'speed-up':>9}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for size in args.sizes:
+            results = benchmark(scratch, size, args.repeat, args.rounds)
+            for (name, size, per_call, prebuilt) in results:
+                print(f'{name:<16} {size:>6} {per_call * 1000:>12.3f} {prebuilt * 1000:>12.3f} '
+                      f'{(per_call - prebuilt) * 1000:>10.3f} {per_call / prebuilt:>8.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,767 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest.mock import MagicMock, patch
+
+import requests
+from installed_clients.baseclient import ServerError
+from KBaseReport.utils.UploadCache import UploadCache
+from KBaseReport.utils.bundle_utils import bundle_dir
+from KBaseReport.utils.html_utils import minify_css, minify_html, minify_js
+from KBaseReport.utils.zip_utils import zip_directory
+from KBaseReport.utils.file_utils import (
+    fetch_or_upload_file_links,
+    fetch_or_upload_html_links,
+    fetch_or_upload_links,
+    LinkUploadError,
+    _link_or_copy,
+    _run_scheduled,
+)
+from KBaseReport.utils.report_utils import _log_info, _summarise_timings
+
+
+class FakeDFU:
+    """ Stand-in for the DataFileUtil client that records the calls made to it """
+
+    def __init__(self, delay=0, fail_on=None, missing_nodes=None):
+        self.delay = delay
+        self.fail_on = fail_on or set()
+        self.missing_nodes = missing_nodes or set()
+        self.calls = []
+        self.zip_contents = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _handle(self, node_id):
+        return {
+            'shock_id': node_id,
+            'handle': {'hid': 'KBH_' + node_id, 'url': 'https://shock', 'id': node_id},
+        }
+
+    def _call(self, method, key):
+        with self._lock:
+            self.calls.append((method, key))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if os.path.basename(key) in self.fail_on:
+                raise RuntimeError('upload failed for ' + key)
+            return self._handle(os.path.basename(key))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def file_to_shock(self, params):
+        if params['file_path'].endswith('.zip'):
+            with zipfile.ZipFile(params['file_path']) as zf:
+                self.zip_contents[params['file_path']] = sorted(zf.namelist())
+        return self._call('file_to_shock', params['file_path'])
+
+    def file_to_shock_mass(self, params):
+        with self._lock:
+            self.calls.append(('file_to_shock_mass', len(params)))
+        return [self._handle(os.path.basename(p['file_path'])) for p in params]
+
+    def own_shock_node(self, params):
+        if params['shock_id'] in self.missing_nodes:
+            raise ServerError('DataFileUtilError', -32500, 'node not found')
+        return self._call('own_shock_node', params['shock_id'])
+
+
+class TestFileUtils(unittest.TestCase):
+
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        self.templater = MagicMock()
+        self.paths = []
+        for n in range(6):
+            path = os.path.join(self.scratch, 'file_' + str(n) + '.txt')
+            with open(path, 'w') as f:
+                f.write('content ' + str(n))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.scratch)
+
+    def test_output_order(self):
+        """ results come back in input order, whatever order the uploads finish in """
+        dfu = FakeDFU(delay=0.01)
+        files = [{'name': os.path.basename(p), 'path': p} for p in self.paths]
+        files.append({'name': 'shocked', 'shock_id': 'node_abc'})
+        out = fetch_or_upload_file_links(dfu, files, self.templater, {'upload-concurrency': 4})
+        self.assertEqual([f['name'] for f in out], [f['name'] for f in files])
+        self.assertEqual(out[-1]['URL'], 'https://shock/node/node_abc')
+        self.assertEqual(out[-1]['handle'], 'KBH_node_abc')
+
+    def test_concurrency_limit(self):
+        """ the number of simultaneous DataFileUtil calls is bounded by the config """
+        dfu = FakeDFU(delay=0.05)
+        # the first two uploads wait for each other, which they can only do if they run at
+        # the same time; otherwise the barrier times out and the upload fails
+        barrier = threading.Barrier(2, timeout=10)
+        started = []
+
+        def overlapping_upload(params):
+            with dfu._lock:
+                started.append(params['file_path'])
+                first_two = len(started) <= 2
+            if first_two:
+                barrier.wait()
+            return FakeDFU.file_to_shock(dfu, params)
+
+        dfu.file_to_shock = overlapping_upload
+        files = [{'name': os.path.basename(p), 'path': p} for p in self.paths]
+        fetch_or_upload_file_links(dfu, files, self.templater, {
+            'upload-concurrency': '2',
+            'upload-batch-size': 1,
+        })
+        self.assertEqual(len(dfu.calls), len(files))
+        self.assertFalse(barrier.broken)
+        self.assertLessEqual(dfu.max_in_flight, 2)
+
+    def test_shock_node_ownership(self):
+        """ each shock node is only owned once per request """
+        dfu = FakeDFU(delay=0.01)
+        file_links = [{'name': 'f' + str(n), 'shock_id': 'node_' + str(n % 3)} for n in range(9)]
+        html_links = [{'name': 'index.html', 'shock_id': 'node_1'}]
+        (files, html_files) = fetch_or_upload_links(dfu, file_links, html_links, self.templater)
+        self.assertEqual(sorted(dfu.calls), [
+            ('own_shock_node', 'node_0'),
+            ('own_shock_node', 'node_1'),
+            ('own_shock_node', 'node_2'),
+        ])
+        self.assertEqual([f['URL'] for f in files[:3]], [
+            'https://shock/node/node_0', 'https://shock/node/node_1', 'https://shock/node/node_2'
+        ])
+        self.assertEqual(html_files[0]['URL'], 'https://shock/node/node_1')
+        self.assertEqual(html_files[0]['name'], 'index.html')
+
+    def test_file_and_html_links(self):
+        """ file_links and html_links are split back out after running together """
+        dfu = FakeDFU()
+        file_links = [{'name': 'a', 'path': self.paths[0]}]
+        html_links = [
+            {'name': 'index.html', 'path': self.paths[1]},
+            {'name': 'other', 'shock_id': 'node_xyz'},
+        ]
+        (files, html_files) = fetch_or_upload_links(dfu, file_links, html_links, self.templater)
+        self.assertEqual([f['name'] for f in files], ['a'])
+        self.assertEqual([f['name'] for f in html_files], ['index.html', 'other'])
+        # single html files are put into a directory before zipping
+        staging_dir = html_links[0]['path']
+        self.assertNotEqual(staging_dir, self.paths[1])
+        self.assertIn(('file_to_shock', staging_dir), dfu.calls)
+        # ...which is removed after the upload
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertTrue(os.path.isfile(self.paths[1]))
+
+    def test_paginated_template_links(self):
+        """ paginated templates are rendered into a directory, which is zipped as it is """
+        dfu = FakeDFU()
+        pages_dir = os.path.join(self.scratch, 'pages')
+        os.makedirs(pages_dir)
+        self.templater.render_template_to_scratch_dir.return_value = {'path': pages_dir}
+        self.templater.render_template_to_scratch_file.return_value = {'path': self.paths[0]}
+        template = {
+            'template_file': 'genes.tt',
+            'template_data_json': '{"genes": []}',
+            'paginate': {'data_key': 'genes', 'page_size': 100},
+        }
+        html_links = [{'name': 'genes.html', 'template': template}]
+        fetch_or_upload_html_links(dfu, html_links, self.templater)
+        self.templater.render_template_to_scratch_dir.assert_called_once_with(
+            template, 'genes.html')
+        self.templater.render_template_to_scratch_file.assert_not_called()
+        self.assertEqual(html_links[0]['path'], pages_dir)
+        self.assertIn(('file_to_shock', pages_dir), dfu.calls)
+
+    def test_link_or_copy(self):
+        """ files are linked rather than copied where possible """
+        dest = os.path.join(self.scratch, 'linked.txt')
+        self.assertEqual(_link_or_copy(self.paths[0], dest), 'hardlink')
+        self.assertTrue(os.path.samefile(self.paths[0], dest))
+
+        # fall back to a symlink if hard links and reflinks are not possible
+        dest = os.path.join(self.scratch, 'symlinked.txt')
+        with patch('os.link', side_effect=OSError('cross-device link')), \
+                patch('KBaseReport.utils.file_utils._reflink', return_value=False):
+            self.assertEqual(_link_or_copy(self.paths[0], dest), 'symlink')
+        self.assertTrue(os.path.islink(dest))
+
+        dest = os.path.join(self.scratch, 'copied.txt')
+        with patch('os.link', side_effect=OSError), patch('os.symlink', side_effect=OSError), \
+                patch('KBaseReport.utils.file_utils._reflink', return_value=False):
+            self.assertEqual(_link_or_copy(self.paths[0], dest), 'copy')
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'content 0')
+
+    def test_html_links(self):
+        """ html_links can also be uploaded on their own """
+        dfu = FakeDFU()
+        out = fetch_or_upload_html_links(dfu, [{'name': 'a', 'shock_id': 'n1'}], self.templater)
+        self.assertEqual(out[0]['URL'], 'https://shock/node/n1')
+
+    def test_upload_errors(self):
+        """ failures are collected into a single LinkUploadError """
+        dfu = FakeDFU(delay=0.05, fail_on={'file_1.txt'})
+        files = [{'name': os.path.basename(p), 'path': p} for p in self.paths]
+        with self.assertRaisesRegex(LinkUploadError, 'file_1.txt: upload failed') as cm:
+            fetch_or_upload_file_links(dfu, files, self.templater, {
+                'upload-concurrency': 1,
+                'upload-batch-size': 1,
+            })
+        self.assertEqual([link['name'] for (link, err) in cm.exception.failures], ['file_1.txt'])
+        # with a single worker, the uploads queued behind the failure are cancelled
+        self.assertLess(len(dfu.calls), len(files))
+
+    def test_batched_uploads(self):
+        """ plain files go through file_to_shock_mass; directories are zipped singly """
+        dfu = FakeDFU()
+        files = [{'name': os.path.basename(p), 'path': p} for p in self.paths]
+        files.insert(2, {'name': 'dir', 'path': self.scratch})
+        out = fetch_or_upload_file_links(dfu, files, self.templater, {'upload-batch-size': 4})
+        self.assertEqual([f['name'] for f in out], [f['name'] for f in files])
+        self.assertEqual(out[3]['URL'], 'https://shock/node/file_2.txt')
+        self.assertEqual(sorted(dfu.calls, key=str), [
+            ('file_to_shock', self.scratch),
+            ('file_to_shock_mass', 2),
+            ('file_to_shock_mass', 4),
+        ])
+
+    def test_upload_cache(self):
+        """ identical content is only uploaded once when the upload cache is on """
+        config = {
+            'upload-cache-dir': os.path.join(self.scratch, 'cache'),
+            'upload-batch-size': 1,
+        }
+        copy_path = os.path.join(self.scratch, 'copy')
+        os.makedirs(copy_path)
+        shutil.copy2(self.paths[0], copy_path)
+
+        dfu = FakeDFU()
+        fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                   self.templater, config)
+        self.assertEqual(dfu.calls, [('file_to_shock', self.paths[0])])
+
+        # same content, same file name
+        dfu = FakeDFU()
+        out = fetch_or_upload_file_links(dfu, [
+            {'name': 'b', 'path': os.path.join(copy_path, 'file_0.txt')},
+            {'name': 'c', 'path': self.paths[1]},
+        ], self.templater, config)
+        self.assertEqual(sorted(dfu.calls), [
+            ('file_to_shock', self.paths[1]),
+            ('own_shock_node', 'file_0.txt'),
+        ])
+        self.assertEqual(out[0]['URL'], 'https://shock/node/file_0.txt')
+
+        # a transport error on a cached node falls back to an upload, keeping the entry
+        dfu = FakeDFU()
+        dfu.own_shock_node = MagicMock(side_effect=requests.exceptions.ConnectionError('reset'))
+        fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                   self.templater, {**config, 'upload-retries': 0})
+        self.assertEqual(dfu.calls, [('file_to_shock', self.paths[0])])
+        dfu = FakeDFU()
+        fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                   self.templater, config)
+        self.assertEqual(dfu.calls, [('own_shock_node', 'file_0.txt')])
+
+        # stale entries are dropped and the content is uploaded again
+        dfu = FakeDFU(missing_nodes={'file_0.txt'})
+        fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                   self.templater, config)
+        self.assertEqual(dfu.calls, [('file_to_shock', self.paths[0])])
+
+        # the cache is off unless upload-cache-dir is set
+        dfu = FakeDFU()
+        with patch('KBaseReport.utils.file_utils.content_digest') as digest:
+            fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                       self.templater, {'scratch': self.scratch})
+        digest.assert_not_called()
+        self.assertEqual(dfu.calls, [('file_to_shock', self.paths[0])])
+
+    def test_upload_cache_eviction(self):
+        """ the upload cache keeps the most recently used entries """
+        cache = UploadCache(os.path.join(self.scratch, 'cache'), max_entries=2)
+        for digest in ['a', 'b']:
+            cache.add(digest, {'shock_id': 'node_' + digest, 'handle': {'hid': digest}})
+        self.assertEqual(cache.get('a'), {'shock_id': 'node_a', 'handle': {'hid': 'a'}})
+        cache.add('c', {'shock_id': 'node_c'})
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        cache.discard('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_zip_directory(self):
+        """ directories are zipped with paths relative to the directory """
+        src_dir = os.path.join(self.scratch, 'src')
+        os.makedirs(os.path.join(src_dir, 'img'))
+        with open(os.path.join(src_dir, 'index.html'), 'w') as f:
+            f.write('<html>' + 'report ' * 10000 + '</html>')
+        with open(os.path.join(src_dir, 'img', 'plot.png'), 'wb') as f:
+            f.write(os.urandom(2048))
+
+        zip_path = zip_directory(src_dir, os.path.join(self.scratch, 'src.zip'), workers=2)
+        with zipfile.ZipFile(zip_path) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(sorted(zf.namelist()), ['img/', 'img/plot.png', 'index.html'])
+            # already-compressed files are stored as they are
+            self.assertEqual(zf.getinfo('img/plot.png').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.getinfo('index.html').compress_type, zipfile.ZIP_DEFLATED)
+            with open(os.path.join(src_dir, 'index.html'), 'rb') as f:
+                self.assertEqual(zf.read('index.html'), f.read())
+
+    def _write_zip_source(self, name):
+        src_dir = os.path.join(self.scratch, name)
+        os.makedirs(os.path.join(src_dir, 'img'))
+        contents = {
+            'index.html': ('<html>' + 'report ' * 1000 + '</html>').encode(),
+            'data.gz': os.urandom(2048),
+            'notes.txt': b'notes ' * 500,
+            os.path.join('img', 'plot.png'): os.urandom(2048),
+        }
+        for (path, content) in contents.items():
+            with open(os.path.join(src_dir, path), 'wb') as f:
+                f.write(content)
+        return (src_dir, {path.replace(os.sep, '/'): content
+                          for (path, content) in contents.items()})
+
+    def test_zip_directory_reuse(self):
+        """ members listed as unchanged are copied from the previous archive as they are """
+        (src_dir, contents) = self._write_zip_source('src')
+        old_zip = zip_directory(src_dir, os.path.join(self.scratch, 'old.zip'), workers=2)
+
+        # the copies come from the old archive, not from the (rewritten) files
+        with open(os.path.join(src_dir, 'index.html'), 'wb') as f:
+            f.write(b'<html>changed</html>')
+        with open(os.path.join(src_dir, 'img', 'plot.png'), 'wb') as f:
+            f.write(b'not used')
+        new_zip = zip_directory(src_dir, os.path.join(self.scratch, 'new.zip'), workers=2,
+                                reuse_from=old_zip, unchanged={'img/plot.png', 'notes.txt'})
+        with zipfile.ZipFile(old_zip) as old, zipfile.ZipFile(new_zip) as new:
+            self.assertIsNone(new.testzip())
+            self.assertEqual(new.namelist(), old.namelist())
+            self.assertEqual(new.read('index.html'), b'<html>changed</html>')
+            for name in ['img/plot.png', 'notes.txt']:
+                self.assertEqual(new.read(name), contents[name])
+                self.assertEqual(new.getinfo(name).compress_type,
+                                 old.getinfo(name).compress_type)
+                self.assertEqual(new.getinfo(name).compress_size,
+                                 old.getinfo(name).compress_size)
+
+        # a missing or broken previous archive is ignored, and everything is compressed
+        with open(old_zip, 'wb') as f:
+            f.write(b'not a zip file')
+        for reuse_from in [old_zip, os.path.join(self.scratch, 'missing.zip')]:
+            zip_path = zip_directory(src_dir, os.path.join(self.scratch, 'again.zip'),
+                                     reuse_from=reuse_from, unchanged={'notes.txt'})
+            with zipfile.ZipFile(zip_path) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(zf.read('img/plot.png'), b'not used')
+
+    def test_zip_directory_zip64(self):
+        """ sizes, offsets and counts past the zip limits are written to zip64 records """
+        # lower the limits, rather than writing more than 4 GiB of data
+        limits = {'_ZIP64_LIMIT': 1024, '_ZIP_FILECOUNT_LIMIT': 3}
+        (src_dir, contents) = self._write_zip_source('src')
+        with patch.multiple('KBaseReport.utils.zip_utils', **limits):
+            old_zip = zip_directory(src_dir, os.path.join(self.scratch, 'old.zip'), workers=2)
+            # members are also copied from an archive with zip64 records
+            new_zip = zip_directory(src_dir, os.path.join(self.scratch, 'new.zip'), workers=2,
+                                    reuse_from=old_zip, unchanged={'img/plot.png'})
+
+        for zip_path in [old_zip, new_zip]:
+            with open(zip_path, 'rb') as f:
+                data = f.read()
+            # the zip64 end of central directory record and its locator
+            self.assertIn(b'PK\x06\x06', data)
+            self.assertIn(b'PK\x06\x07', data)
+            with zipfile.ZipFile(zip_path) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual(sorted(zf.namelist()), sorted(['img/'] + list(contents)))
+                for (name, content) in contents.items():
+                    self.assertEqual(zf.read(name), content)
+                # data.gz is stored, and 2048 bytes, so its sizes are in zip64 extra fields,
+                # as are the offsets of the members after it
+                self.assertEqual(zf.getinfo('data.gz').extract_version, 45)
+                self.assertGreater(zf.getinfo('notes.txt').header_offset, 2048)
+
+    def test_local_zip(self):
+        """ with zip-workers set, directories are zipped before being uploaded """
+        dir_path = os.path.join(self.scratch, 'html_dir')
+        os.makedirs(dir_path)
+        shutil.copy2(self.paths[0], os.path.join(dir_path, 'index.html'))
+        dfu = FakeDFU()
+        out = fetch_or_upload_html_links(dfu, [{'name': 'index.html', 'path': dir_path}],
+                                         self.templater, {'zip-workers': 2})
+        (method, zip_path) = dfu.calls[0]
+        self.assertEqual(os.path.basename(zip_path), 'html_dir.zip')
+        self.assertEqual(dfu.zip_contents[zip_path], ['index.html'])
+        self.assertEqual(out[0]['URL'], 'https://shock/node/html_dir.zip')
+        # the archive is removed once it has been uploaded
+        self.assertFalse(os.path.exists(os.path.dirname(zip_path)))
+
+    def test_minify(self):
+        """ comments and whitespace are removed, leaving strings and preformatted text alone """
+        self.assertEqual(
+            minify_html('<html>\n  <head> <!-- note -->\n'
+                        '    <style> a , b { color : red ; } </style>\n'
+                        '    <script>\n var a  =  "x  y" ; // set a\n </script>\n'
+                        '  </head>\n  <body  class="a   b">  <p>some   text</p>\n'
+                        '    <pre>  keep\n    this</pre>\n  </body>\n</html>\n'),
+            '<html>\n<head> \n<style>a,b{color :red}</style>\n<script>var a="x  y";</script>\n'
+            '</head>\n<body class="a   b"> <p>some text</p>\n<pre>  keep\n    this</pre>\n'
+            '</body>\n</html>\n'
+        )
+        self.assertEqual(minify_css('/*! licence */\ndiv :first-child , a:hover {\n'
+                                    '  content : " ; } " ;\n}\n'),
+                         '/*! licence */ div :first-child,a:hover{content :" ; } "}')
+        # line breaks that might end a statement are kept
+        self.assertEqual(minify_js('var a = b\n(c)\nvar d = a + +1 / 2; /* note */\n'
+                                   'let e = `x  ${ a + 1 }  y` , f = /a  b/g;\n'),
+                         'var a=b\n(c)\nvar d=a+ +1 / 2;let e=`x  ${a+1}  y`,f= /a  b/g;')
+
+    def test_html_minify_and_gzip(self):
+        """ html_links directories are uploaded minified, with .gz copies of text files """
+        cache_dir = os.path.join(self.scratch, 'cache')
+        config = {'html-minify': True, 'html-gzip': True, 'zip-workers': 1,
+                  'upload-cache-dir': cache_dir}
+        dir_path = os.path.join(self.scratch, 'html_dir')
+        os.makedirs(os.path.join(dir_path, 'js'))
+        files = {
+            'index.html': '<html>\n' + '    <p>  report  </p>\n' * 200 + '</html>\n',
+            'style.css': 'p {\n    margin : 0 ;\n}\n',
+            os.path.join('js', 'lib.min.js'): 'var a=1;' * 200,
+            os.path.join('js', 'app.js'): 'x = 1;\n',
+            os.path.join('js', 'app.js.gz'): 'already there',
+        }
+        for (name, content) in files.items():
+            with open(os.path.join(dir_path, name), 'w') as f:
+                f.write(content)
+
+        dfu = FakeDFU()
+        fetch_or_upload_html_links(dfu, [{'name': 'index.html', 'path': dir_path}],
+                                   self.templater, config)
+        (method, zip_path) = dfu.calls[0]
+        self.assertEqual(os.path.basename(zip_path), 'html_dir.zip')
+        self.assertEqual(dfu.zip_contents[zip_path], [
+            'index.html', 'index.html.gz', 'js/', 'js/app.js', 'js/app.js.gz', 'js/lib.min.js',
+            'js/lib.min.js.gz', 'style.css',
+        ])
+        # the directory that was given is not changed
+        for (name, content) in files.items():
+            with open(os.path.join(dir_path, name)) as f:
+                self.assertEqual(f.read(), content)
+
+        # the output is the same every time, so the upload cache recognises it
+        dfu = FakeDFU()
+        fetch_or_upload_html_links(dfu, [{'name': 'index.html', 'path': dir_path}],
+                                   self.templater, config)
+        self.assertEqual(dfu.calls, [('own_shock_node', 'html_dir.zip')])
+
+        # single files are minified too
+        dfu = FakeDFU()
+        fetch_or_upload_html_links(dfu, [{'name': 'page.html', 'path': os.path.join(
+            dir_path, 'index.html')}], self.templater, {**config, 'html-gzip': False})
+        zip_path = dfu.calls[0][1]
+        self.assertEqual(dfu.zip_contents[zip_path], ['page.html'])
+        # staging directories are removed once the upload is done
+        self.assertEqual(sorted(os.listdir(self.scratch)), sorted(
+            [os.path.basename(p) for p in self.paths] + ['cache', 'html_dir']))
+
+    def _write_gene_report(self, dir_path, n_genes):
+        """ A report with a page per gene, sharing a style sheet and an icon """
+        os.makedirs(os.path.join(dir_path, 'genes'))
+        os.makedirs(os.path.join(dir_path, 'icons'))
+        gene_links = ''.join(f'<a href="genes/gene_{n}.html">gene {n}</a>' for n in range(n_genes))
+        files = {
+            'index.html': ('<html><head><title>Genes</title></head><body>' + gene_links +
+                           '<img src="icons/dot.png"></body></html>'),
+            'style.css': 'p { color: red }',
+            'data.json': '{"special": "gene_3.html"}',
+            os.path.join('icons', 'dot.png'): 'dot',
+            os.path.join('icons', 'big.png'): 'x' * 100,
+        }
+        for n in range(n_genes):
+            files[os.path.join('genes', f'gene_{n}.html')] = (
+                f'<html><head><title>Gene {n}</title><link rel="stylesheet" href="../style.css">'
+                f'</head><body><p>gene {n}</p><img src="../icons/dot.png">'
+                f'<img src="../icons/big.png"><a href="gene_{(n + 1) % n_genes}.html">next</a>'
+                + ('<script>go()</script>' if n == 5 else '') + '</body></html>')
+        for (name, content) in files.items():
+            with open(os.path.join(dir_path, name), 'w') as f:
+                f.write(content)
+        return files
+
+    def test_bundle_dir(self):
+        """ small assets are inlined and alike pages are merged into bundles """
+        dir_path = os.path.join(self.scratch, 'bundle_dir')
+        self._write_gene_report(dir_path, 25)
+        stats = bundle_dir(dir_path, 'index.html', inline_size=20, page_size=10)
+        # gene_3 is mentioned in data.json, and gene_5 has a script; each bundle has the head
+        # of its first page, so the style sheet is inlined once per bundle
+        self.assertEqual(stats, {'inlined': 31, 'bundled': 23, 'bundles': 3, 'removed': 25})
+        self.assertEqual(sorted(os.listdir(os.path.join(dir_path, 'genes'))), [
+            'bundle_1.html', 'bundle_2.html', 'bundle_3.html', 'gene_3.html', 'gene_5.html'])
+        self.assertEqual(os.listdir(os.path.join(dir_path, 'icons')), ['big.png'])
+        self.assertFalse(os.path.exists(os.path.join(dir_path, 'style.css')))
+
+        with open(os.path.join(dir_path, 'index.html')) as f:
+            index = f.read()
+        self.assertIn('<a href="genes/bundle_1.html#page-gene_0">gene 0</a>', index)
+        self.assertIn('<a href="genes/gene_3.html">gene 3</a>', index)
+        self.assertIn('<img src="data:image/png;base64,ZG90">', index)
+
+        with open(os.path.join(dir_path, 'genes', 'bundle_1.html')) as f:
+            bundle = f.read()
+        self.assertTrue(bundle.startswith(
+            '<html><head><title>Gene 0</title><style>p { color: red }</style><style>'))
+        # pages are bundled in the order of their names
+        self.assertIn('<div class="kbr-bundle-page" id="page-gene_12"><p>gene 12</p>'
+                      '<img src="data:image/png;base64,ZG90"><img src="../icons/big.png">'
+                      '<a href="bundle_1.html#page-gene_13">next</a></div>', bundle)
+        self.assertIn('<a href="bundle_2.html#page-gene_2">next</a>', bundle)
+        self.assertTrue(bundle.endswith('</body></html>'))
+        with open(os.path.join(dir_path, 'genes', 'bundle_2.html')) as f:
+            self.assertIn('<a href="gene_3.html">next</a>', f.read())
+        # the pages that are not bundled still link to the bundles
+        with open(os.path.join(dir_path, 'genes', 'gene_5.html')) as f:
+            self.assertIn('href="bundle_2.html#page-gene_6"', f.read())
+
+        # too few alike pages are left as they are
+        dir_path = os.path.join(self.scratch, 'small_dir')
+        self._write_gene_report(dir_path, 5)
+        stats = bundle_dir(dir_path, 'index.html', inline_size=0)
+        self.assertEqual(stats, {'inlined': 0, 'bundled': 0, 'bundles': 0, 'removed': 0})
+
+    def test_html_bundle(self):
+        """ html_links directories are bundled before they are zipped """
+        dir_path = os.path.join(self.scratch, 'html_dir')
+        files = self._write_gene_report(dir_path, 25)
+        config = {'html-bundle': True, 'html-bundle-inline-size': 20, 'zip-workers': 1}
+        dfu = FakeDFU()
+        fetch_or_upload_html_links(dfu, [{'name': 'index.html', 'path': dir_path}],
+                                   self.templater, config)
+        zip_path = dfu.calls[0][1]
+        self.assertEqual(dfu.zip_contents[zip_path], [
+            'data.json', 'genes/', 'genes/bundle_1.html', 'genes/gene_3.html',
+            'genes/gene_5.html', 'icons/', 'icons/big.png', 'index.html',
+        ])
+        # the directory that was given is not changed
+        for (name, content) in files.items():
+            with open(os.path.join(dir_path, name)) as f:
+                self.assertEqual(f.read(), content)
+
+    def test_scheduler(self):
+        """ uploads start largest first, with small ones running alongside the large ones """
+        sizes = [1, 500, 2, 300, 400, 3]
+        lock = threading.Lock()
+        state = {'started': [], 'bytes': 0, 'max_bytes': 0}
+
+        def upload(idx):
+            with lock:
+                state['started'].append(idx)
+                if sizes[idx] > 10:
+                    state['bytes'] += sizes[idx]
+                    state['max_bytes'] = max(state['max_bytes'], state['bytes'])
+            time.sleep(0.05 if sizes[idx] > 10 else 0.01)
+            with lock:
+                if sizes[idx] > 10:
+                    state['bytes'] -= sizes[idx]
+            return idx * 10
+
+        (results, failures) = _run_scheduled(upload, list(range(6)), sizes, max_tasks=3,
+                                             max_bytes=700, small_size=10)
+        self.assertEqual(results, [0, 10, 20, 30, 40, 50])
+        self.assertEqual(failures, [])
+        # 500 and 400 do not fit together, so the small files go alongside the largest
+        self.assertEqual(state['started'][:3], [1, 5, 2])
+        self.assertLessEqual(state['max_bytes'], 700)
+        self.assertEqual(sorted(state['started']), list(range(6)))
+
+    def test_scheduler_oversized(self):
+        """ an item bigger than the byte limit still runs, but not alongside other large ones """
+        (results, failures) = _run_scheduled(lambda size: size, [50, 1000, 60], [50, 1000, 60],
+                                             max_tasks=4, max_bytes=100, small_size=0)
+        self.assertEqual(results, [50, 1000, 60])
+        (results, failures) = _run_scheduled(
+            lambda size: 1 / 0 if size == 1000 else size, [50, 1000, 60], [50, 1000, 60],
+            max_tasks=4, max_bytes=100, small_size=0
+        )
+        # nothing else is started once the first upload fails
+        self.assertEqual(results, [None, None, None])
+        self.assertEqual([idx for (idx, err) in failures], [1])
+
+    def test_html_manifest(self):
+        """ re-uploading an html directory only recompresses the files that changed """
+        cache_dir = os.path.join(self.scratch, 'cache')
+        config = {'upload-cache-dir': cache_dir, 'upload-manifest-max-entries': 5,
+                  'zip-workers': 2}
+        dir_path = os.path.join(self.scratch, 'html_dir')
+        os.makedirs(dir_path)
+        shutil.copy2(self.paths[0], os.path.join(dir_path, 'index.html'))
+        shutil.copy2(self.paths[1], os.path.join(dir_path, 'other.html'))
+        links = [{'name': 'index.html', 'path': dir_path}]
+
+        fetch_or_upload_html_links(FakeDFU(), links, self.templater, config)
+        manifest = UploadCache(cache_dir).get_manifest(os.path.realpath(dir_path))
+        self.assertEqual(sorted(manifest['files']), ['index.html', 'other.html'])
+        self.assertTrue(os.path.exists(manifest['archive']))
+
+        with open(os.path.join(dir_path, 'index.html'), 'w') as fd:
+            fd.write('changed')
+        dfu = FakeDFU()
+        with patch('KBaseReport.utils.file_utils.zip_directory',
+                   side_effect=zip_directory) as mock_zip:
+            fetch_or_upload_html_links(dfu, links, self.templater, config)
+        self.assertEqual(mock_zip.call_args[1]['reuse_from'], manifest['archive'])
+        self.assertEqual(mock_zip.call_args[1]['unchanged'], {'other.html'})
+        self.assertEqual(list(dfu.zip_contents.values()), [['index.html', 'other.html']])
+        # the previous archive is replaced by the new one
+        self.assertFalse(os.path.exists(manifest['archive']))
+
+        # nothing changed: the node from the last upload is reused
+        dfu = FakeDFU()
+        fetch_or_upload_html_links(dfu, links, self.templater, config)
+        self.assertEqual(dfu.calls, [('own_shock_node', 'html_dir.zip')])
+
+    def test_retries(self):
+        """ transient errors are retried; other errors are not """
+        config = {'upload-retry-delay': 0.01, 'upload-batch-size': 1}
+        dfu = FakeDFU()
+        attempts = []
+
+        def flaky_upload(params):
+            attempts.append(params['file_path'])
+            if len(attempts) < 3:
+                raise requests.exceptions.ConnectionError('connection reset')
+            return FakeDFU.file_to_shock(dfu, params)
+
+        dfu.file_to_shock = flaky_upload
+        out = fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                         self.templater, config)
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(out[0]['URL'], 'https://shock/node/file_0.txt')
+
+        dfu = FakeDFU(fail_on={'file_0.txt'})
+        with self.assertRaises(LinkUploadError):
+            fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                       self.templater, config)
+        self.assertEqual(len(dfu.calls), 1)
+
+        # HTTP errors are only retried if the server failed (5xx), not the request (4xx)
+        for (status, expected_attempts) in [(503, 4), (401, 1), (413, 1)]:
+            attempts = []
+
+            def http_error(params, status=status):
+                attempts.append(params['file_path'])
+                response = requests.Response()
+                response.status_code = status
+                raise requests.exceptions.HTTPError(f'{status} error', response=response)
+
+            dfu = FakeDFU()
+            dfu.file_to_shock = http_error
+            with self.subTest(status=status), self.assertRaises(LinkUploadError):
+                fetch_or_upload_file_links(dfu, [{'name': 'a', 'path': self.paths[0]}],
+                                           self.templater, config)
+            self.assertEqual(len(attempts), expected_attempts)
+
+    def test_upload_journal(self):
+        """ a retried request only uploads the links that did not complete last time """
+        config = {'scratch': self.scratch, 'upload-batch-size': 1,
+                  'upload-cache-max-entries': 0}
+        request_id = [12345, 'my_report']
+        files = [{'name': 'b', 'template': {'template_file': 'report.tt'}}]
+        files += [{'name': 'a', 'path': path} for path in self.paths[:3]]
+        self.templater.render_template_to_scratch_file.return_value = {'path': self.paths[3]}
+        self.templater.template_stamps.return_value = [['/templates/report.tt', 1, 100]]
+        dfu = FakeDFU(fail_on={'file_2.txt'})
+        with self.assertRaises(LinkUploadError):
+            fetch_or_upload_file_links(dfu, [dict(f) for f in files], self.templater,
+                                       dict(config, **{'upload-concurrency': 1}),
+                                       request_id=request_id)
+        self.assertEqual([path for (method, path) in dfu.calls], [self.paths[3]] + self.paths[:3])
+
+        # a request with the same links but another id has a journal of its own
+        dfu = FakeDFU(fail_on={'file_2.txt'})
+        with self.assertRaises(LinkUploadError):
+            fetch_or_upload_file_links(dfu, [dict(f) for f in files], self.templater,
+                                       config, request_id=[12345, 'other_report'])
+        self.assertEqual(len(dfu.calls), 4)
+        self.assertEqual(len(os.listdir(os.path.join(self.scratch, 'upload_journal'))), 2)
+
+        # file_1 and the template have changed since the first attempt, so they are uploaded
+        # again
+        with open(self.paths[1], 'a') as fd:
+            fd.write('more')
+        self.templater.template_stamps.return_value = [['/templates/report.tt', 2, 120]]
+        dfu = FakeDFU()
+        out = fetch_or_upload_file_links(dfu, [dict(f) for f in files], self.templater, config,
+                                         request_id=request_id)
+        self.assertEqual(sorted(path for (method, path) in dfu.calls), self.paths[1:4])
+        self.assertEqual([f['URL'] for f in out],
+                         ['https://shock/node/file_' + str(n) + '.txt' for n in [3, 0, 1, 2]])
+        # the journal is removed once the request has gone through
+        self.assertEqual(len(os.listdir(os.path.join(self.scratch, 'upload_journal'))), 1)
+
+        # requests without an id are not journalled
+        shutil.rmtree(os.path.join(self.scratch, 'upload_journal'))
+        with self.assertRaises(LinkUploadError):
+            fetch_or_upload_file_links(FakeDFU(fail_on={'file_2.txt'}),
+                                       [dict(f) for f in files], self.templater, config)
+        self.assertFalse(os.path.exists(os.path.join(self.scratch, 'upload_journal')))
+
+    def test_link_timings(self):
+        """ the time spent on each stage of each link is reported """
+        dir_path = os.path.join(self.scratch, 'html_dir')
+        os.makedirs(dir_path)
+        shutil.copy2(self.paths[0], os.path.join(dir_path, 'index.html'))
+        timings = []
+        fetch_or_upload_links(FakeDFU(), [
+            {'name': 'a', 'path': self.paths[0]},
+            {'name': 'b', 'shock_id': 'node_b'},
+        ], [{'name': 'index.html', 'path': dir_path}], self.templater,
+            {'zip-workers': 1, 'upload-cache-dir': os.path.join(self.scratch, 'cache')},
+            timings)
+        self.assertEqual([(link['kind'], link['name']) for link in timings],
+                         [('file', 'a'), ('file', 'b'), ('html', 'index.html')])
+        self.assertEqual(set(timings[0]['timings']), {'stat', 'hash', 'upload'})
+        self.assertEqual(set(timings[1]['timings']), {'stat', 'own'})
+        self.assertEqual(set(timings[2]['timings']), {'stat', 'hash', 'pack', 'upload'})
+
+        # the summary for the report metadata only keeps the start of a long link name
+        summary = json.loads(_summarise_timings(
+            [{'kind': 'file', 'name': 'x' * 10000, 'timings': {'upload': 2.5}}] + timings))
+        self.assertEqual(summary['links'], 4)
+        self.assertEqual(summary['slowest'], 'x' * 97 + '...')
+
+    def test_log_info(self):
+        """ link timings are logged through the MethodContext, or printed without a logger """
+        ctx = MagicMock()
+        _log_info(ctx, 'message')
+        ctx.log_info.assert_called_once_with('message')
+        # as KBaseReportServer.MethodContext(None), whose log_info has no logger to call
+        no_logger = MagicMock()
+        no_logger.log_info.side_effect = AttributeError("'NoneType' has no 'log_message'")
+        with patch('builtins.print') as mock_print:
+            _log_info(no_logger, 'no logger')
+            _log_info(None, 'no context')
+        self.assertEqual([call.args[0].split(' ', 1)[1] for call in mock_print.call_args_list],
+                         ['no logger', 'no context'])
+
+    def test_invalid_config(self):
+        """ the upload config is validated """
+        with self.assertRaisesRegex(TypeError, 'upload-concurrency'):
+            fetch_or_upload_file_links(FakeDFU(), [], self.templater, {'upload-concurrency': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import random
+import unittest
+
+from installed_clients.baseclient import _JSONObjectEncoder
+from KBaseReport.utils import json_codec
+from KBaseReport.utils.json_codec import OrjsonCodec, StdlibCodec
+
+
+class ServerEncoder(json.JSONEncoder):
+    """ as KBaseReportServer.JSONObjectEncoder """
+
+    def default(self, obj):
+        if isinstance(obj, set):
+            return list(obj)
+        if isinstance(obj, frozenset):
+            return list(obj)
+        if hasattr(obj, 'toJSONable'):
+            return obj.toJSONable()
+        return json.JSONEncoder.default(self, obj)
+
+
+class Jsonable:
+
+    def toJSONable(self):
+        return {'name': 'Jsonable', 'sizes': [1.5, 2], 'note': 'ünïcode'}
+
+
+class Text(str):
+    pass
+
+
+OBJECTS = [
+    {'id': '123', 'version': '1.1', 'params': [{'workspace_id': 1, 'message': 'hello'}]},
+    {'z': {'b': 1, 'a': [{'c': 2.5, 'b': None, 'a': True}]}, 'y': False},
+    [0.0, -0.0, 1.0, 0.1, 1e-4, 1e-5, 1e15, 1e16, 1.5e300, 5e-324, float('nan'), float('inf')],
+    [2 ** 63 - 1, 2 ** 63, 2 ** 64, -(2 ** 63), -(2 ** 63) - 1, 10 ** 30],
+    {'set': {1, 2, 3}, 'frozenset': frozenset(['a']), 'toJSONable': Jsonable()},
+    ['ünïcode 😀 \x7f \x00\x1f "quoted" \\ \n\t \u2028 \uffff \U0010ffff',
+     '\\xé \\\\U é\\😀\\'],
+    'lone surrogate \ud800',
+    {1: 'int key', 'str key': 2},
+    {'subclass': Text('text')},
+    {'deep': [[[[[[[[[[{}]]]]]]]]]]},
+]
+
+
+@unittest.skipUnless(json_codec.orjson, 'orjson is not installed')
+class TestJSONCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.orjson = OrjsonCodec()
+        self.stdlib = StdlibCodec()
+
+    def assertSameResult(self, method, *args, **kwargs):
+        results = []
+        for codec in (self.stdlib, self.orjson):
+            try:
+                results.append(repr(getattr(codec, method)(*args, **kwargs)))
+            except Exception as err:
+                results.append(repr(err))
+        self.assertEqual(results[0], results[1], (method, args, kwargs))
+
+    def test_dumps(self):
+        """ orjson output is the same as json.dumps, including for sets and toJSONable """
+        for obj in OBJECTS:
+            for cls in (None, ServerEncoder, _JSONObjectEncoder):
+                for sort_keys in (False, True):
+                    for compact in (False, True):
+                        self.assertSameResult('dumps', obj, cls=cls, sort_keys=sort_keys,
+                                              compact=compact)
+
+        # sets are written as json.dumps writes them: lists, in the set's order
+        self.assertEqual(self.orjson.dumps({'a': {1, 2}}, cls=ServerEncoder, compact=True),
+                         '{"a":[1,2]}')
+        # an encoder that cannot encode the object raises the same error as json.dumps
+        with self.assertRaisesRegex(TypeError, 'Object of type Jsonable is not JSON serializable'):
+            self.orjson.dumps(Jsonable(), cls=_JSONObjectEncoder, compact=True)
+
+    def test_dumps_floats(self):
+        """ floats are written as json.dumps writes them """
+        rand = random.Random(25)
+        floats = [rand.random() * 10 ** rand.randint(-30, 30) * rand.choice([1, -1])
+                  for _ in range(10000)]
+        self.assertEqual(self.orjson.dumps(floats, compact=True),
+                         self.stdlib.dumps(floats, compact=True))
+
+    def test_loads(self):
+        """ orjson parses everything as json.loads does, and raises the same errors """
+        texts = [json.dumps(obj, cls=ServerEncoder) for obj in OBJECTS] + [
+            '123456789012345678901234567890',
+            '[1e400, -1e400]',
+            '"\\ud800"',
+            '{"a": 1, "a": 2}',
+            ' [1, 2] \n',
+            '\ufeff{}',
+            b'\xef\xbb\xbf{}',
+            '{}'.encode('utf-16'),
+            b'{"a": "\xc3\xa9"}',
+            b'\xff',
+            '',
+            '{"a": ',
+            '[1] extra',
+        ]
+        for text in texts:
+            self.assertSameResult('loads', text)
+        self.assertEqual(self.orjson.loads('[18446744073709551616]'), [2 ** 64])
+
+    def test_use_codec(self):
+        """ the module functions use the codec that was chosen """
+        try:
+            json_codec.use_codec('stdlib')
+            self.assertEqual(json_codec.codec_name(), 'stdlib')
+            json_codec.use_codec('auto')
+            self.assertEqual(json_codec.codec_name(), 'orjson')
+            self.assertEqual(json_codec.load(io.StringIO('{"a": [1]}')), {'a': [1]})
+            self.assertEqual(json_codec.dumps({'b': 1, 'a': {2}}, cls=ServerEncoder,
+                                              sort_keys=True), '{"a": [2], "b": 1}')
+            with self.assertRaisesRegex(ValueError, "json-codec must be one of"):
+                json_codec.use_codec('simplejson')
+        finally:
+            json_codec.use_codec()
+
+
+if __name__ == '__main__':
+    unittest.main()